@@ -0,0 +1,334 @@
+"""Admission control for /ws sessions.
+
+Every session holds an upstream Gemini socket, two tasks and DB state, so the
+number of live sessions is capped globally and per user. New sessions are shed
+while the event loop is lagging (the p99 of the LoopWatchdog's heartbeats over
+the last SHED_LOOP_LAG_WINDOW seconds) or the process is above its memory
+budget. Rejections carry a WebSocket close code and a retry hint so clients
+can back off cleanly.
+
+Upstream connects (TLS handshake plus a large setup message) are capped at
+MAX_CONCURRENT_CONNECTS at a time. Waiting connects are queued per user and
+free slots are handed out round-robin across users, so one user opening many
+sessions or reconnecting in a loop cannot starve everyone else. Failed
+connects back off exponentially with jitter (ConnectBackoff), per session.
+
+When several worker processes serve the app, the session caps are enforced
+against a shared SessionRegistry instead of this process's own bookkeeping.
+"""
+import asyncio
+import logging
+import os
+import random
+import resource
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import metrics
+from session_registry import SessionRegistry
+
+logger = logging.getLogger(__name__)
+
+# RFC 6455 close codes used for rejections
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_POLICY_VIOLATION = 1008
+
+ADMISSION_REJECTIONS = metrics.Counter(
+    "admission_rejections_total",
+    "Sessions or upstream connects rejected by admission control, by reason.",
+    labelnames=("reason",),
+)
+CONNECT_QUEUE_WAIT_SECONDS = metrics.Histogram(
+    "upstream_connect_queue_wait_seconds",
+    "Time spent waiting for an upstream connect slot, by kind (initial, reconfigure, reconnect).",
+    labelnames=("kind",),
+)
+CONNECT_QUEUE_DEPTH = metrics.Gauge(
+    "upstream_connect_queue_depth",
+    "Upstream connects currently waiting for a slot.",
+)
+CONNECT_QUEUE_USERS = metrics.Gauge(
+    "upstream_connect_queue_users",
+    "Users with at least one upstream connect waiting for a slot.",
+)
+CONNECTS_IN_FLIGHT = metrics.Gauge(
+    "upstream_connects_in_flight",
+    "Upstream connects currently holding a slot.",
+)
+CONNECT_FAILURES = metrics.Counter(
+    "upstream_connect_failures_total",
+    "Upstream connect attempts that failed, by kind.",
+    labelnames=("kind",),
+)
+CONNECT_BACKOFF_SECONDS = metrics.Histogram(
+    "upstream_connect_backoff_seconds",
+    "Delays imposed before the next upstream connect attempt of a session after a failure.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a session or upstream connect is not admitted."""
+
+    def __init__(self, reason: str, retry_after: float, code: int = CLOSE_TRY_AGAIN_LATER):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.code = code
+
+    def close_reason(self) -> str:
+        """Close frame reason; WebSocket limits this to 123 bytes."""
+        return f"{self.reason}; retry_after={int(self.retry_after)}"[:123]
+
+
+class ConnectBackoff:
+    """Jittered exponential backoff between one session's upstream connect attempts.
+
+    After the n-th consecutive failure the next attempt waits between half and
+    all of min(cap, base * 2**(n-1)) seconds; the random half spreads out
+    sessions that failed together, e.g. when the upstream blipped.
+    """
+
+    def __init__(self, base: float = 0.5, cap: float = 30.0):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self.retry_at = 0.0 # monotonic() before which no attempt should be made
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            base=float(os.getenv("CONNECT_BACKOFF_BASE", "0.5")),
+            cap=float(os.getenv("CONNECT_BACKOFF_MAX", "30")),
+        )
+
+    def remaining(self) -> float:
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def failed(self) -> float:
+        """Record a failure and return the delay before the next attempt."""
+        self.failures += 1
+        ceiling = min(self.cap, self.base * 2 ** (self.failures - 1))
+        delay = random.uniform(ceiling / 2, ceiling)
+        self.retry_at = time.monotonic() + delay
+        CONNECT_BACKOFF_SECONDS.observe(delay)
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+def _current_rss_mb() -> float:
+    """Resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Not on Linux: fall back to the peak RSS (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if peak > 1 << 32 else peak / 1024
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_sessions: int = 200,
+        max_sessions_per_user: int = 5,
+        max_concurrent_connects: int = 10,
+        max_pending_connects: int = 50,
+        connect_queue_timeout: float = 10.0,
+        connect_attempts: int = 3,
+        max_loop_lag: float = 0.25,
+        loop_lag_window: float = 5.0,
+        max_rss_mb: float = 0,
+        retry_after: float = 5.0,
+        registry: SessionRegistry = None,
+        watchdog=None,
+    ):
+        self.max_sessions = max_sessions
+        self.max_sessions_per_user = max_sessions_per_user
+        self.max_concurrent_connects = max_concurrent_connects
+        self.max_pending_connects = max_pending_connects
+        self.connect_queue_timeout = connect_queue_timeout
+        self.connect_attempts = connect_attempts # Tries for connects a session cannot go on without
+        self.max_loop_lag = max_loop_lag
+        self.loop_lag_window = loop_lag_window # Seconds of watchdog heartbeats the shedding p99 covers
+        self.max_rss_mb = max_rss_mb # 0 disables the memory threshold
+        self.retry_after = retry_after
+        self.registry = registry # Shared across worker processes; None for a single process
+        self.watchdog = watchdog # LoopWatchdog whose lag samples drive shedding; None disables it
+
+        self.sessions = {} # client_id -> username
+        self.sessions_per_user = {} # username -> number of live sessions
+        self._active_connects = 0 # Connects holding a slot
+        self._waiters = {} # username -> deque of futures waiting for a slot, oldest first
+        self._turns = deque() # Usernames with waiters, in the order they get the next free slots
+        self._pending_connects = 0
+        CONNECT_QUEUE_DEPTH.set_function(lambda: self._pending_connects)
+        CONNECT_QUEUE_USERS.set_function(lambda: len(self._waiters))
+        CONNECTS_IN_FLIGHT.set_function(lambda: self._active_connects)
+
+    @classmethod
+    def from_env(cls, watchdog=None):
+        """Build a controller from environment variables, falling back to the defaults."""
+        return cls(
+            max_sessions=int(os.getenv("MAX_SESSIONS", "200")),
+            max_sessions_per_user=int(os.getenv("MAX_SESSIONS_PER_USER", "5")),
+            max_concurrent_connects=int(os.getenv("MAX_CONCURRENT_CONNECTS", "10")),
+            max_pending_connects=int(os.getenv("MAX_PENDING_CONNECTS", "50")),
+            connect_queue_timeout=float(os.getenv("CONNECT_QUEUE_TIMEOUT", "10")),
+            connect_attempts=int(os.getenv("CONNECT_ATTEMPTS", "3")),
+            max_loop_lag=float(os.getenv("SHED_LOOP_LAG_MS", "250")) / 1000,
+            loop_lag_window=float(os.getenv("SHED_LOOP_LAG_WINDOW", "5")),
+            max_rss_mb=float(os.getenv("SHED_RSS_MB", "0")),
+            retry_after=float(os.getenv("ADMISSION_RETRY_AFTER", "5")),
+            registry=SessionRegistry(os.environ["SESSION_REGISTRY_PATH"]) if os.getenv("SESSION_REGISTRY_PATH") else None,
+            watchdog=watchdog,
+        )
+
+    def _reject(self, reason: str, code: int = CLOSE_TRY_AGAIN_LATER, retry_after: float = None):
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        raise AdmissionRejected(reason, retry_after if retry_after is not None else self.retry_after, code)
+
+    def check_load(self):
+        """Raise AdmissionRejected if the process is too loaded to take new work."""
+        if self.max_loop_lag and self.watchdog is not None:
+            if self.watchdog.quantile(0.99, seconds=self.loop_lag_window) > self.max_loop_lag:
+                self._reject("event loop overloaded")
+        if self.max_rss_mb and _current_rss_mb() > self.max_rss_mb:
+            self._reject("memory limit reached")
+
+    async def admit(self, client_id: str, username: str):
+        """Register a new session or raise AdmissionRejected."""
+        self.check_load()
+        if self.registry is not None:
+            exceeded = await asyncio.to_thread(
+                self.registry.try_acquire, client_id, username, self.max_sessions, self.max_sessions_per_user
+            )
+        elif len(self.sessions) >= self.max_sessions:
+            exceeded = "sessions"
+        elif self.sessions_per_user.get(username, 0) >= self.max_sessions_per_user:
+            exceeded = "user_sessions"
+        else:
+            exceeded = None
+        if exceeded == "sessions":
+            self._reject("server at session capacity")
+        if exceeded == "user_sessions":
+            # Retrying will not help until the user closes another session
+            self._reject("too many sessions for user", code=CLOSE_POLICY_VIOLATION, retry_after=self.retry_after * 6)
+        self.sessions[client_id] = username
+        self.sessions_per_user[username] = self.sessions_per_user.get(username, 0) + 1
+
+    async def release(self, client_id: str):
+        """Forget a session admitted with admit(). Safe to call for unknown ids."""
+        username = self.sessions.pop(client_id, None)
+        if username is None:
+            return
+        if self.registry is not None:
+            try:
+                await asyncio.to_thread(self.registry.release, client_id)
+            except Exception as e:
+                # The row expires with the next missed heartbeat anyway
+                logger.error("[Admission] Error releasing %s from session registry: %s", client_id, e)
+        remaining = self.sessions_per_user.get(username, 1) - 1
+        if remaining > 0:
+            self.sessions_per_user[username] = remaining
+        else:
+            self.sessions_per_user.pop(username, None)
+
+    async def _acquire_slot(self, username: str):
+        if self._active_connects < self.max_concurrent_connects and not self._turns:
+            self._active_connects += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._waiters.get(username)
+        if queue is None:
+            queue = self._waiters[username] = deque()
+            self._turns.append(username)
+        queue.append(waiter)
+        try:
+            await waiter # _release_slot hands the slot over without decrementing
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot() # Granted just as we gave up: pass it on
+            elif waiter in queue:
+                # Not there if a _release_slot ran between the cancel and this handler and dropped it
+                queue.remove(waiter)
+                if not queue and self._waiters.get(username) is queue:
+                    del self._waiters[username]
+                    self._turns.remove(username)
+            raise
+
+    def _release_slot(self):
+        """Give the slot to the oldest waiter of the next user in turn, or free it."""
+        while self._turns:
+            username = self._turns.popleft()
+            queue = self._waiters[username]
+            waiter = queue.popleft()
+            if queue:
+                self._turns.append(username) # Back of the line until every other waiting user had a turn
+            else:
+                del self._waiters[username]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active_connects -= 1
+
+    @asynccontextmanager
+    async def connect_slot(self, username: str = None, kind: str = "initial"):
+        """Hold one of the limited upstream connect slots for the duration of a connect."""
+        if self._pending_connects >= self.max_pending_connects:
+            self._reject("upstream connect queue full")
+        self._pending_connects += 1
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._acquire_slot(username or ""), timeout=self.connect_queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject("timed out waiting for upstream connect")
+        finally:
+            self._pending_connects -= 1
+        CONNECT_QUEUE_WAIT_SECONDS.labels(kind).observe(time.perf_counter() - queued_at)
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    async def connect_upstream(self, connect, username: str, backoff: ConnectBackoff, kind: str = "initial", attempts: int = None):
+        """Run connect() in a fair connect slot, retrying failures after backoff delays.
+
+        attempts defaults to connect_attempts; the last failure is re-raised.
+        The slot is released while waiting out a backoff delay.
+        """
+        attempts = attempts or self.connect_attempts
+        for attempt in range(1, attempts + 1):
+            delay = backoff.remaining()
+            if delay:
+                await asyncio.sleep(delay)
+            async with self.connect_slot(username, kind):
+                try:
+                    result = await connect()
+                except Exception as e:
+                    CONNECT_FAILURES.labels(kind).inc()
+                    delay = backoff.failed()
+                    if attempt == attempts:
+                        raise
+                    logger.warning("[Admission] Upstream %s connect for %s failed (%s), attempt %d of %d, retrying in %.1fs",
+                                   kind, username, e, attempt, attempts, delay)
+                    continue
+            backoff.succeeded()
+            return result
+
+    async def maintain_registry(self, interval: float = 10.0):
+        """Keep this worker's rows in the shared registry alive."""
+        if self.registry is None:
+            return
+        await asyncio.to_thread(self.registry.clear_worker)
+        while True:
+            try:
+                await asyncio.to_thread(self.registry.heartbeat)
+            except Exception as e:
+                logger.error("[Admission] Session registry heartbeat failed: %s", e)
+            await asyncio.sleep(interval)
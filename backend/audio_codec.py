@@ -0,0 +1,176 @@
+"""Compressed encodings for model audio sent to the browser.
+
+Gemini returns 24 kHz 16-bit PCM, which is the bulk of the /ws egress. A client
+lists the encodings it can decode in its config message, most preferred first:
+
+    {"type": "config", "config": {...}, "audio_codecs": ["mulaw", "pcm16"]}
+
+and the server answers with the one it picked before any audio is sent:
+
+    {"type": "audio_format", "codec": "mulaw", "sample_rate": 24000}
+
+Audio chunks keep their usual shape; only the base64 payload changes.
+
+* ``pcm16``: 16-bit little-endian PCM, passed through untouched (the default).
+* ``mulaw`` / ``alaw``: G.711 companding to 8 bits per sample, half the bytes.
+  Encoding is a single NumPy lookup in a 64K-entry table indexed by the raw
+  sample bits.
+* ``opus``: registered only when opuslib (and libopus) is installed. Each chunk
+  is a sequence of 20 ms packets, each prefixed with its uint16 LE length.
+
+Encoders are created per session because some (Opus) keep stream state.
+Without NumPy only pcm16 is offered.
+"""
+import base64
+import logging
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; only pcm16 is available without it
+    np = None
+
+try:
+    import opuslib
+except ImportError: # Opus is optional
+    opuslib = None
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 24000 # Gemini's output rate
+DEFAULT_CODEC = "pcm16"
+
+
+def _bit_length(values):
+    """Vectorised int.bit_length() for non-negative integer arrays."""
+    return np.frexp(values)[1]
+
+
+def _mulaw_table():
+    """uint8 mu-law code for every int16 sample, indexed by the sample's uint16 bit pattern."""
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32) >> 2 # 14-bit
+    mask = np.where(pcm >= 0, 0xFF, 0x7F)
+    magnitude = np.minimum(np.abs(pcm), 8159) + 0x21
+    segment = np.maximum(_bit_length(magnitude) - 6, 0)
+    code = np.where(segment >= 8, 0x7F, (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F))
+    return (code ^ mask).astype(np.uint8)
+
+
+def _alaw_table():
+    """uint8 A-law code for every int16 sample, indexed by the sample's uint16 bit pattern."""
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32) >> 3 # 13-bit
+    mask = np.where(pcm >= 0, 0xD5, 0x55)
+    magnitude = np.where(pcm >= 0, pcm, -pcm - 1)
+    segment = np.maximum(_bit_length(magnitude) - 5, 0)
+    mantissa = np.where(segment < 2, magnitude >> 1, magnitude >> segment) & 0x0F
+    return (((segment << 4) | mantissa) ^ mask).astype(np.uint8)
+
+
+def mulaw_decode_table():
+    """int16 sample for every mu-law code (used by the bench and by clients' decoders)."""
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    magnitude = (((codes & 0x0F) << 3) + 0x84) << exponent
+    return np.where(codes & 0x80, 0x84 - magnitude, magnitude - 0x84).astype(np.int16)
+
+
+def alaw_decode_table():
+    """int16 sample for every A-law code."""
+    codes = np.arange(256, dtype=np.int32) ^ 0x55
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = np.where(exponent == 0, (mantissa << 4) + 8, ((mantissa << 4) + 0x108) << np.maximum(exponent - 1, 0))
+    return np.where(codes & 0x80, magnitude, -magnitude).astype(np.int16)
+
+
+class PCM16Encoder:
+    name = "pcm16"
+
+    def encode(self, data: str) -> str:
+        return data
+
+    def reset(self):
+        pass
+
+
+class TableEncoder:
+    """Sample-by-sample companding through a precomputed lookup table."""
+
+    _tables = {}
+
+    def __init__(self, name: str, build):
+        self.name = name
+        if name not in self._tables:
+            self._tables[name] = build()
+        self._table = self._tables[name]
+        self._pending = b"" # Odd trailing byte of the previous chunk, half of a sample
+
+    def encode(self, data: str) -> str:
+        raw = base64.b64decode(data)
+        if self._pending:
+            raw = self._pending + raw
+        usable = len(raw) & ~1
+        self._pending = raw[usable:]
+        pcm = np.frombuffer(raw, dtype="<u2", count=usable // 2)
+        return base64.b64encode(self._table[pcm].tobytes()).decode("ascii")
+
+    def reset(self):
+        """Drop a buffered half sample, e.g. when the generation it belongs to was interrupted."""
+        self._pending = b""
+
+
+class OpusEncoder:
+    name = "opus"
+    frame_samples = SAMPLE_RATE // 50 # 20 ms
+
+    def __init__(self):
+        self._encoder = opuslib.Encoder(SAMPLE_RATE, 1, opuslib.APPLICATION_VOIP)
+        self._pending = b"" # PCM left over from the previous chunk, less than one frame
+
+    def encode(self, data: str) -> str:
+        pcm = self._pending + base64.b64decode(data)
+        frame_bytes = self.frame_samples * 2
+        usable = len(pcm) - len(pcm) % frame_bytes
+        self._pending = pcm[usable:]
+        out = bytearray()
+        for offset in range(0, usable, frame_bytes):
+            packet = self._encoder.encode(pcm[offset:offset + frame_bytes], self.frame_samples)
+            out += len(packet).to_bytes(2, "little")
+            out += packet
+        return base64.b64encode(out).decode("ascii")
+
+    def reset(self):
+        """Drop buffered PCM, e.g. when the generation it belongs to was interrupted."""
+        self._pending = b""
+
+
+_FACTORIES = {"pcm16": PCM16Encoder}
+if np is not None:
+    _FACTORIES["mulaw"] = lambda: TableEncoder("mulaw", _mulaw_table)
+    _FACTORIES["alaw"] = lambda: TableEncoder("alaw", _alaw_table)
+if opuslib is not None:
+    _FACTORIES["opus"] = OpusEncoder
+
+
+def register(name: str, factory):
+    """Make another encoder available for negotiation; factory() returns an object with .name, .encode(b64) -> b64 and .reset()."""
+    _FACTORIES[name] = factory
+
+
+def available():
+    return list(_FACTORIES)
+
+
+def negotiate(preferences) -> str:
+    """Pick the first codec in the client's preference list that this server supports."""
+    for name in preferences or ():
+        if name in _FACTORIES:
+            return name
+    return DEFAULT_CODEC
+
+
+def create(name: str):
+    try:
+        return _FACTORIES[name]()
+    except Exception as e:
+        logger.warning("[AudioCodec] Could not create %s encoder, falling back to %s: %s", name, DEFAULT_CODEC, e)
+        return PCM16Encoder()
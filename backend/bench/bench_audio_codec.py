@@ -0,0 +1,82 @@
+"""Compare model audio egress codecs: CPU per second of audio vs bytes on the wire.
+
+Synthesises speech-like 24 kHz PCM (a few drifting harmonics under a syllable
+envelope plus noise), cuts it into Gemini-sized chunks and encodes every chunk
+with each available codec the way ClientEgress does (base64 in, base64 out).
+Reports encoder CPU time per second of audio, the JSON audio message size per
+second of audio, the saving against pcm16, and the SNR after decoding for the
+G.711 codecs.
+
+Usage (from the backend directory):
+    python bench/bench_audio_codec.py --seconds 60 --chunk-ms 100
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio_codec  # noqa: E402
+from audio_codec import SAMPLE_RATE, np  # noqa: E402
+
+
+def make_speech(seconds: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * 3.5 * t), 0, None) ** 2
+    signal = 0.3 * voiced * envelope + 0.01 * rng.standard_normal(t.size)
+    return (np.clip(signal, -1, 1) * 32767).astype("<i2")
+
+
+def snr_db(reference, decoded):
+    reference = reference.astype(np.float64)
+    noise = reference - decoded.astype(np.float64)
+    return 10 * np.log10(np.sum(reference ** 2) / max(np.sum(noise ** 2), 1e-12))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=60.0)
+    parser.add_argument("--chunk-ms", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3, help="best of N timing rounds")
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit("NumPy is not installed")
+
+    pcm = make_speech(args.seconds)
+    samples_per_chunk = SAMPLE_RATE * args.chunk_ms // 1000
+    chunks = [base64.b64encode(pcm[i:i + samples_per_chunk].tobytes()).decode("ascii")
+              for i in range(0, pcm.size, samples_per_chunk)]
+    decoders = {"mulaw": audio_codec.mulaw_decode_table(), "alaw": audio_codec.alaw_decode_table()}
+
+    baseline = None
+    print(f"{args.seconds:.0f} s of 24 kHz audio in {len(chunks)} chunks of {args.chunk_ms} ms")
+    print(f"{'codec':8s} {'cpu us/s':>10s} {'wire KB/s':>10s} {'saved':>7s} {'snr dB':>7s}")
+    for name in audio_codec.available():
+        best = float("inf")
+        for _ in range(args.rounds):
+            encoder = audio_codec.create(name)
+            started = time.process_time()
+            encoded = [encoder.encode(chunk) for chunk in chunks]
+            best = min(best, time.process_time() - started)
+        wire = sum(len(json.dumps({"type": "audio", "data": data, "epoch": 0, "seq": i}, separators=(",", ":")))
+                   for i, data in enumerate(encoded))
+        if baseline is None:
+            baseline = wire
+        snr = ""
+        if name in decoders:
+            codes = np.frombuffer(b"".join(base64.b64decode(data) for data in encoded), dtype=np.uint8)
+            snr = f"{snr_db(pcm, decoders[name][codes]):7.1f}"
+        print(f"{name:8s} {best / args.seconds * 1e6:10.0f} {wire / args.seconds / 1000:10.1f} "
+              f"{(1 - wire / baseline) * 100:6.0f}% {snr:>7s}")
+
+
+if __name__ == "__main__":
+    main()
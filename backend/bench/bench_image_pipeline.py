@@ -0,0 +1,83 @@
+"""Benchmark the image downscale/re-encode pipeline in frames per second per core.
+
+Synthesises screen-share-like JPEG frames, then runs image_pipeline.process_frame
+single-threaded (frames per CPU-second, i.e. per core) and through the worker
+pool used by prepare_frame (aggregate frames per second).
+
+Usage (from the backend directory):
+    python bench/bench_image_pipeline.py --width 2560 --height 1440 --frames 200
+"""
+import argparse
+import base64
+import io
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_pipeline import process_frame  # noqa: E402
+from vision import Image  # noqa: E402
+
+
+def make_frame(width: int, height: int, seed: int, quality: int = 90) -> bytes:
+    from PIL import ImageDraw
+
+    rng = random.Random(seed)
+    img = Image.new("RGB", (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + rng.randrange(20, width // 3), y + rng.randrange(10, height // 6)), fill=color)
+    for row in range(0, height, 24):
+        draw.text((20, row), "lorem ipsum dolor sit amet " * 8, fill=(20, 20, 20))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--max-dimension", type=int, default=1024)
+    parser.add_argument("--quality", type=int, default=70)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    args = parser.parse_args()
+
+    if Image is None:
+        sys.exit("Pillow is not installed")
+
+    # Frames arrive base64 encoded, and process_frame decodes and re-encodes them
+    frames = [base64.b64encode(make_frame(args.width, args.height, seed)).decode("ascii") for seed in range(8)]
+    results = [process_frame(f, args.max_dimension, args.quality) for f in frames]
+    in_bytes = sum(r[2] for r in results) / len(results)
+    out_bytes = sum(r[3] for r in results) / len(results)
+    print(f"frame {args.width}x{args.height}: {in_bytes / 1024:.0f} KiB -> {out_bytes / 1024:.0f} KiB "
+          f"(max_dimension={args.max_dimension}, quality={args.quality})")
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(args.frames):
+        process_frame(frames[i % len(frames)], args.max_dimension, args.quality)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    print(f"single thread: {args.frames / wall:7.1f} frames/s, {args.frames / cpu:7.1f} frames per CPU-second")
+
+    for name, pool_cls in (("threads", ThreadPoolExecutor), ("processes", ProcessPoolExecutor)):
+        with pool_cls(max_workers=args.workers) as pool:
+            list(pool.map(process_frame, frames, [args.max_dimension] * len(frames), [args.quality] * len(frames)))
+            wall_start = time.perf_counter()
+            jobs = [frames[i % len(frames)] for i in range(args.frames)]
+            list(pool.map(process_frame, jobs, [args.max_dimension] * len(jobs), [args.quality] * len(jobs)))
+            wall = time.perf_counter() - wall_start
+        print(f"{args.workers} {name:9s}: {args.frames / wall:7.1f} frames/s aggregate, "
+              f"{args.frames / wall / args.workers:7.1f} frames/s per worker")
+
+
+if __name__ == "__main__":
+    main()
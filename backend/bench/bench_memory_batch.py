@@ -0,0 +1,75 @@
+"""Measure bulk memory edits: one MemoryDB call per row vs one batch transaction.
+
+Per row is what the memory panel costs today, one DELETE /memories/{id} (and
+one commit) for every selected memory. The batch methods apply all ids in a
+single transaction with executemany. Both sides run on fresh copies of the
+same database for delete, update and retype.
+
+Usage (from the backend directory):
+    python bench/bench_memory_batch.py --rows 2000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import MemoryDB  # noqa: E402
+
+USERNAME = "admin"
+
+
+def fresh_db(tmp: str, name: str, rows: int):
+    db = MemoryDB(os.path.join(tmp, f"{name}.db"))
+    db.open()
+    for i in range(rows):
+        db.store_memory(f"Memory number {i} about something the user said.", USERNAME)
+    return db, [m["id"] for m in db.get_all_memories(USERNAME)]
+
+
+def per_row(db: MemoryDB, op: str, ids: list):
+    for memory_id in ids:
+        if op == "delete":
+            db.delete_memory(memory_id, USERNAME)
+        elif op == "update":
+            db.update_memory(memory_id, "Edited memory.", USERNAME)
+        else:
+            # There is no single-row retype; an update is the closest per-row write
+            db.update_memory(memory_id, "Retyped memory.", USERNAME)
+
+
+def batch(db: MemoryDB, op: str, ids: list):
+    if op == "delete":
+        db.delete_memories(ids, USERNAME)
+    elif op == "update":
+        db.update_memories({memory_id: "Edited memory." for memory_id in ids}, USERNAME)
+    else:
+        db.retype_memories(ids, "note", USERNAME)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000, help="memories edited per operation")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    print(f"{args.rows} memories per operation")
+    print(f"{'op':8s} {'per-row ms':>11s} {'batch ms':>9s} {'speedup':>8s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for op in ("delete", "update", "retype"):
+            timings = []
+            for mode, apply in (("row", per_row), ("batch", batch)):
+                db, ids = fresh_db(tmp, f"{op}-{mode}", args.rows)
+                started = time.perf_counter()
+                apply(db, op, ids)
+                timings.append(time.perf_counter() - started)
+                db.close()
+            print(f"{op:8s} {timings[0] * 1000:11.1f} {timings[1] * 1000:9.1f} {timings[0] / timings[1]:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
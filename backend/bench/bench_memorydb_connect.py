@@ -0,0 +1,88 @@
+"""Measure the MemoryDB work a /ws connect costs, per-session vs shared service.
+
+Every connect loads the user's saved config, saves the merged config and reads
+the user's memories for the setup prompt. Two ways of doing that are compared
+on the same database file:
+
+* per-session: what GeminiConnection used to do, building its own MemoryDB
+  (schema creation and the default user lookup) and opening a fresh SQLite
+  connection for every call.
+* shared: one MemoryDB opened once, as the lifespan handler now does, with
+  each thread reusing its connection.
+
+Reports the wall time per connect (mean, p50, p95) and the speedup.
+
+Usage (from the backend directory):
+    python bench/bench_memorydb_connect.py --connects 2000 --memories 50
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import MemoryDB  # noqa: E402
+
+CONFIG = {"systemPrompt": "You are a friendly AI assistant.", "voice": "Puck"}
+
+
+def session_work(db: MemoryDB, username: str, fresh_connections: bool):
+    calls = (
+        lambda: db.get_user_config(username),
+        lambda: db.update_user_config(username, CONFIG),
+        lambda: db.get_all_memories(username),
+    )
+    for call in calls:
+        call()
+        if fresh_connections:
+            db.close() # The next call opens a new connection, as every call used to
+
+
+def per_session(path: str, username: str):
+    db = MemoryDB(path)
+    db.open()
+    session_work(db, username, fresh_connections=True)
+
+
+def run(label: str, connect, connects: int):
+    samples = []
+    for _ in range(connects):
+        started = time.perf_counter()
+        connect()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    mean = statistics.fmean(samples)
+    print(f"{label:12s} {mean * 1e6:9.0f} {samples[len(samples) // 2] * 1e6:9.0f} "
+          f"{samples[int(len(samples) * 0.95)] * 1e6:9.0f}")
+    return mean
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connects", type=int, default=2000)
+    parser.add_argument("--memories", type=int, default=50, help="stored memories for the connecting user")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "memories.db")
+        shared = MemoryDB(path)
+        shared.open()
+        for i in range(args.memories):
+            shared.store_memory(f"Memory number {i} about something the user said.", "admin")
+
+        print(f"{args.connects} connects, {args.memories} memories")
+        print(f"{'mode':12s} {'mean us':>9s} {'p50 us':>9s} {'p95 us':>9s}")
+        before = run("per-session", lambda: per_session(path, "admin"), args.connects)
+        after = run("shared", lambda: session_work(shared, "admin", fresh_connections=False), args.connects)
+        print(f"speedup {before / after:.1f}x")
+        shared.close()
+
+
+if __name__ == "__main__":
+    main()
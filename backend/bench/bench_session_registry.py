@@ -0,0 +1,86 @@
+"""Benchmark the shared session registry across worker processes.
+
+Each worker process admits, holds and releases sessions through
+AdmissionController backed by one SessionRegistry file, the same path every
+/ws session takes under serve.py. Reports admitted sessions per second per
+worker and the CPU cost per admit+release, i.e. how many session setups one
+core can account for. That is only the accounting part of a session; for live
+sessions per core end to end, run bench_sessions_per_core.py.
+
+Usage (from the backend directory):
+    python bench/bench_session_registry.py --workers 4 --sessions 2000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, AdmissionRejected  # noqa: E402
+from session_registry import SessionRegistry  # noqa: E402
+
+
+async def _run_worker(path, worker, sessions, held):
+    admission = AdmissionController(
+        max_sessions=10 ** 9, max_sessions_per_user=10 ** 9, max_loop_lag=0, registry=SessionRegistry(path)
+    )
+    live = []
+    rejected = 0
+    for i in range(sessions):
+        client_id = f"bench-{worker}:{i}"
+        try:
+            await admission.admit(client_id, f"user{i % 50}")
+        except AdmissionRejected:
+            rejected += 1
+            continue
+        live.append(client_id)
+        if len(live) > held:
+            await admission.release(live.pop(0))
+    for client_id in live:
+        await admission.release(client_id)
+    return rejected
+
+
+def _worker(path, worker, sessions, held, results):
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    rejected = asyncio.run(_run_worker(path, worker, sessions, held))
+    results.put((worker, time.perf_counter() - wall_start, time.process_time() - cpu_start, rejected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--sessions", type=int, default=2000, help="sessions admitted per worker")
+    parser.add_argument("--held", type=int, default=100, help="sessions each worker keeps open at a time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.db")
+        SessionRegistry(path)
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=_worker, args=(path, w, args.sessions, args.held, results))
+            for w in range(args.workers)
+        ]
+        for p in procs:
+            p.start()
+        rows = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+    total_wall = max(r[1] for r in rows)
+    total_cpu = sum(r[2] for r in rows)
+    admitted = args.workers * args.sessions - sum(r[3] for r in rows)
+    print(f"workers={args.workers} sessions/worker={args.sessions} held/worker={args.held}")
+    for worker, wall, cpu, rejected in sorted(rows):
+        print(f"  worker {worker}: {args.sessions / wall:8.0f} admits/s  cpu/admit={cpu / args.sessions * 1e6:7.0f} us  rejected={rejected}")
+    print(f"aggregate: {admitted / total_wall:.0f} admits/s, {admitted / total_cpu:.0f} admits per CPU-second")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Measure live /ws sessions per core end to end, for one or more worker counts.
+
+Starts bench/mock_gemini.py as the upstream, then for every --workers value
+starts serve.py with that many workers (in a scratch directory, so the
+memories and session registry databases are fresh) and runs bench/loadgen.py
+against it at every --sessions level. Sessions stream real-time audio and get
+model audio turns back, so the server CPU per session covers the whole path:
+admission and the shared registry, ingress resampling, the upstream relay and
+the egress queue. bench_session_registry.py only measures the admission part.
+
+sessions/core is sessions divided by the server's busy cores (CPU seconds of
+the serve.py process tree per wall second), i.e. how many such sessions one
+fully used core would carry. Compare it across worker counts, and watch the
+response latency p99 to see where a level stops being sustainable. loadgen and
+the mock run on the same host and take CPU too, so leave cores free for them.
+
+Usage (from the backend directory):
+    python bench/bench_sessions_per_core.py --workers 1 2 --sessions 25 50 100 --duration 20
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BACKEND, "bench"))
+
+import loadgen  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"process exited with {process.returncode} before listening on {port}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    sys.exit(f"nothing listening on {port} after {timeout:.0f}s")
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[25, 50])
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of streaming per level after ramp-up")
+    parser.add_argument("--ramp", type=float, default=5.0)
+    parser.add_argument("--first-audio-latency", type=float, default=0.3, help="mock upstream delay before model audio")
+    args = parser.parse_args()
+
+    mock_port = free_port()
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND, "bench", "mock_gemini.py"), "--port", str(mock_port),
+         "--first-audio-latency", str(args.first_audio_latency)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    rows = []
+    try:
+        wait_for_port(mock_port, mock)
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as scratch:
+                port = free_port()
+                env = {
+                    **os.environ,
+                    "PYTHONPATH": BACKEND,
+                    "GEMINI_WS_URI": f"ws://127.0.0.1:{mock_port}",
+                    "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY", "bench"),
+                    "MAX_SESSIONS": "100000",
+                    "MAX_SESSIONS_PER_USER": "100000",
+                    "MAX_PENDING_CONNECTS": "100000",
+                    "LOG_LEVEL": "warning",
+                }
+                server = subprocess.Popen(
+                    [sys.executable, os.path.join(BACKEND, "serve.py"), "--workers", str(workers), "--port", str(port),
+                     "--log-level", "warning"],
+                    cwd=scratch, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                )
+                try:
+                    wait_for_port(port, server)
+                    for sessions in args.sessions:
+                        print(f"--- {workers} worker(s), {sessions} sessions")
+                        load = argparse.Namespace(
+                            url=f"ws://127.0.0.1:{port}", username="admin", password="admin", sessions=sessions,
+                            duration=args.duration, ramp=args.ramp, chunk_bytes=1280, chunk_interval=0.04,
+                            server_pid=server.pid,
+                        )
+                        rows.append((workers, sessions, asyncio.run(loadgen.main_async(load))))
+                finally:
+                    stop(server)
+    finally:
+        stop(mock)
+
+    print()
+    print(f"{'workers':>7s} {'sessions':>8s} {'live':>5s} {'failed':>6s} {'busy cores':>10s} "
+          f"{'sessions/core':>13s} {'resp p50 ms':>11s} {'resp p99 ms':>11s}")
+    for workers, sessions, result in rows:
+        cores = result["busy_cores"] or float("nan")
+        print(f"{workers:7d} {sessions:8d} {result['sessions']:5d} {result['failed']:6d} {cores:10.2f} "
+              f"{result['sessions'] / cores:13.0f} {result['response_p50'] * 1000:11.1f} {result['response_p99'] * 1000:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
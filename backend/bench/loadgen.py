@@ -0,0 +1,206 @@
+"""Open N authenticated /ws sessions against the backend and report load figures.
+
+Each session logs in through /token once (shared), sends its config, then
+streams 16 kHz PCM audio chunks in real time. Reports message and byte
+throughput, time to the first server message, last-user-audio to
+first-model-audio latency percentiles, and the server's CPU and RSS when
+--server-pid is given (child worker processes are included).
+
+Usage (from the backend directory), with the backend pointed at the mock:
+    python bench/mock_gemini.py --port 9000 &
+    GEMINI_WS_URI=ws://127.0.0.1:9000 MAX_SESSIONS_PER_USER=1000 python serve.py --workers 2 &
+    python bench/loadgen.py --sessions 100 --duration 30 --server-pid <serve.py pid>
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+import urllib.parse
+import urllib.request
+
+from websockets.asyncio.client import connect
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def login(http_url: str, username: str, password: str) -> str:
+    body = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    with urllib.request.urlopen(f"{http_url}/token", data=body) as response:
+        return json.loads(response.read())["access_token"]
+
+
+def _process_tree(pid: int):
+    """pid plus all of its descendants (Linux /proc)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def sample_server(pid: int):
+    """Return (cpu seconds, rss bytes) summed over the server process tree."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu = rss = 0
+    for proc in _process_tree(pid):
+        try:
+            with open(f"/proc/{proc}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{proc}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, rss
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.rejected = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ready_latencies = []
+        self.response_latencies = []
+        self.errors = {}
+
+
+async def run_session(ws_url: str, token: str, args, stats: Stats, deadline: float):
+    chunk = json.dumps({
+        "type": "audio",
+        "data": base64.b64encode(os.urandom(args.chunk_bytes)).decode("ascii")
+    })
+    started = time.perf_counter()
+    try:
+        async with connect(f"{ws_url}/ws?token={token}", max_size=None) as ws:
+            await ws.send(json.dumps({"type": "config", "config": {"voice": "Puck"}}))
+            stats.connected += 1
+            last_audio_at = None
+            awaiting_first_audio = True
+            got_first_message = False
+
+            async def receiver():
+                nonlocal awaiting_first_audio, got_first_message
+                async for raw in ws:
+                    now = time.perf_counter()
+                    stats.messages_in += 1
+                    stats.bytes_in += len(raw)
+                    if not got_first_message:
+                        got_first_message = True
+                        stats.ready_latencies.append(now - started)
+                    message = json.loads(raw)
+                    if message.get("type") == "audio":
+                        if awaiting_first_audio and last_audio_at is not None:
+                            stats.response_latencies.append(now - last_audio_at)
+                        awaiting_first_audio = False
+                    elif message.get("type") in ("turn_complete", "stop_audio"):
+                        awaiting_first_audio = True
+                    elif message.get("type") == "error":
+                        stats.rejected += 1
+                        stats.errors[message.get("message")] = stats.errors.get(message.get("message"), 0) + 1
+
+            receive_task = asyncio.create_task(receiver())
+            try:
+                next_send = time.perf_counter()
+                while time.perf_counter() < deadline and not receive_task.done():
+                    await ws.send(chunk)
+                    last_audio_at = time.perf_counter()
+                    stats.messages_out += 1
+                    stats.bytes_out += len(chunk)
+                    next_send += args.chunk_interval
+                    await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            finally:
+                receive_task.cancel()
+    except Exception as e:
+        stats.failed += 1
+        name = type(e).__name__
+        stats.errors[name] = stats.errors.get(name, 0) + 1
+
+
+async def main_async(args) -> dict:
+    """Run the load and print the report; returns the headline figures (used by bench_sessions_per_core.py)."""
+    http_url = args.url.replace("ws://", "http://").replace("wss://", "https://")
+    token = await asyncio.to_thread(login, http_url, args.username, args.password)
+    stats = Stats()
+    server_before = sample_server(args.server_pid) if args.server_pid else None
+
+    started = time.perf_counter()
+    deadline = started + args.ramp + args.duration
+    tasks = []
+    for i in range(args.sessions):
+        tasks.append(asyncio.create_task(run_session(args.url, token, args, stats, deadline)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / args.sessions)
+    peak_rss = 0
+    while any(not t.done() for t in tasks):
+        await asyncio.sleep(1.0)
+        if args.server_pid:
+            peak_rss = max(peak_rss, sample_server(args.server_pid)[1])
+    elapsed = time.perf_counter() - started
+
+    print(f"sessions: {args.sessions} requested, {stats.connected} connected, "
+          f"{stats.rejected} rejected by the server, {stats.failed} failed")
+    print(f"client -> server: {stats.messages_out / elapsed:8.0f} msg/s {stats.bytes_out / elapsed / 1e6:7.2f} MB/s")
+    print(f"server -> client: {stats.messages_in / elapsed:8.0f} msg/s {stats.bytes_in / elapsed / 1e6:7.2f} MB/s")
+    for label, values in (("first message", stats.ready_latencies), ("response latency", stats.response_latencies)):
+        print(f"{label:17s} n={len(values):5d} p50={percentile(values, 50) * 1000:7.1f} ms "
+              f"p90={percentile(values, 90) * 1000:7.1f} ms p99={percentile(values, 99) * 1000:7.1f} ms")
+    summary = {
+        "sessions": stats.connected - stats.rejected,
+        "failed": stats.failed + stats.rejected,
+        "response_p50": percentile(stats.response_latencies, 50),
+        "response_p99": percentile(stats.response_latencies, 99),
+        "busy_cores": None,
+        "peak_rss": peak_rss,
+    }
+    if server_before:
+        cpu_after, rss_after = sample_server(args.server_pid)
+        cpu = cpu_after - server_before[0]
+        summary["busy_cores"] = cpu / elapsed
+        print(f"server: cpu {cpu:.1f} s ({cpu / elapsed * 100:.0f}% of one core), "
+              f"rss {rss_after / 1e6:.0f} MB (peak {peak_rss / 1e6:.0f} MB), "
+              f"{summary['sessions'] / max(cpu / elapsed, 1e-9):.0f} sessions per busy core")
+    if stats.errors:
+        print(f"errors: {stats.errors}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open N authenticated /ws sessions and report throughput and latency.")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of streaming after ramp-up")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which sessions are opened")
+    parser.add_argument("--chunk-bytes", type=int, default=1280, help="PCM bytes per audio chunk (1280 = 40 ms at 16 kHz)")
+    parser.add_argument("--chunk-interval", type=float, default=0.04)
+    parser.add_argument("--server-pid", type=int, help="backend process to sample for CPU and RSS")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
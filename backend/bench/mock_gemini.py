@@ -0,0 +1,150 @@
+"""Local stand-in for the Gemini BidiGenerateContent WebSocket.
+
+Speaks the subset of the protocol the backend uses: it acknowledges ``setup``,
+streams ``serverContent`` model audio after every N ``realtime_input`` audio
+chunks, sends ``turnComplete``, answers ``realtime_input.interrupt`` with
+``interrupted``, and can emit a ``toolCall`` every few turns. Latencies and
+payload sizes are configurable so load tests do not depend on the real API.
+
+Usage (from the backend directory):
+    python bench/mock_gemini.py --port 9000 --first-audio-latency 0.3
+    GEMINI_WS_URI=ws://127.0.0.1:9000 python main.py
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+logger = logging.getLogger("mock_gemini")
+
+
+class MockGemini:
+    def __init__(
+        self,
+        setup_latency: float = 0.05,
+        first_audio_latency: float = 0.3,
+        audio_per_turn: int = 25,
+        chunks_per_turn: int = 20,
+        chunk_bytes: int = 4800,
+        chunk_interval: float = 0.1,
+        tool_call_every: int = 0,
+    ):
+        self.setup_latency = setup_latency # Delay before acknowledging setup
+        self.first_audio_latency = first_audio_latency # Delay before the first audio chunk of a turn
+        self.audio_per_turn = audio_per_turn # Client audio chunks that trigger a model turn
+        self.chunks_per_turn = chunks_per_turn
+        self.chunk_bytes = chunk_bytes # Raw PCM bytes per chunk (4800 = 100 ms at 24 kHz)
+        self.chunk_interval = chunk_interval # Seconds between streamed chunks
+        self.tool_call_every = tool_call_every # Emit a toolCall every N turns; 0 disables
+        self.sessions = 0
+        self._call_ids = itertools.count(1)
+        self._chunk_payload = json.dumps({
+            "serverContent": {
+                "modelTurn": {
+                    "parts": [{
+                        "inlineData": {
+                            "mimeType": "audio/pcm;rate=24000",
+                            "data": base64.b64encode(os.urandom(chunk_bytes)).decode("ascii")
+                        }
+                    }]
+                }
+            }
+        })
+
+    async def _stream_turn(self, ws, turn: int):
+        await asyncio.sleep(self.first_audio_latency)
+        if self.tool_call_every and turn % self.tool_call_every == 0:
+            await ws.send(json.dumps({
+                "toolCall": {
+                    "functionCalls": [{
+                        "id": f"call-{next(self._call_ids)}",
+                        "name": "get_recent_memories",
+                        "args": {"limit": 3}
+                    }]
+                }
+            }))
+        for _ in range(self.chunks_per_turn):
+            await ws.send(self._chunk_payload)
+            await asyncio.sleep(self.chunk_interval)
+        await ws.send(json.dumps({"serverContent": {"turnComplete": True}}))
+
+    async def handler(self, ws):
+        self.sessions += 1
+        turn_task = None
+        turns = 0
+        audio_chunks = 0
+        try:
+            setup = json.loads(await ws.recv())
+            if "setup" not in setup:
+                await ws.close(code=1008, reason="Expected setup")
+                return
+            await asyncio.sleep(self.setup_latency)
+            await ws.send(json.dumps({"setupComplete": {}}))
+
+            async for raw in ws:
+                message = json.loads(raw)
+                realtime_input = message.get("realtime_input", {})
+                if "interrupt" in realtime_input:
+                    if turn_task and not turn_task.done():
+                        turn_task.cancel()
+                        await ws.send(json.dumps({"serverContent": {"interrupted": True}}))
+                    continue
+                for chunk in realtime_input.get("media_chunks", []):
+                    if not chunk.get("mime_type", "").startswith("audio"):
+                        continue
+                    audio_chunks += 1
+                    if audio_chunks % self.audio_per_turn == 0 and (turn_task is None or turn_task.done()):
+                        turns += 1
+                        turn_task = asyncio.create_task(self._stream_turn(ws, turns))
+                # toolResponse and clientContent messages need no reply
+        except ConnectionClosed:
+            pass
+        finally:
+            if turn_task and not turn_task.done():
+                turn_task.cancel()
+            self.sessions -= 1
+
+
+async def run(host: str, port: int, mock: MockGemini):
+    async with serve(mock.handler, host, port, max_size=None):
+        logger.info("Mock Gemini listening on ws://%s:%d", host, port)
+        await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini BidiGenerateContent WebSocket.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--setup-latency", type=float, default=0.05)
+    parser.add_argument("--first-audio-latency", type=float, default=0.3)
+    parser.add_argument("--audio-per-turn", type=int, default=25)
+    parser.add_argument("--chunks-per-turn", type=int, default=20)
+    parser.add_argument("--chunk-bytes", type=int, default=4800)
+    parser.add_argument("--chunk-interval", type=float, default=0.1)
+    parser.add_argument("--tool-call-every", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    mock = MockGemini(
+        setup_latency=args.setup_latency,
+        first_audio_latency=args.first_audio_latency,
+        audio_per_turn=args.audio_per_turn,
+        chunks_per_turn=args.chunks_per_turn,
+        chunk_bytes=args.chunk_bytes,
+        chunk_interval=args.chunk_interval,
+        tool_call_every=args.tool_call_every,
+    )
+    try:
+        asyncio.run(run(args.host, args.port, mock))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Replay recorded sessions through websocket_endpoint for regression benchmarks.
+
+Starts a replay upstream (answers setup, then plays back the recorded Gemini
+messages) and the backend app in this process, then opens one or more /ws
+sessions that play back the recorded client messages. With --speed 1 both
+sides follow the recorded timestamps; --speed 0 sends everything as fast as
+possible, which measures the relay hot path. Reports relayed message
+counts, wall time and CPU time per recorded second.
+
+Record sessions with RECORD_DIR=recordings python main.py, then (from the
+backend directory):
+    python bench/replay.py recordings/<file>.awrec --speed 0 --sessions 20
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import CLIENT_IN, UPSTREAM_IN, RecordingReader  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _play(records, speed: float, send):
+    """Send (offset, payload) records, pacing them by offset/speed unless speed is 0."""
+    started = time.perf_counter()
+    for offset, payload in records:
+        if speed > 0:
+            delay = started + offset / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await send(payload)
+
+
+class Counters:
+    def __init__(self):
+        self.client_sent = 0
+        self.client_received = 0
+        self.upstream_sent = 0
+        self.upstream_received = 0
+
+
+async def main_async(args):
+    # Messages are decoded once up front so the harness does not dominate the profile
+    with RecordingReader(args.recording) as reader:
+        client_records = [(offset, bytes(payload).decode("utf-8")) for offset, payload in reader.records(CLIENT_IN)]
+        upstream_records = [(offset, bytes(payload).decode("utf-8")) for offset, payload in reader.records(UPSTREAM_IN)]
+    if not client_records:
+        sys.exit("Recording has no client messages")
+    # The first upstream record is the setup response, the first client record the config message
+    setup_response = upstream_records.pop(0)[1] if upstream_records else '{"setupComplete": {}}'
+    recorded_seconds = max(r[0] for r in client_records + upstream_records)
+
+    upstream_port, app_port = _free_port(), _free_port()
+    os.environ["GEMINI_WS_URI"] = f"ws://127.0.0.1:{upstream_port}"
+    os.environ.setdefault("MAX_SESSIONS_PER_USER", str(args.sessions))
+    os.environ.pop("RECORD_DIR", None)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import uvicorn
+    from websockets.asyncio.client import connect
+    from websockets.asyncio.server import serve
+    from websockets.exceptions import ConnectionClosed
+
+    import main
+    from security import create_access_token
+
+    counters = Counters()
+
+    async def upstream_handler(ws):
+        await ws.recv() # setup
+        await ws.send(setup_response)
+
+        async def send(payload):
+            await ws.send(payload)
+            counters.upstream_sent += 1
+
+        player = asyncio.create_task(_play(upstream_records, args.speed, send))
+        try:
+            async for _ in ws:
+                counters.upstream_received += 1
+        except ConnectionClosed:
+            pass
+        finally:
+            player.cancel()
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=app_port, log_level="warning", ws="websockets"))
+    token = create_access_token({"sub": args.username})
+
+    async def run_client():
+        async with connect(f"ws://127.0.0.1:{app_port}/ws?token={token}", max_size=None) as ws:
+            async def receiver():
+                async for _ in ws:
+                    counters.client_received += 1
+
+            receive_task = asyncio.create_task(receiver())
+
+            async def send(payload):
+                await ws.send(payload)
+                counters.client_sent += 1
+
+            await _play(client_records, args.speed, send)
+            # Give in-flight responses a moment to drain before closing normally
+            await asyncio.sleep(args.drain)
+            receive_task.cancel()
+
+    async with serve(upstream_handler, "127.0.0.1", upstream_port, max_size=None):
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(run_client() for _ in range(args.sessions)))
+        wall = time.perf_counter() - wall_start - args.drain
+        cpu = time.process_time() - cpu_start
+
+        server.should_exit = True
+        await server_task
+
+    total_recorded = recorded_seconds * args.sessions
+    print(f"recording: {args.recording} ({recorded_seconds:.1f} s, {len(client_records)} client / "
+          f"{len(upstream_records) + 1} upstream messages)")
+    print(f"sessions={args.sessions} speed={'max' if args.speed <= 0 else f'{args.speed}x'}")
+    print(f"client:   sent {counters.client_sent}, received {counters.client_received}")
+    print(f"upstream: sent {counters.upstream_sent}, received {counters.upstream_received}")
+    print(f"wall {wall:.2f} s, cpu {cpu:.2f} s (harness included), "
+          f"{cpu / max(total_recorded, 1e-9) * 1000:.1f} ms CPU per recorded session-second, "
+          f"{(counters.client_sent + counters.upstream_sent) / max(wall, 1e-9):.0f} relayed msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sessions through the /ws endpoint.")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=0.0, help="1 = recorded pace, 0 = as fast as possible")
+    parser.add_argument("--sessions", type=int, default=1)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--drain", type=float, default=0.5, help="seconds to wait for responses after the last message")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""ETags and conditional GET for per-user resources versioned by MemoryDB.
+
+The ETag of /memories and /config is the user's version counter for that
+resource, so a route can answer If-None-Match from MemoryDB.get_versions (one
+primary key lookup) without loading or serializing anything. Responses carry
+``Cache-Control: private, no-cache``: browsers keep the body and revalidate on
+every request, which turns the frontend's plain re-fetches into 304s without
+any frontend change. The version is also sent as X-Version so that clients can
+ask for ``?since_version=`` deltas.
+
+Every user's counters start at 0, so the tag also carries a digest of the
+username and responses vary on Authorization. Otherwise a second user in the
+same browser whose counter happens to match would be served the first user's
+cached body.
+"""
+import hashlib
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+import metrics
+
+CONDITIONAL_GETS = metrics.Counter(
+    "conditional_get_responses_total",
+    "Responses of versioned routes, by route and result (not_modified, delta, full).",
+    labelnames=("route", "result"),
+)
+
+
+def etag(resource: str, username: str, version: int) -> str:
+    user = hashlib.sha256(username.encode()).hexdigest()[:16]
+    return f'"{resource}-{user}-{version}"'
+
+
+def _headers(tag: str, version: int) -> dict:
+    return {"ETag": tag, "Cache-Control": "private, no-cache", "Vary": "Authorization", "X-Version": str(version)}
+
+
+def matches(request: Request, tag: str) -> bool:
+    """Whether the request's If-None-Match lists tag (weak comparison, as RFC 9110 asks for)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == tag for candidate in header.split(","))
+
+
+def not_modified(route: str, resource: str, username: str, version: int) -> Response:
+    CONDITIONAL_GETS.labels(route, "not_modified").inc()
+    return Response(status_code=304, headers=_headers(etag(resource, username, version), version))
+
+
+def versioned_json(route: str, result: str, resource: str, username: str, version: int, content) -> JSONResponse:
+    CONDITIONAL_GETS.labels(route, result).inc()
+    return JSONResponse(content, headers=_headers(etag(resource, username, version), version))
@@ -1,15 +1,118 @@
 import sqlite3
 from datetime import datetime
+import functools
 import json
+import logging
+import threading
+import time
 from security import get_password_hash
+import metrics
+from session_stats import current_stats
+
+logger = logging.getLogger(__name__)
+
+def _timed(func):
+    """Records the duration of a MemoryDB call in the db_call_seconds histogram and the calling session's stats."""
+    histogram = metrics.DB_CALL_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed)
+            stats = current_stats.get()
+            if stats is not None:
+                stats.db_seconds += elapsed
+    return wrapper
 
 class MemoryDB:
-    def __init__(self, db_path="memories.db"):
+    """Process-wide storage service for memories, users and their configs.
+
+    One instance is shared by every session and route. open() creates the schema
+    and the default user once at startup; each thread that uses the service
+    (the event loop and the to_thread workers) then reuses its own SQLite
+    connection until close() is called at shutdown.
+
+    Every user has two version counters, one for their memories and one for
+    their config, each bumped in the same transaction as the write that changes
+    it. Memory rows carry the version that last wrote them and deletes leave a
+    tombstone, so get_memories_since can tell a client what changed after the
+    version it last saw.
+    """
+    _write_listeners = [] # Callbacks run with the username after a write to memories (None: all users)
+    _change_listeners = [] # Callbacks run with the username and a description of the change
+
+    def __init__(self, db_path="memories.db", timeout: float = 30.0):
         self.db_path = db_path
+        self.timeout = timeout # Seconds to wait on a lock held by another connection or worker process
+        self._local = threading.local() # Per-thread connection
+        self._connections = [] # Every connection opened, so close() can reach other threads' ones
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """This thread's connection; use it as a context manager for a transaction."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Only ever used from the thread that opened it; close() may run elsewhere
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def open(self):
+        """Create the schema and default user. Called once at startup."""
         self.init_db()
+        logger.info("[MemoryDB] Opened %s", self.db_path)
+
+    def close(self):
+        """Close every thread's connection. Called once at shutdown."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning("[MemoryDB] Error closing connection: %s", e)
+        logger.info("[MemoryDB] Closed %d connection(s)", len(connections))
+
+    @classmethod
+    def add_write_listener(cls, callback):
+        """Register callback(username) to run after memories change, e.g. to invalidate caches."""
+        cls._write_listeners.append(callback)
+
+    @classmethod
+    def add_change_listener(cls, callback):
+        """Register callback(username, change) to run after a memory change is committed.
+
+        change is a memory_added, memory_updated or memory_deleted event with the
+        memory id and the new memories version, or memories_cleared (username None).
+        Added and updated events carry the new or changed fields under "memory".
+        Callbacks run on the writing thread, which may be a to_thread worker.
+        """
+        cls._change_listeners.append(callback)
+
+    def _notify_write(self, username, *changes: dict):
+        for callback in self._write_listeners:
+            try:
+                callback(username)
+            except Exception as e:
+                logger.error("[MemoryDB] Write listener %r failed: %s", callback, e)
+        for callback in self._change_listeners:
+            for change in changes:
+                try:
+                    callback(username, change)
+                except Exception as e:
+                    logger.error("[MemoryDB] Change listener %r failed: %s", callback, e)
 
     def init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
+            # WAL lets readers in other worker processes proceed while one process writes
+            conn.execute("PRAGMA journal_mode=WAL")
             # Create memories table
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS memories (
@@ -17,7 +120,33 @@ class MemoryDB:
                     content TEXT NOT NULL,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     type TEXT NOT NULL,
-                    username TEXT NOT NULL
+                    username TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0
+                )""")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(memories)")]
+            if "version" not in columns:
+                try:
+                    conn.execute("ALTER TABLE memories ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    pass # Another worker process added it first
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_username_version ON memories (username, version)")
+
+            # Version counters per user; memories_reset is the version of the last clear_memories,
+            # before which get_memories_since can no longer give a delta
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_versions (
+                    username TEXT PRIMARY KEY,
+                    memories_version INTEGER NOT NULL DEFAULT 0,
+                    memories_reset INTEGER NOT NULL DEFAULT 0,
+                    config_version INTEGER NOT NULL DEFAULT 0
+                )""")
+
+            # Deleted memory ids, so deltas can report deletes
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS memory_tombstones (
+                    memory_id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    version INTEGER NOT NULL
                 )""")
             
             # Create users table – add config column to store JSON config
@@ -33,6 +162,16 @@ class MemoryDB:
             conn.commit()
             self.create_default_user()
 
+    @staticmethod
+    def _bump_version(conn, username: str, column: str) -> int:
+        """Increment one of the user's counters inside the caller's transaction and return it."""
+        conn.execute(
+            f"INSERT INTO user_versions (username, {column}) VALUES (?, 1) "
+            f"ON CONFLICT (username) DO UPDATE SET {column} = {column} + 1",
+            (username,)
+        )
+        return conn.execute(f"SELECT {column} FROM user_versions WHERE username = ?", (username,)).fetchone()[0]
+
     def create_default_user(self):
         """Creates a default admin user if it doesn't exist."""
         default_username = "admin"
@@ -47,16 +186,21 @@ class MemoryDB:
             "cancelPhrase": ""
         }
 
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.execute(
                 "SELECT username FROM users WHERE username = ?",
                 (default_username,)
             )
             if cursor.fetchone() is None:
-                self.create_user(default_username, default_password)
+                try:
+                    self.create_user(default_username, default_password)
+                except sqlite3.IntegrityError:
+                    # Another worker process created it first
+                    return
                 self.update_user_config(default_username, default_config)
-                print(f"[MemoryDB] Created default user: {default_username}")
+                logger.info("[MemoryDB] Created default user: %s", default_username)
 
+    @_timed
     def store_memory(self, content: str, username: str, type: str = "conversation", context: str = None, tags: list = None):
         """Stores a memory in the database.
 
@@ -67,37 +211,91 @@ class MemoryDB:
             context: Optional context about the memory
             tags: Optional list of tags to categorize the memory
         """
-        print(f"[MemoryDB] Storing {type} memory...")
-        print(f"[MemoryDB] Content preview: {content[:100]}...")
-        if context:
-            print(f"[MemoryDB] Context: {context}")
-        if tags:
-            print(f"[MemoryDB] Tags: {', '.join(tags)}")
+        logger.debug("[MemoryDB] Storing %s memory...", type)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[MemoryDB] Content preview: %s...", content[:100])
+            if context:
+                logger.debug("[MemoryDB] Context: %s", context)
+            if tags:
+                logger.debug("[MemoryDB] Tags: %s", ", ".join(tags))
             
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "INSERT INTO memories (content, type, username) VALUES (?, ?, ?)",
-                (content, type, username)
-            )
+        with self._connect() as conn:
+            version = self._bump_version(conn, username, "memories_version")
+            memory_id = conn.execute(
+                "INSERT INTO memories (content, type, username, version) VALUES (?, ?, ?, ?)",
+                (content, type, username, version)
+            ).lastrowid
+            timestamp, = conn.execute("SELECT timestamp FROM memories WHERE id = ?", (memory_id,)).fetchone()
             conn.commit()
-        print(f"[MemoryDB] Successfully stored memory")
+        self._notify_write(username, {
+            "type": "memory_added", "id": memory_id, "version": version,
+            "memory": {"id": memory_id, "content": content, "timestamp": timestamp, "type": type},
+        })
+        logger.info("[MemoryDB] Successfully stored %s memory", type)
+        return version
 
-    def get_all_memories(self, username: str):
+    @_timed
+    def get_all_memories(self, username: str, limit: int = None):
         """Retrieves all memories from the database.
         
         Args:
             username: User identifier to filter memories
+            limit: Optional maximum number of (newest) memories to return
         """
-        print(f"[MemoryDB] Fetching all memories for user {username}...")
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute(
-                "SELECT id, content, timestamp, type FROM memories WHERE username = ? ORDER BY timestamp DESC",
-                (username,)
+        logger.debug("[MemoryDB] Fetching all memories for user %s...", username)
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row # Per cursor, since the connection is shared with other calls
+            cursor.execute(
+                "SELECT id, content, timestamp, type FROM memories WHERE username = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (username, -1 if limit is None else limit)
             )
             memories = cursor.fetchall()
             return [dict(memory) for memory in memories]
 
+    @_timed
+    def get_versions(self, username: str) -> dict:
+        """The user's current memories and config versions (0 before their first write)."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT memories_version, config_version FROM user_versions WHERE username = ?",
+                (username,)
+            ).fetchone()
+            memories_version, config_version = row or (0, 0)
+            return {"memories": memories_version, "config": config_version}
+
+    @_timed
+    def get_memories_since(self, username: str, since_version: int) -> dict:
+        """Memories written and ids deleted after since_version, for polling clients.
+
+        Returns {"version", "full", "memories", "deleted"}. If the changes since
+        since_version are no longer known (clear_memories dropped the tombstones)
+        or since_version was never handed out by this database, "full" is True
+        and "memories" holds all of the user's memories instead.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN") # One snapshot for the version and the rows
+            row = conn.execute(
+                "SELECT memories_version, memories_reset FROM user_versions WHERE username = ?",
+                (username,)
+            ).fetchone()
+            version, reset = row or (0, 0)
+            full = since_version < reset or since_version > version
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(
+                "SELECT id, content, timestamp, type, version FROM memories WHERE username = ? AND version > ? "
+                "ORDER BY timestamp DESC, id DESC",
+                (username, -1 if full else since_version)
+            )
+            memories = [dict(memory) for memory in cursor.fetchall()]
+            deleted = [] if full else [memory_id for memory_id, in conn.execute(
+                "SELECT memory_id FROM memory_tombstones WHERE username = ? AND version > ?",
+                (username, since_version)
+            )]
+        return {"version": version, "full": full, "memories": memories, "deleted": deleted}
+
+    @_timed
     def get_recent_memories(self, username: str, limit: int = 5):
         """Retrieves recent memories from the database.
         
@@ -105,15 +303,16 @@ class MemoryDB:
             username: User
             limit: Maximum number of memories to retrieve
         """
-        print(f"[MemoryDB] Fetching {limit} recent memories...")
-        with sqlite3.connect(self.db_path) as conn:
+        logger.debug("[MemoryDB] Fetching %s recent memories...", limit)
+        with self._connect() as conn:
             cursor = conn.execute(
-                "SELECT content, timestamp FROM memories WHERE username = ? ORDER BY timestamp DESC LIMIT ?",
+                "SELECT content, timestamp FROM memories WHERE username = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
                 (username, limit)
             )
             memories = cursor.fetchall()
             return memories
 
+    @_timed
     def search_memories(self, username: str, query: str, limit: int = 5):
         """Searches memories by content.
         
@@ -122,50 +321,165 @@ class MemoryDB:
             query: Search term to look for in memory content
             limit: Maximum number of results to return
         """
-        print(f"[MemoryDB] Searching memories with query: {query}")
-        with sqlite3.connect(self.db_path) as conn:
+        logger.debug("[MemoryDB] Searching memories with query: %s", query)
+        with self._connect() as conn:
             cursor = conn.execute(
-                "SELECT content, timestamp FROM memories WHERE username = ? AND content LIKE ? ORDER BY timestamp DESC LIMIT ?",
+                "SELECT content, timestamp FROM memories WHERE username = ? AND content LIKE ? ORDER BY timestamp DESC, id DESC LIMIT ?",
                 (username, f"%{query}%", limit)
             )
             memories = cursor.fetchall()
             return memories
 
+    @_timed
     def clear_memories(self):
         """Clears all memories"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
+            # Deltas from before this point are gone with the tombstones: bump every affected user's
+            # version and mark it as a reset, so their clients fall back to a full reload
+            affected = "SELECT username FROM memories UNION SELECT username FROM memory_tombstones"
+            conn.execute(f"INSERT OR IGNORE INTO user_versions (username) {affected}")
+            conn.execute(
+                "UPDATE user_versions SET memories_version = memories_version + 1, memories_reset = memories_version + 1 "
+                f"WHERE username IN ({affected})"
+            )
             conn.execute("DELETE FROM memories")
+            conn.execute("DELETE FROM memory_tombstones")
             conn.commit()
-            print("[MemoryDB] Cleared all memories")
+            logger.info("[MemoryDB] Cleared all memories")
+        self._notify_write(None, {"type": "memories_cleared"})
 
+    @_timed
     def delete_memory(self, memory_id: int, username: str):
-        """Deletes a specific memory by ID"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("DELETE FROM memories WHERE id = ? AND username = ?", (memory_id, username))
+        """Deletes a specific memory by ID. Returns the new memories version, None if there was no such memory."""
+        with self._connect() as conn:
+            version = self._bump_version(conn, username, "memories_version")
+            if conn.execute("DELETE FROM memories WHERE id = ? AND username = ?", (memory_id, username)).rowcount == 0:
+                conn.rollback()
+                return None
+            conn.execute(
+                "INSERT OR REPLACE INTO memory_tombstones (memory_id, username, version) VALUES (?, ?, ?)",
+                (memory_id, username, version)
+            )
             conn.commit()
+        self._notify_write(username, {"type": "memory_deleted", "id": memory_id, "version": version})
+        return version
 
+    @_timed
     def update_memory(self, memory_id: int, new_content: str, username: str):
-        """Updates the content of a specific memory"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "UPDATE memories SET content = ? WHERE id = ? AND username = ?",
-                (new_content, memory_id, username)
+        """Updates the content of a specific memory. Returns the new memories version, None if there was no such memory."""
+        with self._connect() as conn:
+            version = self._bump_version(conn, username, "memories_version")
+            cursor = conn.execute(
+                "UPDATE memories SET content = ?, version = ? WHERE id = ? AND username = ?",
+                (new_content, version, memory_id, username)
             )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return None
             conn.commit()
+        self._notify_write(username, {"type": "memory_updated", "id": memory_id, "version": version, "memory": {"id": memory_id, "content": new_content}})
+        return version
+
+    BATCH_CHUNK = 500 # Ids per IN (...) lookup, well under SQLite's bound parameter limit
+
+    def _begin_batch(self, conn, username: str, memory_ids):
+        """Start a batch write and return the ones among memory_ids that belong to username.
+
+        The write lock is taken before looking, so the answer holds until commit.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        found = set()
+        for start in range(0, len(memory_ids), self.BATCH_CHUNK):
+            chunk = memory_ids[start:start + self.BATCH_CHUNK]
+            found.update(memory_id for memory_id, in conn.execute(
+                f"SELECT id FROM memories WHERE username = ? AND id IN ({','.join('?' * len(chunk))})",
+                (username, *chunk)
+            ))
+        return found
+
+    @_timed
+    def delete_memories(self, memory_ids: list, username: str):
+        """Deletes many memories in one transaction.
+
+        Returns (version, results): the new memories version (None if nothing
+        matched) and {memory_id: deleted} for every requested id.
+        """
+        memory_ids = list(dict.fromkeys(memory_ids))
+        with self._connect() as conn:
+            found = self._begin_batch(conn, username, memory_ids)
+            if not found:
+                conn.rollback()
+                return None, dict.fromkeys(memory_ids, False)
+            version = self._bump_version(conn, username, "memories_version")
+            rows = [(memory_id, username) for memory_id in memory_ids if memory_id in found]
+            conn.executemany("DELETE FROM memories WHERE id = ? AND username = ?", rows)
+            conn.executemany(
+                "INSERT OR REPLACE INTO memory_tombstones (memory_id, username, version) VALUES (?, ?, ?)",
+                [(memory_id, username, version) for memory_id, _ in rows]
+            )
+            conn.commit()
+        self._notify_write(username, *({"type": "memory_deleted", "id": memory_id, "version": version} for memory_id, _ in rows))
+        logger.info("[MemoryDB] Deleted %d of %d memories for user %s", len(rows), len(memory_ids), username)
+        return version, {memory_id: memory_id in found for memory_id in memory_ids}
+
+    @_timed
+    def update_memories(self, updates: dict, username: str):
+        """Replaces the content of many memories ({memory_id: new_content}) in one transaction.
+
+        Returns (version, results) like delete_memories.
+        """
+        with self._connect() as conn:
+            found = self._begin_batch(conn, username, list(updates))
+            if not found:
+                conn.rollback()
+                return None, dict.fromkeys(updates, False)
+            version = self._bump_version(conn, username, "memories_version")
+            rows = [(content, version, memory_id, username) for memory_id, content in updates.items() if memory_id in found]
+            conn.executemany("UPDATE memories SET content = ?, version = ? WHERE id = ? AND username = ?", rows)
+            conn.commit()
+        self._notify_write(username, *(
+            {"type": "memory_updated", "id": memory_id, "version": version, "memory": {"id": memory_id, "content": content}}
+            for content, _, memory_id, _ in rows
+        ))
+        logger.info("[MemoryDB] Updated %d of %d memories for user %s", len(rows), len(updates), username)
+        return version, {memory_id: memory_id in found for memory_id in updates}
+
+    @_timed
+    def retype_memories(self, memory_ids: list, new_type: str, username: str):
+        """Sets the type of many memories in one transaction. Returns (version, results) like delete_memories."""
+        memory_ids = list(dict.fromkeys(memory_ids))
+        with self._connect() as conn:
+            found = self._begin_batch(conn, username, memory_ids)
+            if not found:
+                conn.rollback()
+                return None, dict.fromkeys(memory_ids, False)
+            version = self._bump_version(conn, username, "memories_version")
+            rows = [(new_type, version, memory_id, username) for memory_id in memory_ids if memory_id in found]
+            conn.executemany("UPDATE memories SET type = ?, version = ? WHERE id = ? AND username = ?", rows)
+            conn.commit()
+        self._notify_write(username, *(
+            {"type": "memory_updated", "id": memory_id, "version": version, "memory": {"id": memory_id, "type": new_type}}
+            for _, _, memory_id, _ in rows
+        ))
+        logger.info("[MemoryDB] Retyped %d of %d memories for user %s to %s", len(rows), len(memory_ids), username, new_type)
+        return version, {memory_id: memory_id in found for memory_id in memory_ids}
+
+    @_timed
     def create_user(self, username: str, password: str):
         """Creates a new user with hashed password"""
         hashed_password = get_password_hash(password)
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             conn.execute(
                 "INSERT INTO users (username, hashed_password) VALUES (?, ?)",
                 (username, hashed_password)
             )
             conn.commit()
-        print(f"[MemoryDB] Created user {username}")
+        logger.info("[MemoryDB] Created user %s", username)
 
+    @_timed
     def get_user(self, username: str):
         """Get user by username"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.execute(
                 "SELECT username, hashed_password FROM users WHERE username = ?",
                 (username,)
@@ -173,38 +487,47 @@ class MemoryDB:
             user = cursor.fetchone()
             return user
 
+    @_timed
     def get_memory(self, memory_id: int):
         """Retrieves a specific memory by ID.
         
         Args:
             memory_id: The ID of the memory to retrieve
         """
-        print(f"[MemoryDB] Fetching memory ID {memory_id}...")
-        with sqlite3.connect(self.db_path) as conn:
+        logger.debug("[MemoryDB] Fetching memory ID %s...", memory_id)
+        with self._connect() as conn:
             cursor = conn.execute(
                 "SELECT id, content, timestamp, type FROM memories WHERE id = ?",
                 (memory_id,)
             )
             memory = cursor.fetchone()
-            if memory:
-                print(f"[MemoryDB] Found memory: {memory[1][:100]}...")
-            else:
-                print(f"[MemoryDB] Memory ID {memory_id} not found")
+            if memory is None:
+                logger.debug("[MemoryDB] Memory ID %s not found", memory_id)
             return memory
 
+    @_timed
     def update_user_config(self, username: str, config: dict):
-        """Update the configuration for a user."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "UPDATE users SET config = ? WHERE username = ?",
-                (json.dumps(config), username)
+        """Update the configuration for a user. Returns the config version, which only moves if the config changed."""
+        with self._connect() as conn:
+            config_json = json.dumps(config)
+            cursor = conn.execute(
+                "UPDATE users SET config = ? WHERE username = ? AND config IS NOT ?",
+                (config_json, username, config_json)
             )
+            if cursor.rowcount:
+                version = self._bump_version(conn, username, "config_version")
+            else:
+                # Unchanged (every /ws connect saves the config it was given) or no such user
+                row = conn.execute("SELECT config_version FROM user_versions WHERE username = ?", (username,)).fetchone()
+                version = row[0] if row else 0
             conn.commit()
-        print(f"[MemoryDB] Updated config for user {username}")
+        logger.info("[MemoryDB] Updated config for user %s", username)
+        return version
 
+    @_timed
     def get_user_config(self, username: str):
         """Retrieve a user’s configuration."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.execute(
                 "SELECT config FROM users WHERE username = ?",
                 (username,)
@@ -214,5 +537,5 @@ class MemoryDB:
                 try:
                     return json.loads(row[0])
                 except Exception as e:
-                    print(f"[MemoryDB] Error parsing config for user {username}: {e}")
+                    logger.error("[MemoryDB] Error parsing config for user %s: %s", username, e)
             return None
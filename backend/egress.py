@@ -0,0 +1,174 @@
+"""Per-session outbound queue for messages to the browser, with generation epochs.
+
+Everything websocket_endpoint forwards from Gemini goes through a ClientEgress:
+the Gemini receiver enqueues and a sender task writes to the client socket.
+Model audio chunks are tagged with the generation epoch they belong to and a
+sequence number within that epoch:
+
+    {"type": "audio", "data": "...", "epoch": 3, "seq": 17}
+
+A model turn is stamped with the epoch current when its first chunk arrives.
+An interrupt (from the client or from Gemini) bumps the epoch, purges queued
+messages of older epochs straight away and puts ``stop_audio`` carrying the
+new epoch at the head of the queue, so the client falls silent without
+waiting for the backlog to drain. Chunks of the interrupted turn that are
+still arriving from upstream are dropped until Gemini ends that turn. Clients
+drop any chunk whose epoch is older than the last ``stop_audio`` they saw and
+acknowledge with ``{"type": "audio_stopped", "epoch": N}`` once playback has
+stopped, which gives the end-to-end interrupt-to-silence latency.
+
+Model audio is re-encoded on the way in with the codec the session negotiated
+(see audio_codec), after the epoch check so interrupted chunks cost nothing.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import audio_codec
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STALE_AUDIO_DROPPED = metrics.Counter(
+    "interrupted_audio_chunks_dropped_total",
+    "Model audio chunks of an interrupted generation that were not sent, by where they were caught (queue, upstream).",
+    labelnames=("stage",),
+)
+_DROPPED_QUEUED = STALE_AUDIO_DROPPED.labels("queue")
+_DROPPED_UPSTREAM = STALE_AUDIO_DROPPED.labels("upstream")
+INTERRUPT_SILENCE_SECONDS = metrics.Histogram(
+    "interrupt_to_silence_seconds",
+    "Time from an interrupt to the client acknowledging that playback stopped.",
+)
+EGRESS_QUEUE_DEPTH = metrics.Histogram(
+    "client_egress_queue_depth",
+    "Messages already queued for the client when a new message is enqueued.",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500),
+)
+
+
+class ClientEgress:
+    def __init__(self, send, max_queued: int = 256):
+        self._send = send # Coroutine function that writes one message to the client
+        self.max_queued = max_queued # Producers wait once this many messages are queued
+        self.epoch = 0
+        self.seq = 0 # Sequence number of the next audio chunk within the current epoch
+        self.turn_epoch = None # Epoch of the model turn in progress, None between turns
+        self.closed = False
+        self._queue = deque() # (epoch or None, payload, interrupted_at or None)
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._pending_silence = None # (epoch, perf_counter of the interrupt) awaiting the client's ack
+        self.encoder = audio_codec.create(audio_codec.DEFAULT_CODEC) # Negotiated model audio encoding
+
+    @classmethod
+    def from_env(cls, send):
+        return cls(send, max_queued=int(os.getenv("CLIENT_EGRESS_MAX_QUEUE", "256")))
+
+    @property
+    def stale_turn(self) -> bool:
+        """True while the model is still producing a turn that has been interrupted"""
+        return self.turn_epoch is not None and self.turn_epoch < self.epoch
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def put(self, payload: dict, epoch=None) -> bool:
+        """Queue a message; epoch marks it as part of a generation an interrupt may purge.
+
+        Returns False if the message was dropped because the sender has stopped or
+        the generation was interrupted while waiting for queue space.
+        """
+        while len(self._queue) >= self.max_queued and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        if self.closed:
+            return False
+        if epoch is not None and epoch < self.epoch:
+            _DROPPED_QUEUED.inc()
+            return True
+        EGRESS_QUEUE_DEPTH.observe(len(self._queue))
+        self._queue.append((epoch, payload, None))
+        self._ready.set()
+        return True
+
+    async def set_codec(self, preferences) -> str:
+        """Pick the audio encoding from the client's preference list and announce it."""
+        name = audio_codec.negotiate(preferences)
+        if name != self.encoder.name:
+            self.encoder = audio_codec.create(name)
+        await self.put({"type": "audio_format", "codec": self.encoder.name, "sample_rate": audio_codec.SAMPLE_RATE})
+        return self.encoder.name
+
+    async def audio(self, kind: str, data: str) -> bool:
+        """Queue a model media chunk, tagged with its turn's epoch and a sequence number."""
+        if self.turn_epoch is None:
+            self.turn_epoch = self.epoch
+        elif self.turn_epoch < self.epoch:
+            _DROPPED_UPSTREAM.inc()
+            return True
+        if kind == "audio":
+            data = self.encoder.encode(data)
+        payload = {"type": kind, "data": data, "epoch": self.turn_epoch, "seq": self.seq}
+        self.seq += 1
+        return await self.put(payload, epoch=self.turn_epoch)
+
+    def end_turn(self) -> bool:
+        """Mark the model turn as finished. Returns False if it had been interrupted."""
+        interrupted = self.stale_turn
+        self.turn_epoch = None
+        return not interrupted
+
+    def interrupt(self, started: float = None) -> int:
+        """Start a new epoch: purge queued messages of older ones and send stop_audio first.
+
+        started is the perf_counter() at which the interrupt arrived, used for the latency
+        metrics. Returns the new epoch.
+        """
+        started = started if started is not None else time.perf_counter()
+        self.epoch += 1
+        self.seq = 0
+        self.encoder.reset()
+        kept = deque(item for item in self._queue if item[0] is None or item[0] >= self.epoch)
+        purged = len(self._queue) - len(kept)
+        if purged:
+            _DROPPED_QUEUED.inc(purged)
+        kept.appendleft((None, {"type": "stop_audio", "data": True, "epoch": self.epoch}, started))
+        self._queue = kept
+        self._pending_silence = (self.epoch, started)
+        self._ready.set()
+        if len(self._queue) < self.max_queued:
+            self._space.set()
+        logger.debug("[ClientEgress] Interrupt: epoch %d, purged %d queued messages.", self.epoch, purged)
+        return self.epoch
+
+    def playback_stopped(self, epoch: int):
+        """Record the client's acknowledgement that it went silent for epoch."""
+        if self._pending_silence is not None and epoch >= self._pending_silence[0]:
+            INTERRUPT_SILENCE_SECONDS.observe(time.perf_counter() - self._pending_silence[1])
+            self._pending_silence = None
+
+    async def run(self):
+        """Write queued messages to the client until cancelled or a send fails."""
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                _, payload, interrupted_at = self._queue.popleft()
+                if len(self._queue) < self.max_queued:
+                    self._space.set()
+                await self._send(payload)
+                if interrupted_at is not None:
+                    metrics.INTERRUPT_LATENCY_SECONDS.observe(time.perf_counter() - interrupted_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("[ClientEgress] Error sending to client, stopping egress: %s", e)
+        finally:
+            self.closed = True
+            self._queue.clear()
+            self._space.set()
@@ -0,0 +1,65 @@
+"""Closing the upstream Gemini socket of /ws sessions that have gone quiet.
+
+A browser tab left open keeps its session's upstream socket and receiver task
+alive even when nothing has been said for hours. Every GeminiConnection records
+when audio or images last went upstream or a message last came back
+(``last_activity``), and the reaper periodically closes the upstream of any
+session that has been idle for longer than SESSION_IDLE_TIMEOUT seconds. The
+client socket stays open; the session is marked ``reaped`` and reconnects
+lazily when its next audio message arrives.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+IDLE_REAPED = metrics.Counter("idle_upstreams_reaped_total", "Upstream sockets closed because their session was idle.")
+IDLE_REVIVED = metrics.Counter("idle_upstreams_revived_total", "Reaped sessions reconnected by a new audio message.")
+IDLE_SESSIONS = metrics.Gauge("idle_sessions", "Sessions whose upstream socket is currently closed by the idle reaper.")
+
+
+class IdleReaper:
+    def __init__(self, idle_timeout: float = 300.0, check_interval: float = 30.0):
+        self.idle_timeout = idle_timeout # 0 disables reaping
+        self.check_interval = check_interval
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            idle_timeout=float(os.getenv("SESSION_IDLE_TIMEOUT", "300")),
+            check_interval=float(os.getenv("SESSION_IDLE_CHECK_INTERVAL", "30")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.idle_timeout > 0
+
+    async def run(self, sessions: dict):
+        """Close idle upstreams among sessions (client_id -> GeminiConnection) until cancelled."""
+        IDLE_SESSIONS.set_function(lambda: sum(1 for gemini in sessions.values() if gemini.reaped))
+        if not self.enabled:
+            return
+        # Check often enough that a session is reaped within a fraction of the timeout
+        interval = min(self.check_interval, self.idle_timeout / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for client_id, gemini in list(sessions.items()):
+                if gemini.reaped or not gemini.is_open():
+                    continue
+                idle = now - gemini.last_activity
+                if idle >= self.idle_timeout:
+                    await self.reap(client_id, gemini, idle)
+
+    async def reap(self, client_id: str, gemini, idle: float):
+        gemini.reaped = True
+        IDLE_REAPED.inc()
+        logger.info("[IdleReaper-%s] Session idle for %.0fs, closing upstream until the next audio message.", client_id, idle)
+        try:
+            await gemini.close()
+        except Exception as e:
+            logger.error("[IdleReaper-%s] Error closing idle upstream: %s", client_id, e)
@@ -0,0 +1,138 @@
+"""Off-loop decode, downscale and re-encode of client image frames.
+
+Screen-share frames can be several megapixels, and relaying them unchanged
+inflates upstream bandwidth and Gemini ingest time. prepare_frame() decodes a
+frame once on a worker pool, computes the perceptual hash used by the vision
+ingest stage, and, when the frame exceeds the session's maximum dimension,
+downscales and re-encodes it at the configured JPEG quality. Nothing here runs
+on the event loop, including the base64 decode and encode of the frame.
+
+Clients may set maxImageDimension and imageQuality in their config, within
+MAX_DIMENSION_RANGE and QUALITY_RANGE; frame_options() checks them.
+
+The pool is a thread pool by default (Pillow releases the GIL while decoding,
+resizing and encoding); set IMAGE_POOL=process to use processes instead.
+"""
+import asyncio
+import base64
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+from vision import Image, dhash_image, frame_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1024")) # 0 disables downscaling
+DEFAULT_QUALITY = int(os.getenv("IMAGE_QUALITY", "70"))
+MAX_DIMENSION_RANGE = (64, 4096)
+QUALITY_RANGE = (1, 95)
+
+IMAGE_PREPARE_SECONDS = metrics.Histogram(
+    "image_prepare_seconds",
+    "Time from submitting a frame to the image pool until it is ready to forward.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+IMAGE_BYTES = metrics.Counter(
+    "image_bytes_total",
+    "JPEG bytes of client frames before (in) and after (out) the image pipeline.",
+    labelnames=("stage",),
+)
+_IMAGE_BYTES_IN = IMAGE_BYTES.labels("in")
+_IMAGE_BYTES_OUT = IMAGE_BYTES.labels("out")
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("IMAGE_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+        if os.getenv("IMAGE_POOL", "thread") == "process":
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+    return _executor
+
+
+def shutdown():
+    """Stop the worker pool (called at application shutdown)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _bounded_int(config: dict, key: str, default: int, bounds: tuple) -> int:
+    value = config.get(key)
+    if value is None:
+        return default
+    low, high = bounds
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != int(value) or not low <= value <= high:
+        raise ValueError(f"{key} must be an integer from {low} to {high}")
+    return int(value)
+
+
+def frame_options(config: dict) -> tuple:
+    """(max_dimension, quality) for a session config, with the defaults for unset keys; ValueError if out of range."""
+    return (
+        _bounded_int(config, "maxImageDimension", DEFAULT_MAX_DIMENSION, MAX_DIMENSION_RANGE),
+        _bounded_int(config, "imageQuality", DEFAULT_QUALITY, QUALITY_RANGE),
+    )
+
+
+def process_frame(image_data: str, max_dimension: int, quality: int):
+    """Decode a base64 JPEG frame, hash it and downscale it if needed. Runs on the worker pool.
+
+    Returns (base64_jpeg_to_forward, perceptual_hash, bytes_in, bytes_out),
+    with None instead of the data when the frame is already small enough to
+    forward unchanged. The byte counts are of the decoded JPEGs.
+    """
+    jpeg_bytes = base64.b64decode(image_data)
+    if Image is None:
+        return None, frame_hash(jpeg_bytes), len(jpeg_bytes), len(jpeg_bytes)
+
+    with Image.open(io.BytesIO(jpeg_bytes)) as img:
+        width, height = img.size
+        if not max_dimension or max(width, height) <= max_dimension:
+            # Only the hash is needed, so a reduced-size draft decode is enough
+            img.draft("L", (64, 64))
+            return None, dhash_image(img), len(jpeg_bytes), len(jpeg_bytes)
+
+        scale = max_dimension / max(width, height)
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # Let the JPEG decoder do most of the downscaling, then resample the rest
+        img.draft("RGB", target)
+        resized = img.convert("RGB").resize(target, Image.BILINEAR)
+    digest = dhash_image(resized)
+    out = io.BytesIO()
+    resized.save(out, "JPEG", quality=quality, optimize=False)
+    return base64.b64encode(out.getvalue()).decode("ascii"), digest, len(jpeg_bytes), out.tell()
+
+
+class PreparedFrame:
+    __slots__ = ("data", "digest")
+
+    def __init__(self, data: str, digest):
+        self.data = data # base64 JPEG to forward
+        self.digest = digest # Perceptual hash, or None if the frame could not be decoded
+
+
+async def prepare_frame(image_data: str, max_dimension: int = DEFAULT_MAX_DIMENSION, quality: int = DEFAULT_QUALITY) -> PreparedFrame:
+    """Decode, hash and (if too large) shrink a base64 JPEG frame off the event loop."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        out, digest, bytes_in, bytes_out = await loop.run_in_executor(_get_executor(), process_frame, image_data, max_dimension, quality)
+    except Exception as e:
+        logger.warning("[ImagePipeline] Could not process frame, forwarding it unchanged: %s", e)
+        size = len(image_data) * 3 // 4 # Roughly the decoded size, without decoding on the loop
+        _IMAGE_BYTES_IN.inc(size)
+        _IMAGE_BYTES_OUT.inc(size)
+        return PreparedFrame(image_data, None)
+    IMAGE_PREPARE_SECONDS.observe(loop.time() - started)
+    _IMAGE_BYTES_IN.inc(bytes_in)
+    _IMAGE_BYTES_OUT.inc(bytes_out)
+    return PreparedFrame(image_data if out is None else out, digest)
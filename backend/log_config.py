@@ -0,0 +1,102 @@
+"""Logging setup that keeps formatting and I/O off the event loop.
+
+Records are handed to a ``QueueHandler`` and written by a ``QueueListener``
+running on a background thread, so a slow stdout never blocks the loop.
+Messages use %-style arguments and are formatted on the listener thread,
+unless an argument is mutable. Per-message call sites additionally go through
+a ``RateLimiter`` so that e.g. one audio chunk log every few seconds is
+emitted instead of one per chunk.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+# Log arguments that cannot change between the call and the listener formatting the record
+_IMMUTABLE_ARGS = (str, bytes, int, float, type(None), BaseException)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock ``prepare`` formats the message in the calling thread, which is
+    exactly the work we want off the event loop. The listener lives in the same
+    process, so the record can be passed through as is, unless an argument is
+    mutable (a config dict, say) and could change before the listener formats
+    it; only those messages are rendered in the calling thread.
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if args and (isinstance(args, dict) or not all(isinstance(arg, _IMMUTABLE_ARGS) for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def setup_logging(level=None):
+    """Route all logging through a background listener thread. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    log_queue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RateLimiter:
+    """Per-call-site limiter for hot-path log lines.
+
+    Keep one instance per call site and guard the log call with ``allow()``, so
+    suppressed lines never even build a LogRecord. Call sites on a session's
+    message path get one instance per session, so a noisy session cannot hide
+    another session's lines::
+
+        _audio_log = RateLimiter(interval=5.0)
+        if _audio_log.allow():
+            logger.info("Forwarded audio (%d suppressed)", _audio_log.suppressed)
+    """
+    __slots__ = ("interval", "_next_at", "_suppressed", "suppressed")
+
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self._next_at = 0.0
+        self._suppressed = 0
+        self.suppressed = 0 # Number of lines dropped since the previous allowed one
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if now < self._next_at:
+            self._suppressed += 1
+            return False
+        self._next_at = now + self.interval
+        self.suppressed = self._suppressed
+        self._suppressed = 0
+        return True
@@ -0,0 +1,223 @@
+"""Event loop lag watchdog that names the code holding the loop.
+
+A heartbeat task wakes every LOOP_WATCHDOG_INTERVAL_MS and records how late it
+was woken; the lag distribution is exported as a histogram and as rolling
+quantiles. A sampler thread watches the heartbeat: once the loop has failed to
+come back for LOOP_LAG_THRESHOLD_MS, it grabs the loop thread's current stack
+with sys._current_frames() and the asyncio task that is running. When the
+heartbeat finally runs it charges the stall to that capture.
+
+Stalls are grouped by the innermost backend function on the stack (e.g.
+``MemoryDB.store_memory``) and the backend call path leading to it (e.g.
+``websocket_endpoint.<locals>.receive_from_gemini``), and attributed to the
+session through the task name (``gemini-receiver:<client_id>`` etc.). The
+worst offenders are available from the /admin/loop-lag endpoint.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STDLIB_DIR = os.path.dirname(os.__file__)
+QUANTILES = (0.5, 0.9, 0.99)
+
+LOOP_LAG_DISTRIBUTION = metrics.Histogram(
+    "event_loop_lag_distribution_seconds",
+    "Event loop scheduling lag measured by the watchdog heartbeat.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+LOOP_LAG_QUANTILE = metrics.Gauge(
+    "event_loop_lag_quantile_seconds",
+    "Event loop lag quantiles over the watchdog's recent samples.",
+    labelnames=("quantile",),
+)
+LOOP_STALLS = metrics.Counter(
+    "event_loop_stalls_total",
+    "Heartbeats that came back later than LOOP_LAG_THRESHOLD_MS.",
+)
+
+
+def qualname(frame) -> str:
+    code = frame.f_code
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def is_backend(filename: str) -> bool:
+    return filename.startswith(BACKEND_DIR) and "site-packages" not in filename
+
+
+def short_filename(filename: str) -> str:
+    """Backend files relative to the backend, libraries relative to site-packages or the stdlib."""
+    if is_backend(filename):
+        return os.path.relpath(filename, BACKEND_DIR)
+    if "site-packages" + os.sep in filename:
+        return filename.rsplit("site-packages" + os.sep, 1)[1]
+    if filename.startswith(STDLIB_DIR):
+        return os.path.relpath(filename, STDLIB_DIR)
+    return filename
+
+
+def running_task_name(loop) -> str:
+    """Name of the task the loop is running, read from another thread."""
+    try:
+        task = asyncio.tasks._current_tasks.get(loop)
+    except Exception:
+        return "unknown"
+    return task.get_name() if task is not None else "callback"
+
+
+class Offender:
+    __slots__ = ("site", "path", "count", "total", "worst", "last_task", "last_seen", "stack")
+
+    def __init__(self, site: str, path: str):
+        self.site = site
+        self.path = path
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.last_task = None
+        self.last_seen = None
+        self.stack = []
+
+    def as_dict(self) -> dict:
+        return {
+            "site": self.site,
+            "path": self.path,
+            "stalls": self.count,
+            "total_ms": round(self.total * 1000, 1),
+            "worst_ms": round(self.worst * 1000, 1),
+            "last_task": self.last_task,
+            "last_seen": self.last_seen,
+            "stack": self.stack,
+        }
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05, window: int = 1200, max_offenders: int = 50):
+        self.threshold = threshold # 0 disables stack capture; lag is still measured
+        self.interval = interval
+        self.max_offenders = max_offenders
+        self.stalls = 0
+        self._samples = deque(maxlen=window) # Recent lag samples for the quantiles
+        self._offenders = {} # (site, path) -> Offender
+        self._loop = None
+        self._thread_id = None
+        self._beat = None # monotonic() when the heartbeat last went to sleep
+        self._capture = None # (beat, task name, site, path, stack) taken by the sampler for the current stall
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        for q in QUANTILES:
+            LOOP_LAG_QUANTILE.labels(str(q)).set_function(lambda q=q: self.quantile(q))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            threshold=float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000,
+            interval=float(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "50")) / 1000,
+        )
+
+    def quantile(self, q: float, seconds: float = None) -> float:
+        """Lag quantile over the whole window, or only the heartbeats of the last seconds."""
+        samples = self._samples
+        if seconds is not None:
+            recent = max(1, int(seconds / self.interval))
+            samples = list(samples)[-recent:]
+        samples = sorted(samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    async def run(self):
+        """Heartbeat until cancelled; starts the sampler thread alongside."""
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        if self.threshold:
+            threading.Thread(target=self._sample_loop, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                self._beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - expected)
+                self._samples.append(lag)
+                LOOP_LAG_DISTRIBUTION.observe(lag)
+                if self.threshold and lag >= self.threshold:
+                    self._record_stall(lag)
+        finally:
+            self._stop.set()
+
+    def _sample_loop(self):
+        """Sampler thread: capture the loop thread's stack once per stalled heartbeat."""
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            if beat is None or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            with self._lock:
+                if self._capture is not None and self._capture[0] == beat:
+                    continue # Already captured this stall
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            site, path, stack = self._describe(frame)
+            with self._lock:
+                self._capture = (beat, running_task_name(self._loop), site, path, stack)
+
+    def _describe(self, frame):
+        """(innermost backend function, backend call path, formatted stack) for a frame."""
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse() # Outermost first
+        names = [qualname(f) for f in frames if is_backend(f.f_code.co_filename)]
+        site = names[-1] if names else qualname(frames[-1])
+        path = " > ".join(names[-4:-1]) # The backend callers leading to site
+        stack = [f"{short_filename(f.f_code.co_filename)}:{f.f_lineno} {qualname(f)}" for f in frames[-12:]]
+        return site, path, stack
+
+    def _record_stall(self, lag: float):
+        self.stalls += 1
+        LOOP_STALLS.inc()
+        with self._lock:
+            capture, self._capture = self._capture, None
+        if capture is None:
+            # The loop came back before the sampler looked
+            task, site, path, stack = "unknown", "unknown", "", []
+        else:
+            _, task, site, path, stack = capture
+        key = (site, path)
+        offender = self._offenders.get(key)
+        if offender is None:
+            if len(self._offenders) >= self.max_offenders:
+                # Make room by forgetting the offender with the least total stall time
+                del self._offenders[min(self._offenders, key=lambda k: self._offenders[k].total)]
+            offender = self._offenders[key] = Offender(site, path)
+        offender.count += 1
+        offender.total += lag
+        offender.worst = max(offender.worst, lag)
+        offender.last_task = task
+        offender.last_seen = time.time()
+        if stack:
+            offender.stack = stack
+        logger.warning("[LoopWatchdog] Event loop blocked for %.0f ms in %s (%s, task %s)", lag * 1000, site, path or "-", task)
+
+    def report(self, limit: int = 20) -> dict:
+        offenders = sorted(self._offenders.values(), key=lambda o: o.total, reverse=True)[:limit]
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "samples": len(self._samples),
+            "lag_ms": {f"p{int(q * 100)}": round(self.quantile(q) * 1000, 2) for q in QUANTILES} |
+                      {"max": round(max(self._samples, default=0.0) * 1000, 2)},
+            "stalls": self.stalls,
+            "offenders": [o.as_dict() for o in offenders],
+        }
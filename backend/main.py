@@ -1,29 +1,83 @@
 import logging
-from fastapi import FastAPI, WebSocket, HTTPException, Depends, status, Request, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, HTTPException, Depends, status, Request, Response, WebSocketDisconnect
 from starlette.websockets import WebSocketState # Added import
+from starlette.requests import HTTPConnection
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from security import get_current_user_websocket, create_access_token, authenticate_user, get_password_hash, ACCESS_TOKEN_EXPIRE_MINUTES
-from jose import JWTError, jwt
-from security import SECRET_KEY, ALGORITHM
+from fastapi.security import OAuth2PasswordRequestForm
+from security import get_current_user_websocket, get_current_username, get_admin_username, create_access_token, authenticate_user, login_slot, ACCESS_TOKEN_EXPIRE_MINUTES
+import security
 from typing import Annotated
 import asyncio
+import base64
+import functools
 import json
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from websockets import connect, exceptions as ws_exceptions # Added exceptions import
 from websockets.connection import State
 from typing import Dict
+from contextlib import asynccontextmanager
 from db import MemoryDB
+from admission import AdmissionController, AdmissionRejected, ConnectBackoff, CLOSE_POLICY_VIOLATION
+from resumption import SessionParking
+from vision import VisionIngest
+import image_pipeline
+from recording import SessionRecorder
+from egress import ClientEgress
+from idle_reaper import IdleReaper, IDLE_REVIVED
+from loop_watchdog import LoopWatchdog
+import profiler
+from session_stats import SessionStats, current_stats
+import setup_payload
+from setup_payload import memory_context_cache
+from memory_working_set import MemoryWorkingSet
+import conditional_get
+from memory_feed import MemoryFeed
+import memory_batch
+import resampler
+from log_config import setup_logging, RateLimiter
+import metrics
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging (records are formatted and written on a background listener thread)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Grace period during which a disconnected client can reattach to its upstream session
+session_parking = SessionParking.from_env()
+# Closes the upstream of sessions that have had no audio/image traffic for a while
+idle_reaper = IdleReaper.from_env()
+# Measures event loop lag and captures the stack of whatever is blocking it
+loop_watchdog = LoopWatchdog.from_env()
+# Session caps, upstream connect queue and load shedding on the watchdog's lag (configured via environment variables)
+admission = AdmissionController.from_env(watchdog=loop_watchdog)
+# Pushes memory changes to the sessions and /ws/memories channels of the user they belong to
+memory_feed = MemoryFeed.from_env()
+MemoryDB.add_change_listener(memory_feed.publish)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One storage service for the whole process; sessions and routes get it injected
+    app.state.memory_db = MemoryDB()
+    await asyncio.to_thread(app.state.memory_db.open)
+    background_tasks = [
+        asyncio.create_task(admission.maintain_registry(), name="admission-registry"),
+        asyncio.create_task(idle_reaper.run(connections), name="idle-reaper"),
+        asyncio.create_task(loop_watchdog.run(), name="loop-watchdog"),
+    ]
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await session_parking.close_all()
+    image_pipeline.shutdown()
+    security.shutdown()
+    app.state.memory_db.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -32,162 +86,123 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Version"],
 )
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+def get_memory_db(connection: HTTPConnection) -> MemoryDB:
+    """The shared MemoryDB opened by the lifespan handler"""
+    return connection.app.state.memory_db
 
-# Add user model
-class User:
-    def __init__(self, username: str, hashed_password: str):
-        self.username = username
-        self.hashed_password = hashed_password
+MemoryDBDep = Annotated[MemoryDB, Depends(get_memory_db)]
+# Username behind the request's bearer token; 401 without a valid one
+CurrentUser = Annotated[str, Depends(get_current_username)]
+# Same, but 403 unless the user is listed in ADMIN_USERS
+AdminUser = Annotated[str, Depends(get_admin_username)]
 
-# Temporary in-memory user database (replace with real DB in production)
-fake_users_db = {
-    "admin": User(
-        username="admin",
-        hashed_password=get_password_hash("admin")
-    )
-}
+GEMINI_WS_URI = os.environ.get(
+    "GEMINI_WS_URI",
+    "wss://generativelanguage.googleapis.com/ws/"
+    "google.ai.generativelanguage.v1alpha.GenerativeService.BidiGenerateContent"
+)
 
 class GeminiConnection:
-    def __init__(self):
+    def __init__(self, memory_db: MemoryDB):
         self.api_key = os.environ.get("GEMINI_API_KEY")
         self.model = "gemini-2.0-flash-exp"
-        self.uri = (
-            "wss://generativelanguage.googleapis.com/ws/"
-            "google.ai.generativelanguage.v1alpha.GenerativeService.BidiGenerateContent"
-            f"?key={self.api_key}"
-        )
+        # GEMINI_WS_URI points the backend at another BidiGenerateContent endpoint, e.g. bench/mock_gemini.py
+        self.uri = f"{GEMINI_WS_URI}?key={self.api_key}"
         self.ws = None
         self.config = None
-        self.interrupted = False
-        self.memory_db = MemoryDB()
+        self.memory_db = memory_db # Shared storage service, not owned by the session
         self.username = None # Added to store username
-        self.interrupt_sent = False # Flag to track if interrupt was sent to Gemini API
+        self.last_user_audio_at = None # perf_counter() of the last audio chunk forwarded to Gemini
+        self.awaiting_first_audio = True # True until the first model audio chunk of a turn is seen
+        self.recorder = None # SessionRecorder when RECORD_DIR is set
+        self.setup_timings = {} # Seconds per phase of the last connect()
+        self.resampler = None # Converts client audio to 16 kHz when it declares another inputSampleRate
+        self.last_activity = time.monotonic() # Last media sent upstream or message received, for the idle reaper
+        self.reaped = False # True while the idle reaper has closed the upstream
+        self.stats = SessionStats() # Per-session counters for /admin/sessions
+        self.working_set = None # The user's newest memories, loaded at connect, for memory tool calls
+        self.connect_backoff = ConnectBackoff.from_env() # Delays upstream connect attempts after failures
+        self.closed_send_log = RateLimiter(interval=5.0) # Audio sent while the upstream is closed
 
     async def connect(self):
         """Initialize connection to Gemini"""
+        if not self.config:
+            logger.error(f"[GeminiConnection-{self.username}] Configuration must be set before connecting.")
+            raise ValueError("Configuration must be set before connecting")
+
         logger.info(f"[GeminiConnection-{self.username}] Attempting to connect to Gemini at {self.uri}")
+        connect_started = time.perf_counter()
+        timings = {}
+        self.last_activity = time.monotonic()
+
+        working_set = MemoryWorkingSet.from_env(self.memory_db, self.username)
+
+        def load_memories():
+            context = memory_context_cache.get(self.memory_db, self.username)
+            try:
+                working_set.load()
+            except Exception as e:
+                # Tool calls fall back to the DB until the set loads
+                logger.error(f"[GeminiConnection-{self.username}] Error loading memory working set: {e}")
+            return context
+
+        async def load_memory_context():
+            # Runs in a worker thread alongside the TLS/WebSocket handshake
+            started = time.perf_counter()
+            try:
+                return await asyncio.to_thread(load_memories)
+            except Exception as e:
+                logger.error(f"[GeminiConnection-{self.username}] Error fetching memories: {e}")
+                return "Could not retrieve memories."
+            finally:
+                timings["memory"] = time.perf_counter() - started
+
+        memory_task = asyncio.create_task(load_memory_context(), name=f"memory-context:{self.username}")
         try:
             self.ws = await connect(self.uri, additional_headers={"Content-Type": "application/json"})
+            timings["handshake"] = time.perf_counter() - connect_started
             logger.info(f"[GeminiConnection-{self.username}] WebSocket connection established.")
         except Exception as e:
+            memory_task.cancel()
             logger.error(f"[GeminiConnection-{self.username}] Failed to connect to Gemini: {e}")
             raise
 
-        if not self.config:
-            logger.error(f"[GeminiConnection-{self.username}] Configuration must be set before connecting.")
-            raise ValueError("Configuration must be set before connecting")
-
-        logger.info(f"[GeminiConnection-{self.username}] Fetching memories for system prompt.")
-        # Get all memories and format them into the system prompt
-        try:
-            memories = self.memory_db.get_all_memories(self.username)
-            memory_context = "\n".join([f"- {memory[1]}" for memory in memories]) # Assuming memory content is at index 1
-        except Exception as e:
-            logger.error(f"[GeminiConnection-{self.username}] Error fetching memories: {e}")
-            memory_context = "Could not retrieve memories."
-
-        # Send initial setup message with configuration
-        logger.info(f"[GeminiConnection-{self.username}] Sending setup message.")
-        setup_message = {
-            "setup": {
-                "model": f"models/{self.model}",
-                "generation_config": {
-                    "response_modalities": ["AUDIO"],
-                    "speech_config": {
-                        "voice_config": {
-                            "prebuilt_voice_config": {
-                                "voice_name": self.config["voice"]
-                            }
-                        }
-                    }
-                },
-                "tools": [
-                    { "googleSearch": {} },
-                    {
-                        "function_declarations": [
-                            {
-                                "name": "store_memory",
-                                "description": "Stores a memory in the database using MemoryDB.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "client_id": { "type": "string" },
-                                        "content": { "type": "string" },
-                                        "context": { "type": "string" },
-                                        "tags": { "type": "array", "items": { "type": "string" } },
-                                        "type": { "type": "string" }
-                                    }
-                                }
-                            },
-                            {
-                                "name": "get_recent_memories",
-                                "description": "Retrieves recent memories from the database.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "client_id": { "type": "string" },
-                                        "limit": { "type": "integer" }
-                                    }
-                                }
-                            },
-                            {
-                                "name": "search_memories",
-                                "description": "Searches memories based on query.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "client_id": { "type": "string" },
-                                        "query": { "type": "string" },
-                                        "limit": { "type": "integer" }
-                                    }
-                                }
-                            },
-                            {
-                                "name": "delete_memory",
-                                "description": "Deletes a specific memory by its ID.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "memory_id": { "type": "integer" }
-                                    }
-                                }
-                            },
-                            {
-                                "name": "update_memory",
-                                "description": "Updates the content of a specific memory.",
-                                "parameters": {
-                                    "type": "object",
-                                    "properties": {
-                                        "memory_id": { "type": "integer" },
-                                        "new_content": { "type": "string" }
-                                    }
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "system_instruction": {
-                    "parts": [
-                        {
-                            "text": self.config["systemPrompt"] +
-                            "\n\nHere are recent memories:\n" + memory_context +
-                            "\n\nYou can also use the memory functions store_memory, get_recent_memories, and search_memories."
-                            "\n\nUse the memory function often."
-                        }
-                    ]
-                }
-            }
-        }
         try:
-            await self.ws.send(json.dumps(setup_message))
+            waited = time.perf_counter()
+            memory_context = await memory_task
+            self.working_set = working_set
+            timings["memory_wait"] = time.perf_counter() - waited # Part of the fetch the handshake did not hide
+
+            # Send initial setup message with configuration; the static tools section is pre-serialized
+            logger.info(f"[GeminiConnection-{self.username}] Sending setup message.")
+            started = time.perf_counter()
+            await self._send_raw(setup_payload.build_setup_message(
+                self.model, self.config["voice"], self.config["systemPrompt"], memory_context
+            ))
+            timings["setup_send"] = time.perf_counter() - started
 
             # Wait for setup completion
             logger.info(f"[GeminiConnection-{self.username}] Waiting for setup response.")
+            started = time.perf_counter()
             setup_response = await self.ws.recv()
-            logger.info(f"[GeminiConnection-{self.username}] Received setup response: {setup_response[:100]}...") # Log truncated response
+            timings["setup_ack"] = time.perf_counter() - started
+            if self.recorder is not None:
+                self.recorder.upstream(setup_response)
+            metrics.SESSION_SETUP_SECONDS.observe(time.perf_counter() - connect_started)
+            for phase, seconds in timings.items():
+                metrics.SESSION_SETUP_PHASE_SECONDS.labels(phase).observe(seconds)
+            self.setup_timings = timings
+            metrics.UPSTREAM_IN_BYTES.inc(len(setup_response))
+            metrics.UPSTREAM_IN_MESSAGES.inc()
+            self.stats.upstream_in_bytes += len(setup_response)
+            self.stats.upstream_in_messages += 1
+            self.stats.upstream_connects += 1
+            logger.info("[GeminiConnection-%s] Setup took %.0f ms (%s)", self.username, (time.perf_counter() - connect_started) * 1000,
+                        ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in timings.items()))
+            logger.info("[GeminiConnection-%s] Received setup response: %.100s...", self.username, setup_response) # Log truncated response
             return setup_response
         except Exception as e:
             logger.error(f"[GeminiConnection-{self.username}] Error during setup communication: {e}")
@@ -204,16 +219,56 @@ class GeminiConnection:
         if "systemPrompt" in config:
             config["systemPrompt"] = config["systemPrompt"]
 
+        input_rate = resampler.validate_rate(config.get("inputSampleRate")) # Callers check it first; see invalid_config
         self.config = config
-        logger.info(f"[GeminiConnection-{self.username}] Config set: {self.config}")
+        if input_rate != (self.resampler.in_rate if self.resampler else resampler.TARGET_RATE):
+            self.resampler = resampler.for_rate(input_rate)
+        # The full config includes the (potentially very long) system prompt, so only log it at DEBUG
+        logger.info("[GeminiConnection-%s] Config set (voice=%s, keys=%s)", self.username, config.get("voice"), sorted(config))
+        logger.debug("[GeminiConnection-%s] Full config: %s", self.username, config)
+
+    async def _send(self, payload: dict):
+        """Serialize and send a message to Gemini, counting it in the upstream metrics"""
+        await self._send_raw(json.dumps(payload))
+
+    async def _send_raw(self, message: str):
+        """Send an already serialized message to Gemini"""
+        await self.ws.send(message)
+        self.last_activity = time.monotonic()
+        metrics.UPSTREAM_OUT_BYTES.inc(len(message))
+        metrics.UPSTREAM_OUT_MESSAGES.inc()
+        self.stats.upstream_out_bytes += len(message)
+        self.stats.upstream_out_messages += 1
+
+    def is_open(self) -> bool:
+        """Whether the upstream websocket is connected and usable"""
+        return self.ws is not None and self.ws.state == State.OPEN
+
+    @property
+    def model_speaking(self) -> bool:
+        """True between the first model audio chunk of a turn and its end"""
+        return not self.awaiting_first_audio
+
+    def upstream_backlog(self) -> int:
+        """Bytes queued on the upstream socket that the OS has not accepted yet"""
+        transport = getattr(self.ws, "transport", None)
+        return transport.get_write_buffer_size() if transport is not None else 0
 
     async def send_audio(self, audio_data: str):
         """Send audio data to Gemini"""
         # Check Gemini connection state correctly
         if not self.ws or self.ws.state == State.CLOSED:
-            logger.warning(f"[GeminiConnection-{self.username}] Attempted to send audio while WebSocket is closed or None.")
+            if self.closed_send_log.allow():
+                logger.warning("[GeminiConnection-%s] Attempted to send audio while WebSocket is closed or None (%d similar lines suppressed).", self.username, self.closed_send_log.suppressed)
             return
 
+        if self.resampler is not None:
+            pcm = self.resampler.process(base64.b64decode(audio_data))
+            pcm_bytes = len(pcm)
+            audio_data = base64.b64encode(pcm).decode("ascii")
+        else:
+            pcm_bytes = len(audio_data) * 3 // 4 - audio_data[-2:].count("=") # Decoded size, without decoding
+
         realtime_input_msg = {
             "realtime_input": {
                 "media_chunks": [
@@ -225,7 +280,8 @@ class GeminiConnection:
         }
         }
         try:
-            await self.ws.send(json.dumps(realtime_input_msg))
+            await self._send(realtime_input_msg)
+            self.stats.audio_bytes_forwarded += pcm_bytes
         except Exception as e:
             logger.error(f"[GeminiConnection-{self.username}] Error sending audio data: {e}")
             await self.close()
@@ -237,10 +293,6 @@ class GeminiConnection:
             logger.warning(f"[GeminiConnection-{self.username}] Attempted to send interrupt while WebSocket is closed or None.")
             return False
 
-        # Set the interrupted flag immediately to stop sending audio
-        self.interrupted = True
-        self.interrupt_sent = True
-
         # Send the interrupt message to Gemini
         interrupt_msg = {
             "realtime_input": {
@@ -250,7 +302,7 @@ class GeminiConnection:
 
         try:
             logger.info(f"[GeminiConnection-{self.username}] Sending interrupt signal to Gemini API.")
-            await self.ws.send(json.dumps(interrupt_msg))
+            await self._send(interrupt_msg)
             logger.info(f"[GeminiConnection-{self.username}] Interrupt signal sent successfully.")
             return True
         except Exception as e:
@@ -267,25 +319,37 @@ class GeminiConnection:
 
         try:
             message = await self.ws.recv()
+            self.last_activity = time.monotonic()
+            if self.recorder is not None:
+                self.recorder.upstream(message)
+            metrics.UPSTREAM_IN_BYTES.inc(len(message))
+            metrics.UPSTREAM_IN_MESSAGES.inc()
+            self.stats.upstream_in_bytes += len(message)
+            self.stats.upstream_in_messages += 1
             return message
         except Exception as e:
-            logger.error(f"[GeminiConnection-{self.username}] Error receiving message from Gemini: {e}")
+            if self.reaped:
+                logger.info(f"[GeminiConnection-{self.username}] Upstream closed by the idle reaper.")
+            else:
+                logger.error(f"[GeminiConnection-{self.username}] Error receiving message from Gemini: {e}")
             await self.close() # Ensure connection is closed on error
             raise # Re-raise the exception
 
     async def close(self):
         """Close the connection"""
         # Use self.ws.state to check connection status correctly
-        if self.ws and self.ws.state != State.CLOSED:
+        ws = self.ws
+        if ws and ws.state != State.CLOSED:
             logger.info(f"[GeminiConnection-{self.username}] Closing Gemini websocket connection.")
             try:
                 # Add a timeout to close to prevent hanging
-                await asyncio.wait_for(self.ws.close(), timeout=5.0)
+                await asyncio.wait_for(ws.close(), timeout=5.0)
                 logger.info(f"[GeminiConnection-{self.username}] Gemini websocket connection closed.")
             except Exception as e:
                 logger.error(f"[GeminiConnection-{self.username}] Error closing Gemini websocket: {e}")
             finally:
-                self.ws = None
+                if self.ws is ws: # A reconnect may have replaced it while we waited
+                    self.ws = None
         elif self.ws and self.ws.state == State.CLOSED: # Check state correctly here too
              logger.info(f"[GeminiConnection-{self.username}] Gemini websocket connection already closed.")
              self.ws = None
@@ -295,13 +359,15 @@ class GeminiConnection:
 
     async def handle_tool_call(self, tool_call):
         responses = []
-        logger.info(f"[GeminiConnection-{self.username}] Handling tool call: {tool_call}")
+        logger.info("[GeminiConnection-%s] Handling tool call with %d function call(s)", self.username, len(tool_call.get("functionCalls", [])))
         for f in tool_call.get("functionCalls", []):
-            logger.info(f"[GeminiConnection-{self.username}]   <- Function call: {f}")
+            logger.debug("[GeminiConnection-%s]   <- Function call: %s", self.username, f)
             func_name = f.get("name")
             args = f.get("args", {})
+            self.stats.tool_calls += 1
             response_text = "Tool call processed." # Default response text
             result = None
+            tool_started = time.perf_counter()
             try:
                 if func_name == "store_memory":
                     result = self.memory_db.store_memory(
@@ -314,23 +380,17 @@ class GeminiConnection:
                     response_text = f"Stored memory: {args.get('content', '')[:50]}..."
                     logger.info(f"[GeminiConnection-{self.username}] Stored memory via tool call.")
                 elif func_name == "get_recent_memories":
-                    result = self.memory_db.get_recent_memories(
-                        self.username,
-                        args.get("limit", 5)
-                    )
+                    # Answered from the session's working set, falling back to the DB
+                    result = await self.working_set.recent(args.get("limit", 5))
                     response_text = f"Here are your recent memories:\n"
                     for i, memory in enumerate(result or [], 1):
-                        response_text += f"{i}. {memory[1][:100]}...\n" # Assuming content at index 1
+                        response_text += f"{i}. {memory[0][:100]}...\n" # Rows are (content, timestamp)
                     logger.info(f"[GeminiConnection-{self.username}] Retrieved recent memories via tool call.")
                 elif func_name == "search_memories":
-                    result = self.memory_db.search_memories(
-                        self.username,
-                        args.get("query", ""),
-                        args.get("limit", 5)
-                    )
+                    result = await self.working_set.search(args.get("query", ""), args.get("limit", 5))
                     response_text = f"Found {len(result or [])} memories matching '{args.get('query', '')}':\n"
                     for i, memory in enumerate(result or [], 1):
-                        response_text += f"{i}. {memory[1][:100]}...\n" # Assuming content at index 1
+                        response_text += f"{i}. {memory[0][:100]}...\n" # Rows are (content, timestamp)
                     logger.info(f"[GeminiConnection-{self.username}] Searched memories via tool call.")
                 elif func_name == "delete_memory":
                     memory_id = args.get("memory_id")
@@ -346,6 +406,17 @@ class GeminiConnection:
                     )
                     response_text = f"Successfully updated memory ID {memory_id}"
                     logger.info(f"[GeminiConnection-{self.username}] Updated memory {memory_id} via tool call.")
+                elif func_name == "batch_memories":
+                    updates = args.get("updates")
+                    if isinstance(updates, list):
+                        updates = [{"id": u.get("memory_id"), "content": u.get("new_content")} for u in updates if isinstance(u, dict)]
+                    # Batches can be large, so they run off the event loop
+                    result = await asyncio.to_thread(
+                        memory_batch.run, self.memory_db, self.username, args.get("operation"),
+                        ids=args.get("memory_ids"), updates=updates, new_type=args.get("type")
+                    )
+                    response_text = memory_batch.summary(result)
+                    logger.info(f"[GeminiConnection-{self.username}] Batch {result['op']} of {len(result['results'])} memories via tool call.")
                 else:
                     result = {"error": f"Unknown function {func_name}"}
                     response_text = f"Sorry, I don't know how to handle the function '{func_name}'."
@@ -356,6 +427,7 @@ class GeminiConnection:
                 result = {"error": f"Error executing function {func_name}: {str(e)}"}
                 response_text = f"Sorry, there was an error trying to execute the function '{func_name}'."
             # This runs after the try-except block for the current function call 'f'
+            metrics.TOOL_CALL_SECONDS.labels(str(func_name)).observe(time.perf_counter() - tool_started)
 
             responses.append({
                 "id": f.get("id"),
@@ -369,7 +441,7 @@ class GeminiConnection:
             # Send a verbal response about the tool call result
             logger.info(f"[GeminiConnection-{self.username}] Sending verbal response for tool call {func_name}.")
             try:
-                await self.ws.send(json.dumps({
+                await self._send({
                     "clientContent": {
                         "turns": [{
                             "parts": [{"text": response_text}],
@@ -377,7 +449,7 @@ class GeminiConnection:
                         }],
                         "turnComplete": True
                     }
-                }))
+                })
             except Exception as e:
                  logger.error(f"[GeminiConnection-{self.username}] Error sending tool call verbal response: {e}")
                  await self.close()
@@ -389,9 +461,9 @@ class GeminiConnection:
                 "functionResponses": responses
             }
         }
-        logger.info(f"[GeminiConnection-{self.username}] Sending tool response: {tool_response}")
+        logger.debug("[GeminiConnection-%s] Sending tool response: %s", self.username, tool_response)
         try:
-            await self.ws.send(json.dumps(tool_response))
+            await self._send(tool_response)
         except Exception as e:
             logger.error(f"[GeminiConnection-{self.username}] Error sending tool response: {e}")
             await self.close()
@@ -415,41 +487,115 @@ class GeminiConnection:
             }
         }
         try:
-            await self.ws.send(json.dumps(image_message))
+            await self._send(image_message)
+            self.stats.images_forwarded += 1
         except Exception as e:
             logger.error(f"[GeminiConnection-{self.username}] Error sending image data: {e}")
             await self.close()
 
 
-# Helper function to get username from token
-def get_username_from_token(token: str) -> str:
-    """Extract username from JWT token"""
+def invalid_config(config, audio_codecs=None) -> str:
+    """Why a client config (and the audio_codecs sent with it) cannot be used, or None. Checked before it is applied or saved."""
+    if not isinstance(config, dict):
+        return "config must be an object"
+    if audio_codecs is not None and not (isinstance(audio_codecs, list) and all(isinstance(c, str) for c in audio_codecs)):
+        return "audio_codecs must be a list of codec names"
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid authentication credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return username
-    except JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        resampler.validate_rate(config.get("inputSampleRate"))
+        image_pipeline.frame_options(config)
+    except ValueError as e:
+        return str(e)
+    return None
+
+async def send_client_json(websocket: WebSocket, payload: dict) -> int:
+    """Send a JSON message to the browser, counting it in the client metrics. Returns its size."""
+    message = json.dumps(payload, separators=(",", ":"))
+    await websocket.send_text(message)
+    metrics.CLIENT_OUT_BYTES.inc(len(message))
+    metrics.CLIENT_OUT_MESSAGES.inc()
+    return len(message)
+
+async def reject_session(websocket: WebSocket, rejected: AdmissionRejected):
+    """Tell the client why it was not admitted and when to retry, then close the socket"""
+    try:
+        await send_client_json(websocket, {
+            "type": "error",
+            "message": rejected.reason,
+            "retry_after": rejected.retry_after
+        })
+        await websocket.close(code=rejected.code, reason=rejected.close_reason())
+    except Exception as close_err:
+        logger.warning(f"Error closing rejected websocket: {close_err}")
+
+async def admit_session(client_id: str, username: str) -> bool:
+    """Admit a session or raise AdmissionRejected.
+
+    A user at their cap takes over the admission slot of one of their parked
+    sessions; returns True if that happened, and the caller must then call
+    session_parking.close_lent unless the new session resumed it.
+    """
+    try:
+        await admission.admit(client_id, username)
+        return False
+    except AdmissionRejected as rejected:
+        if rejected.code != CLOSE_POLICY_VIOLATION or not await session_parking.lend_slot(username):
+            raise
+    try:
+        await admission.admit(client_id, username)
+    except AdmissionRejected:
+        await session_parking.close_lent(username)
+        raise
+    return True
 
 # Store active connections
 connections: Dict[str, GeminiConnection] = {}
-memory_db = MemoryDB()
+metrics.ACTIVE_CONNECTIONS.set_function(lambda: len(connections))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Expose metrics in the Prometheus text format"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/admin/loop-lag")
+async def get_loop_lag(admin: AdminUser, limit: int = 20):
+    """Event loop lag percentiles and the code paths that blocked the loop the longest"""
+    return loop_watchdog.report(limit)
+
+@app.get("/admin/sessions")
+async def list_sessions(admin: AdminUser, sort: str = "total_bytes", limit: int = 100):
+    """Live sessions with their resource counters, most expensive first by the chosen counter"""
+    if sort not in SessionStats.sort_keys():
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(SessionStats.sort_keys())}")
+    sessions = [
+        {"client_id": client_id, "username": gemini.username, "upstream_open": gemini.is_open(), "reaped": gemini.reaped, **gemini.stats.as_dict()}
+        for client_id, gemini in list(connections.items())
+    ]
+    sessions.sort(key=lambda session: session[sort], reverse=True)
+    return {"count": len(sessions), "sort": sort, "sessions": sessions[:limit]}
+
+@app.post("/admin/profile")
+async def take_profile(admin: AdminUser, seconds: float = 10.0, client_id: str = None, interval_ms: float = 5.0):
+    """Sample the process, or one session in connections, and return collapsed stacks for a flame graph"""
+    if client_id is not None and client_id not in connections:
+        raise HTTPException(status_code=404, detail="No such session")
+    logger.info(f"Profile requested by {admin} for {client_id or 'the process'} ({seconds}s)")
+    try:
+        collapsed = await asyncio.to_thread(
+            profiler.profile, asyncio.get_running_loop(), threading.get_ident(), seconds, client_id, max(interval_ms, 1.0) / 1000
+        )
+    except profiler.ProfileBusy as busy:
+        raise HTTPException(status_code=409, detail=str(busy))
+    filename = f"profile-{(client_id or 'process').replace(':', '_')}-{int(time.time())}.collapsed"
+    return Response(content=collapsed, media_type="text/plain", headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.post("/token")
 async def login_for_access_token(
-    form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    memory_db: MemoryDBDep
 ):
-    user = authenticate_user(fake_users_db, form_data.username, form_data.password)
+    # Users come from the users table; bcrypt runs on the password pool, with a cap on logins in flight
+    async with login_slot():
+        user = await authenticate_user(memory_db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -462,10 +608,12 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, memory_db: MemoryDBDep):
     client_host = websocket.client.host
     client_port = websocket.client.port
     client_id = f"{client_host}:{client_port}"
+    # Task names carry the session, so the loop watchdog can attribute stalls to it
+    asyncio.current_task().set_name(f"ws:{client_id}")
     logger.info(f"[WebSocket-{client_id}] Connection attempt.")
 
     await websocket.accept()
@@ -473,7 +621,16 @@ async def websocket_endpoint(websocket: WebSocket):
 
     username = None
     gemini = None
+    gemini_receive_task = None # Task handle for the Gemini receiver
     closed_intentionally = False # Flag to prevent double closing
+    admitted = False # Only release admission slots this session actually holds
+    took_parked_slot = False # Admitted on the slot of a parked session, which is closed unless resumed
+    resume_token = None # Token the client can use to reattach to the upstream session
+    client_close_code = None # Close code sent by the client, if it disconnected
+    recorder = None # Writes the session to RECORD_DIR for replay benchmarks
+    egress_task = None # Task writing the egress queue to the client
+    memory_subscription = None # Memory change feed, if the client asked for it
+    memory_feed_task = None # Task moving memory changes into the egress queue
     try:
         # Require authentication for WebSocket
         logger.info(f"[WebSocket-{client_id}] Attempting authentication.")
@@ -485,8 +642,20 @@ async def websocket_endpoint(websocket: WebSocket):
             return # Exit the try block
         logger.info(f"[WebSocket-{client_id}] Authenticated as user: {username}")
 
-        gemini = GeminiConnection()
+        try:
+            took_parked_slot = await admit_session(client_id, username)
+        except AdmissionRejected as rejected:
+            logger.warning(f"[WebSocket-{client_id}] Session for {username} rejected: {rejected.reason}")
+            await reject_session(websocket, rejected)
+            closed_intentionally = True
+            return
+        admitted = True
+
+        recorder = SessionRecorder.for_session(username, client_id)
+        gemini = GeminiConnection(memory_db)
         gemini.username = username # Pass username to GeminiConnection
+        current_stats.set(gemini.stats) # Tasks started from here on charge their DB time to this session
+        gemini.recorder = recorder
         connections[client_id] = gemini # Use client_id as key
         logger.info(f"[WebSocket-{client_id}] GeminiConnection created and stored for user {username}.")
 
@@ -494,15 +663,21 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.info(f"[WebSocket-{client_id}] Attempting to load saved config for user {username}.")
         saved_config = memory_db.get_user_config(username)
         if saved_config:
-            logger.info(f"[WebSocket-{client_id}] Loaded saved config for user {username}: {saved_config}")
+            logger.info("[WebSocket-%s] Loaded saved config for user %s.", client_id, username)
+            logger.debug("[WebSocket-%s] Saved config: %s", client_id, saved_config)
         else:
             logger.info(f"[WebSocket-{client_id}] No saved config found for user {username}.")
 
 
         # Wait for initial configuration
         logger.info(f"[WebSocket-{client_id}] Waiting for initial configuration message.")
-        config_data = await websocket.receive_json()
-        logger.info(f"[WebSocket-{client_id}] Received initial message: {config_data}")
+        config_text = await websocket.receive_text()
+        if recorder is not None:
+            recorder.client(config_text)
+        gemini.stats.client_in_bytes += len(config_text)
+        gemini.stats.client_in_messages += 1
+        config_data = json.loads(config_text)
+        logger.debug("[WebSocket-%s] Received initial message: %s", client_id, config_data)
 
         if config_data.get("type") != "config":
             logger.error(f"[WebSocket-{client_id}] First message was not configuration type. Closing.")
@@ -511,7 +686,14 @@ async def websocket_endpoint(websocket: WebSocket):
 
         # Set the configuration and update it in the DB
         const_config = config_data.get("config", {})
-        logger.info(f"[WebSocket-{client_id}] Processing initial config: {const_config}")
+        logger.debug("[WebSocket-%s] Processing initial config: %s", client_id, const_config)
+        problem = invalid_config(const_config, config_data.get("audio_codecs"))
+        if problem:
+            logger.warning(f"[WebSocket-{client_id}] Rejecting initial config: {problem}")
+            await send_client_json(websocket, {"type": "error", "message": problem})
+            await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA, reason="Invalid configuration")
+            closed_intentionally = True
+            return
 
         # Ensure all required config fields are present
         default_config = {
@@ -528,17 +710,85 @@ async def websocket_endpoint(websocket: WebSocket):
         for key, value in default_config.items():
             if key not in const_config:
                 const_config[key] = value
-        gemini.set_config(const_config)
-        memory_db.update_user_config(username, const_config) # Save initial config
-
-        logger.info(f"[WebSocket-{client_id}] Initial config set and saved for user {username}.")
-
-        # Initialize Gemini connection
-        logger.info(f"[WebSocket-{client_id}] Initializing Gemini connection.")
-        await gemini.connect()
-        logger.info(f"[WebSocket-{client_id}] Gemini connection initialized successfully.")
 
-        gemini_receive_task = None # Task handle for the Gemini receiver
+        # Reattach to a parked upstream session if the client is resuming one
+        parked = None
+        if config_data.get("resume_token"):
+            parked = await session_parking.resume(config_data["resume_token"], username)
+            if parked and parked.gemini.config != const_config:
+                # The config changed while detached, so the upstream has to be set up again
+                logger.info(f"[WebSocket-{client_id}] Config changed since the session was parked, not resuming.")
+                await parked.gemini.close()
+                parked = None
+        if took_parked_slot:
+            await session_parking.close_lent(username) # Anything still parked was not resumed and holds no slot
+            took_parked_slot = False
+
+        if parked:
+            gemini = parked.gemini
+            gemini.recorder = recorder
+            connections[client_id] = gemini
+            current_stats.set(gemini.stats)
+            logger.info(f"[WebSocket-{client_id}] Resumed parked Gemini session for user {username}.")
+        else:
+            gemini.set_config(const_config)
+            memory_db.update_user_config(username, const_config) # Save initial config
+
+            logger.info(f"[WebSocket-{client_id}] Initial config set and saved for user {username}.")
+
+            # Initialize Gemini connection
+            logger.info(f"[WebSocket-{client_id}] Initializing Gemini connection.")
+            await admission.connect_upstream(gemini.connect, username, gemini.connect_backoff)
+            logger.info(f"[WebSocket-{client_id}] Gemini connection initialized successfully.")
+
+        if session_parking.enabled:
+            resume_token = session_parking.issue_token()
+            await send_client_json(websocket, {
+                "type": "session",
+                "resume_token": resume_token,
+                "resume_window": session_parking.grace_seconds,
+                "resumed": parked is not None
+            })
+        # Messages forwarded from Gemini are queued per session so interrupts can purge them
+        async def send_to_client(payload: dict):
+            size = await send_client_json(websocket, payload)
+            gemini.stats.client_out_bytes += size
+            gemini.stats.client_out_messages += 1
+
+        egress = ClientEgress.from_env(send_to_client)
+        egress_task = asyncio.create_task(egress.run(), name=f"client-egress:{client_id}")
+        if "audio_codecs" in config_data:
+            codec = await egress.set_codec(config_data["audio_codecs"])
+            logger.info(f"[WebSocket-{client_id}] Model audio encoding: {codec}")
+        if config_data.get("memory_feed"):
+            memory_subscription = memory_feed.subscribe(username)
+            memory_feed_task = asyncio.create_task(memory_feed.pump(memory_subscription, egress.put), name=f"memory-feed:{client_id}")
+        if parked:
+            # Replay what the model produced while the client was away
+            for buffered_message in parked.buffered:
+                if buffered_message["type"] == "turn_complete":
+                    egress.end_turn()
+                    await egress.put(buffered_message)
+                else:
+                    await egress.audio(buffered_message["type"], buffered_message["data"])
+
+        vision = VisionIngest.from_env() # Per-session frame dedupe and rate control
+        # Rate limiters for this session's per-message log lines, one per call site
+        skipped_part_log = RateLimiter(interval=5.0)
+        client_media_log = RateLimiter(interval=5.0)
+        reconnect_backoff_log = RateLimiter(interval=5.0)
+        skipped_audio_log = RateLimiter(interval=5.0)
+        skipped_image_log = RateLimiter(interval=5.0)
+        image_task = None # Frame currently being prepared on the image pool
+
+        async def forward_image(image_data: str):
+            try:
+                frame = await image_pipeline.prepare_frame(image_data, *image_pipeline.frame_options(gemini.config))
+                # Drop frames that are near-identical to the last forwarded one
+                if vision.check_duplicate(frame.digest):
+                    await gemini.send_image(frame.data)
+            except Exception as send_image_err:
+                logger.error(f"[ClientReceiver-{client_id}] Error forwarding image: {send_image_err}")
 
         # Define receiver functions within the endpoint scope
         async def receive_from_gemini():
@@ -582,35 +832,26 @@ async def websocket_endpoint(websocket: WebSocket):
                             parts = candidate.get("content", {}).get("parts", [])
 
 
-                        # Forward parts (like audio) to the client
+                        # Forward parts (like audio) to the client through the egress queue
                         for p in parts:
-                            # Check client connection state before sending
-                            if websocket.client_state != WebSocketState.CONNECTED:
-                                logger.warning(f"[GeminiReceiver-{client_id}] Client WebSocket disconnected before sending part. Aborting send.")
+                            if egress.closed:
+                                logger.warning(f"[GeminiReceiver-{client_id}] Client egress stopped before sending part. Aborting send.")
                                 break # Stop sending parts if client disconnected
 
-                            # If an interrupt was issued, skip sending any remaining audio chunks.
-                            if gemini.interrupted:
-                                logger.info(f"[GeminiReceiver-{client_id}] Interrupt active, skipping sending part.")
-                                continue
-
                             if "inlineData" in p and "data" in p["inlineData"]:
                                 data = p['inlineData']['data']
                                 mime_type = p['inlineData'].get('mimeType', 'audio/pcm') # Default to audio if not specified
-                                try:
-                                    # Check client connection state again just before sending
-                                    if websocket.client_state == WebSocketState.CONNECTED:
-                                        await websocket.send_json({
-                                            "type": mime_type.split('/')[0], # "audio" or "video" etc.
-                                            "data": data
-                                        })
-                                    else:
-                                        logger.warning(f"[GeminiReceiver-{client_id}] Client disconnected right before sending {mime_type} data.")
-                                        break # Exit inner loop if client disconnected
-                                except Exception as send_err:
-                                     logger.error(f"[GeminiReceiver-{client_id}] Error sending data part to client: {send_err}")
-                                     # If sending fails, assume client disconnected
-                                     break # Stop trying to send parts
+                                # Chunks of an interrupted generation are dropped until Gemini ends that turn
+                                if egress.stale_turn:
+                                    if skipped_part_log.allow():
+                                        logger.info("[GeminiReceiver-%s] Turn was interrupted, dropping part (%d similar lines suppressed).", client_id, skipped_part_log.suppressed)
+                                elif gemini.awaiting_first_audio:
+                                    if gemini.last_user_audio_at is not None:
+                                        metrics.RESPONSE_LATENCY_SECONDS.observe(time.perf_counter() - gemini.last_user_audio_at)
+                                    gemini.awaiting_first_audio = False
+                                if not await egress.audio(mime_type.split('/')[0], data): # "audio" or "video" etc.
+                                    logger.warning(f"[GeminiReceiver-{client_id}] Client egress stopped, could not send {mime_type} data.")
+                                    break # Exit inner loop if client disconnected
 
                             elif "text" in p:
                                 # Text parts are not forwarded directly, but logged in GeminiConnection if needed
@@ -619,44 +860,33 @@ async def websocket_endpoint(websocket: WebSocket):
 
                     # Handle turn completion
                     if response.get("serverContent", {}).get("turnComplete"):
-                        if gemini.interrupted:
-                             logger.info(f"[GeminiReceiver-{client_id}] Turn complete received, but interrupt was active. Resetting interrupt flag.")
-                             gemini.interrupted = False # Reset interrupt flag after turn completion signal
-                             gemini.interrupt_sent = False # Reset interrupt sent flag
+                        gemini.awaiting_first_audio = True # Next model audio starts a new turn
+                        turn_epoch = egress.turn_epoch
+                        if not egress.end_turn():
+                            logger.info(f"[GeminiReceiver-{client_id}] Turn complete received for an interrupted turn. Not forwarding.")
                         else:
                             logger.info(f"[GeminiReceiver-{client_id}] Turn complete. Sending confirmation to client.")
-                            try:
-                                if websocket.client_state == WebSocketState.CONNECTED: # Check connection before sending
-                                    await websocket.send_json({
-                                        "type": "turn_complete",
-                                        "data": True
-                                    })
-                            except Exception as send_err:
-                                logger.error(f"[GeminiReceiver-{client_id}] Error sending turn_complete to client: {send_err}")
-                                break # Assume client disconnected
+                            await egress.put({
+                                "type": "turn_complete",
+                                "data": True
+                            }, epoch=turn_epoch)
 
                     # Check for interrupted response
                     if response.get("serverContent", {}).get("interrupted") is not None:
                         logger.info(f"[GeminiReceiver-{client_id}] Received interrupted signal from Gemini API.")
-                        # Set the interrupted flag to ensure no more audio is sent
-                        gemini.interrupted = True
-                        try:
-                            if websocket.client_state == WebSocketState.CONNECTED:
-                                # Send interrupt confirmation to client
-                                await websocket.send_json({
-                                    "type": "interrupt_confirmed",
-                                    "data": True
-                                })
-                                logger.info(f"[GeminiReceiver-{client_id}] Sent interrupt_confirmed to client.")
-
-                                # Also send a stop_audio message to tell the client to stop playing any buffered audio
-                                await websocket.send_json({
-                                    "type": "stop_audio",
-                                    "data": True
-                                })
-                                logger.info(f"[GeminiReceiver-{client_id}] Sent stop_audio to client.")
-                        except Exception as send_err:
-                            logger.error(f"[GeminiReceiver-{client_id}] Error sending interrupt_confirmed to client: {send_err}")
+                        gemini.awaiting_first_audio = True
+                        gemini.stats.interrupts += 1
+                        # If the client interrupted this turn already, its stop_audio has been sent
+                        already_stopped = egress.stale_turn
+                        egress.end_turn()
+                        if not already_stopped:
+                            # Purge queued audio and tell the client to stop playing what it has buffered
+                            egress.interrupt()
+                            logger.info(f"[GeminiReceiver-{client_id}] Queued stop_audio for epoch {egress.epoch}.")
+                        await egress.put({
+                            "type": "interrupt_confirmed",
+                            "data": True
+                        })
 
             except ws_exceptions.ConnectionClosedOK:
                 logger.info(f"[GeminiReceiver-{client_id}] Gemini WebSocket closed cleanly (OK). Exiting loop.")
@@ -689,6 +919,8 @@ async def websocket_endpoint(websocket: WebSocket):
 
         async def receive_from_client():
             nonlocal gemini_receive_task # Allow modification/restart
+            nonlocal client_close_code
+            nonlocal image_task
             while True:
                 try:
                     # Check client connection state before receiving
@@ -696,15 +928,32 @@ async def websocket_endpoint(websocket: WebSocket):
                         logger.warning(f"[ClientReceiver-{client_id}] Client WebSocket is not connected ({websocket.client_state}). Exiting loop.")
                         break
                     message_text = await websocket.receive_text()
+                    if recorder is not None:
+                        recorder.client(message_text)
+                    metrics.CLIENT_IN_BYTES.inc(len(message_text))
+                    metrics.CLIENT_IN_MESSAGES.inc()
+                    gemini.stats.client_in_bytes += len(message_text)
+                    gemini.stats.client_in_messages += 1
 
                     message_content = json.loads(message_text)
                     msg_type = message_content.get("type")
-                    logger.info(f"[ClientReceiver-{client_id}] Received message type: {msg_type}")
+                    if msg_type == "audio" or msg_type == "image":
+                        # Media arrives many times per second; log a sample instead of every chunk
+                        if client_media_log.allow():
+                            logger.info("[ClientReceiver-%s] Received message type: %s (%d similar lines suppressed)", client_id, msg_type, client_media_log.suppressed)
+                    else:
+                        logger.info("[ClientReceiver-%s] Received message type: %s", client_id, msg_type)
 
                     if msg_type == "config":
                         # Handle config updates during active connection
                         logger.info(f"[ClientReceiver-{client_id}] Received updated config from client.")
                         updated_config = message_content.get("config", {})
+                        problem = invalid_config(updated_config, message_content.get("audio_codecs"))
+                        if problem:
+                            # Keep running with the current config; nothing is saved
+                            logger.warning(f"[ClientReceiver-{client_id}] Ignoring config update: {problem}")
+                            await egress.put({"type": "error", "message": problem})
+                            continue
 
                         # Ensure all required config fields are present
                         default_config = {
@@ -721,6 +970,8 @@ async def websocket_endpoint(websocket: WebSocket):
                         for key, value in default_config.items():
                             if key not in updated_config:
                                 updated_config[key] = value
+                        if "audio_codecs" in message_content:
+                            await egress.set_codec(message_content["audio_codecs"])
                         # Update the configuration
                         gemini.set_config(updated_config)
 
@@ -746,77 +997,108 @@ async def websocket_endpoint(websocket: WebSocket):
 
                         # Perform the reconnect
                         await gemini.close()
-                        await gemini.connect()
+                        await admission.connect_upstream(gemini.connect, username, gemini.connect_backoff, kind="reconfigure")
                         logger.info(f"[ClientReceiver-{client_id}] Gemini reconnected successfully.")
+                        egress.end_turn() # The new upstream session starts between turns
+                        gemini.awaiting_first_audio = True
 
                         # Start a new Gemini receiver task
                         logger.info(f"[ClientReceiver-{client_id}] Starting new Gemini receiver task.")
-                        gemini_receive_task = asyncio.create_task(receive_from_gemini())
+                        gemini_receive_task = asyncio.create_task(receive_from_gemini(), name=f"gemini-receiver:{client_id}")
 
 
                     elif msg_type == "audio":
-                        if gemini.interrupted:
-                                logger.info(f"[ClientReceiver-{client_id}] Audio received after interrupt, resuming generation.")
-                                gemini.interrupted = False # Resume with a new generation if audio arrives after an interrupt
-
-                        # Check Gemini connection state correctly
-                        if not gemini.ws or gemini.ws.state == State.CLOSED:
-                            logger.warning(f"[ClientReceiver-{client_id}] Gemini connection is closed. Attempting to reconnect before sending audio.")
+                        # Check Gemini connection state correctly; an idle-reaped upstream reconnects here
+                        if gemini.reaped or not gemini.ws or gemini.ws.state == State.CLOSED:
+                            if gemini.reaped:
+                                logger.info(f"[ClientReceiver-{client_id}] Audio after idle period. Reconnecting Gemini.")
+                            else:
+                                logger.warning(f"[ClientReceiver-{client_id}] Gemini connection is closed. Attempting to reconnect before sending audio.")
+                            if gemini.connect_backoff.remaining():
+                                # A reconnect just failed; audio arrives many times a second, so drop it
+                                # until the backoff delay is over instead of retrying on every chunk
+                                if reconnect_backoff_log.allow():
+                                    logger.warning("[ClientReceiver-%s] Upstream reconnect backing off for %.1fs, dropping audio (%d similar lines suppressed).",
+                                                   client_id, gemini.connect_backoff.remaining(), reconnect_backoff_log.suppressed)
+                                continue
+                            # The old receiver must not outlive its socket and close the new one
+                            if gemini_receive_task and not gemini_receive_task.done():
+                                gemini_receive_task.cancel()
+                                try:
+                                    await gemini_receive_task
+                                except asyncio.CancelledError:
+                                    pass
+                                gemini_receive_task = None
                             try:
-                                await gemini.connect()
+                                await admission.connect_upstream(gemini.connect, username, gemini.connect_backoff, kind="reconnect", attempts=1)
                                 logger.info(f"[ClientReceiver-{client_id}] Gemini reconnected successfully.")
+                            except AdmissionRejected as rejected:
+                                logger.warning(f"[ClientReceiver-{client_id}] Reconnect not admitted: {rejected.reason}. Skipping audio send.")
+                                continue
                             except Exception as recon_err:
                                 logger.error(f"[ClientReceiver-{client_id}] Failed to reconnect Gemini: {recon_err}. Skipping audio send.")
                                 continue # Skip sending if reconnect fails
+                            if gemini.reaped:
+                                gemini.reaped = False
+                                IDLE_REVIVED.inc()
+                            egress.end_turn() # The new upstream session starts between turns
+                            gemini.awaiting_first_audio = True
+                            gemini_receive_task = asyncio.create_task(receive_from_gemini(), name=f"gemini-receiver:{client_id}")
                         # Check Gemini connection state before sending audio
                         gemini_ws_state = gemini.ws.state if gemini.ws else 'None'
                         if gemini.ws and gemini_ws_state == State.OPEN:
                             try:
                                 await gemini.send_audio(message_content["data"])
+                                gemini.last_user_audio_at = time.perf_counter()
                             except Exception as send_audio_err:
                                 logger.error(f"[ClientReceiver-{client_id}] Error calling gemini.send_audio: {send_audio_err}")
-                        else:
-                             logger.warning(f"[ClientReceiver-{client_id}] Skipping audio send because Gemini WS state is not OPEN (State: {gemini_ws_state}).")
+                        elif skipped_audio_log.allow():
+                             logger.warning("[ClientReceiver-%s] Skipping audio send because Gemini WS state is not OPEN (State: %s, %d similar lines suppressed).", client_id, gemini_ws_state, skipped_audio_log.suppressed)
 
 
                     elif msg_type == "image":
+                       # Enforce the adaptive frame rate before doing any decoding work
+                       image_busy = image_task is not None and not image_task.done()
+                       if not vision.check_rate(gemini.model_speaking, gemini.upstream_backlog(), busy=image_busy):
+                           continue
                        # Check Gemini connection state before sending image
                        gemini_ws_state = gemini.ws.state if gemini.ws else 'None'
                        if gemini.ws and gemini_ws_state == State.OPEN:
-                           try:
-                               await gemini.send_image(message_content["data"])
-                           except Exception as send_image_err:
-                               logger.error(f"[ClientReceiver-{client_id}] Error calling gemini.send_image: {send_image_err}")
-                       else:
-                            logger.warning(f"[ClientReceiver-{client_id}] Skipping image send because Gemini WS state is not OPEN (State: {gemini_ws_state}).")
+                           # Decode/downscale runs on the image pool; don't hold up audio behind it
+                           image_task = asyncio.create_task(forward_image(message_content["data"]), name=f"image-forward:{client_id}")
+                       elif skipped_image_log.allow():
+                            logger.warning("[ClientReceiver-%s] Skipping image send because Gemini WS state is not OPEN (State: %s, %d similar lines suppressed).", client_id, gemini_ws_state, skipped_image_log.suppressed)
 
                     elif msg_type == "interrupt":
                         logger.info(f"[ClientReceiver-{client_id}] Received interrupt command from client.")
+                        # Purge queued audio and put stop_audio at the head of the client queue first
+                        epoch = egress.interrupt(time.perf_counter())
+                        gemini.awaiting_first_audio = True
+                        gemini.stats.interrupts += 1
 
                         # Send the interrupt signal to Gemini API
                         interrupt_success = await gemini.send_interrupt()
 
                         # Send confirmation to client
-                        logger.info(f"[ClientReceiver-{client_id}] Sending interrupt confirmation to client.")
-                        await websocket.send_json({
+                        logger.info(f"[ClientReceiver-{client_id}] Sending interrupt confirmation to client (epoch {epoch}).")
+                        await egress.put({
                             "type": "interrupt",
                             "message": "Generation canceled.",
-                            "success": interrupt_success
-                        })
-
-                        # Also send a stop_audio message to tell the client to stop playing any buffered audio
-                        await websocket.send_json({
-                            "type": "stop_audio",
-                            "data": True
+                            "success": interrupt_success,
+                            "epoch": epoch
                         })
-                        logger.info(f"[ClientReceiver-{client_id}] Sent stop_audio to client.")
                         continue # Don't process further in this loop iteration
 
+                    elif msg_type == "audio_stopped":
+                        # The client has silenced playback after a stop_audio
+                        egress.playback_stopped(message_content.get("epoch", 0))
+
                     else:
                         logger.warning(f"[ClientReceiver-{client_id}] Unknown message type received: {msg_type}")
 
                 except WebSocketDisconnect as wsd:
                     logger.info(f"[ClientReceiver-{client_id}] WebSocket disconnected: {wsd.code} - {wsd.reason}")
+                    client_close_code = wsd.code
                     break # Exit loop on disconnect
                 except json.JSONDecodeError as e:
                     logger.error(f"[ClientReceiver-{client_id}] JSON decode error: {e}. Message: {message_text[:100]}...")
@@ -838,17 +1120,22 @@ async def websocket_endpoint(websocket: WebSocket):
 
         # Start the initial Gemini receiver task
         logger.info(f"[WebSocket-{client_id}] Starting initial Gemini receiver task.")
-        gemini_receive_task = asyncio.create_task(receive_from_gemini())
+        gemini_receive_task = asyncio.create_task(receive_from_gemini(), name=f"gemini-receiver:{client_id}")
 
         # Run the client receiver loop in the main task
         logger.info(f"[WebSocket-{client_id}] Starting client receiver loop.")
         await receive_from_client() # This will run until the client disconnects
 
-        logger.info(f"[WebSocket-{client_id}] Client receiver loop finished.")
+        logger.info(f"[WebSocket-{client_id}] Client receiver loop finished. Image frames: {vision.stats()}")
 
     except WebSocketDisconnect as wsd:
          logger.info(f"[WebSocket-{client_id}] WebSocket disconnected: {wsd.code} - {wsd.reason}")
          closed_intentionally = True # Mark as closed on disconnect
+    except AdmissionRejected as rejected:
+        logger.warning(f"[WebSocket-{client_id}] Upstream connect rejected: {rejected.reason}")
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await reject_session(websocket, rejected)
+            closed_intentionally = True
     except Exception as e:
         logger.error(f"[WebSocket-{client_id}] Unexpected error in main WebSocket handler: {type(e).__name__} - {str(e)}", exc_info=True)
         # Attempt to close gracefully if possible
@@ -876,10 +1163,32 @@ async def websocket_endpoint(websocket: WebSocket):
                  # Log error, but continue cleanup
                  logger.error(f"[WebSocket-{client_id}] Error awaiting cancelled Gemini task during cleanup: {task_cancel_err}")
 
-        # Close Gemini connection using the 'gemini' variable from the try block scope
+        if memory_subscription is not None:
+            memory_subscription.close()
+            memory_feed_task.cancel()
+        if egress_task and not egress_task.done():
+            egress_task.cancel()
+            try:
+                await egress_task
+            except asyncio.CancelledError:
+                pass
+
+        # Close Gemini connection using the 'gemini' variable from the try block scope.
+        # If the client dropped without a normal close it may come back, so park the upstream instead.
         if gemini:
-             logger.info(f"[WebSocket-{client_id}] Closing Gemini connection instance.")
-             await gemini.close()
+             if (client_close_code not in (None, status.WS_1000_NORMAL_CLOSURE, status.WS_1005_NO_STATUS_RCVD)
+                     and session_parking.park(resume_token, gemini, username, release=functools.partial(admission.release, client_id) if admitted else None)):
+                 logger.info(f"[WebSocket-{client_id}] Parked Gemini connection for resumption.")
+                 admitted = False # The parked session holds the admission slot until it is resumed or expires
+             else:
+                 logger.info(f"[WebSocket-{client_id}] Closing Gemini connection instance.")
+                 await gemini.close()
+        if took_parked_slot:
+            await session_parking.close_lent(username) # Dropped before its config said whether it resumes
+        if admitted:
+            await admission.release(client_id)
+        if recorder is not None:
+            recorder.close()
         # Remove from active connections dict (redundant if pop was used, but safe)
         if client_id in connections:
              del connections[client_id]
@@ -905,26 +1214,59 @@ async def websocket_endpoint(websocket: WebSocket):
 
         logger.info(f"[WebSocket-{client_id}] Cleanup complete. Connection fully closed.")
 
+@app.websocket("/ws/memories")
+async def memory_feed_endpoint(websocket: WebSocket, memory_db: MemoryDBDep, since_version: int = -1):
+    """Memory change feed for clients that only need the memory list, without a Gemini session.
+
+    The first message is a memory_sync with the changes since since_version (the
+    full list without it, see MemoryDB.get_memories_since); memory_changes
+    messages follow as memories are written.
+    """
+    client_id = f"{websocket.client.host}:{websocket.client.port}"
+    asyncio.current_task().set_name(f"ws-memories:{client_id}")
+    await websocket.accept()
+    username = await get_current_user_websocket(websocket)
+    if not username:
+        return
+    # Subscribe before reading, so nothing written in between is missed
+    subscription = memory_feed.subscribe(username)
+    pump_task = None
+    try:
+        sync = await asyncio.to_thread(memory_db.get_memories_since, username, since_version)
+        await send_client_json(websocket, {"type": "memory_sync", **sync})
+        pump_task = asyncio.create_task(
+            memory_feed.pump(subscription, lambda payload: send_client_json(websocket, payload)),
+            name=f"memory-feed:{client_id}"
+        )
+        logger.info("[MemoryFeed-%s] Subscribed %s at version %d", client_id, username, sync["version"])
+        while True:
+            await websocket.receive_text() # Nothing is expected from the client; this notices the disconnect
+    except WebSocketDisconnect:
+        logger.info("[MemoryFeed-%s] Disconnected", client_id)
+    finally:
+        subscription.close()
+        if pump_task is not None:
+            pump_task.cancel()
+
 @app.get("/memories")
-async def get_memories(request: Request):
-    """Get all memories"""
+async def get_memories(request: Request, username: CurrentUser, memory_db: MemoryDBDep, since_version: int = None):
+    """Get all memories, or with since_version only the changes after that version"""
     logger.info("Received request for /memories")
     try:
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-
-        if not token:
-            logger.warning("Authentication token missing")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        username = get_username_from_token(token)
+        # The version is read before the memories, so the ETag can only be older than the body
+        version = memory_db.get_versions(username)["memories"]
+        if conditional_get.matches(request, conditional_get.etag("memories", username, version)):
+            logger.debug("Memories of user %s unchanged at version %d", username, version)
+            return conditional_get.not_modified("/memories", "memories", username, version)
+        if since_version is not None:
+            delta = memory_db.get_memories_since(username, since_version)
+            logger.info("Returning %s of %d memories for user %s since version %d", "full list" if delta["full"] else "delta",
+                        len(delta["memories"]), username, since_version)
+            return conditional_get.versioned_json("/memories", "full" if delta["full"] else "delta", "memories", username, delta["version"], delta)
         logger.info(f"Fetching memories for user: {username}")
         memories = memory_db.get_all_memories(username)
         logger.info(f"Returning {len(memories)} memories for user {username}")
-        return memories
+        return conditional_get.versioned_json("/memories", "full", "memories", username, version, memories)
     except HTTPException as he:
         logger.warning(f"HTTP Exception in /memories: {he.status_code} - {he.detail}")
         raise he
@@ -932,22 +1274,34 @@ async def get_memories(request: Request):
         logger.error(f"Unexpected error in /memories: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/memories/batch")
+async def batch_memories(request: Request, username: CurrentUser, memory_db: MemoryDBDep):
+    """Delete, update or retype many memories in one transaction.
+
+    Body: {"op": "delete", "ids": [...]}, {"op": "update", "updates": [{"id", "content"}, ...]}
+    or {"op": "retype", "ids": [...], "type": "..."}. Returns the status of every id.
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Body must be a JSON object")
+    try:
+        outcome = await asyncio.to_thread(
+            memory_batch.run, memory_db, username, body.get("op"),
+            ids=body.get("ids"), updates=body.get("updates"), new_type=body.get("type")
+        )
+    except memory_batch.BatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info("Batch %s for user %s: %s", outcome["op"], username, memory_batch.summary(outcome))
+    return outcome
+
 @app.get("/memories/{memory_id}")
-async def get_memory(memory_id: int, request: Request):
+async def get_memory(memory_id: int, username: CurrentUser, memory_db: MemoryDBDep):
     """Get a specific memory by ID"""
     logger.info(f"Received request for /memories/{memory_id}")
     try:
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-
-        if not token:
-            logger.warning(f"Authentication token missing for /memories/{memory_id}")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        username = get_username_from_token(token)
         logger.info(f"Fetching memory {memory_id} for user: {username}")
 
         # Get the memory and verify it belongs to the user
@@ -978,21 +1332,10 @@ async def get_memory(memory_id: int, request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/memories/{memory_id}")
-async def delete_memory(memory_id: int, request: Request):
+async def delete_memory(memory_id: int, username: CurrentUser, memory_db: MemoryDBDep):
     """Delete a specific memory"""
     logger.info(f"Received request to delete /memories/{memory_id}")
     try:
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-
-        if not token:
-            logger.warning(f"Authentication token missing for DELETE /memories/{memory_id}")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        username = get_username_from_token(token)
         logger.info(f"Attempting to delete memory {memory_id} for user: {username}")
         # Assuming delete_memory handles authorization internally or raises an error
         memory_db.delete_memory(memory_id, username)
@@ -1008,21 +1351,10 @@ async def delete_memory(memory_id: int, request: Request):
         raise HTTPException(status_code=500, detail=f"Failed to delete memory: {str(e)}")
 
 @app.post("/config")
-async def update_config(request: Request):
+async def update_config(request: Request, username: CurrentUser, memory_db: MemoryDBDep):
     """Update user configuration"""
     logger.info("Received request to POST /config")
     try:
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-
-        if not token:
-            logger.warning("Authentication token missing for POST /config")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        username = get_username_from_token(token)
         logger.info(f"Updating config for user: {username}")
 
         # Get the request body
@@ -1031,6 +1363,9 @@ async def update_config(request: Request):
         except json.JSONDecodeError:
             logger.error("Failed to decode JSON body for POST /config")
             raise HTTPException(status_code=400, detail="Invalid JSON format")
+        problem = invalid_config(config_data)
+        if problem:
+            raise HTTPException(status_code=400, detail=problem)
 
 
         # Ensure all required config fields are present
@@ -1050,14 +1385,14 @@ async def update_config(request: Request):
                 config_data[key] = value
         # Update the configuration in the database
         try:
-            memory_db.update_user_config(username, config_data)
+            version = memory_db.update_user_config(username, config_data)
             logger.info(f"Successfully updated config for user {username}")
         except Exception as db_err:
              logger.error(f"Database error updating config for user {username}: {db_err}", exc_info=True)
              raise HTTPException(status_code=500, detail="Database error updating configuration")
 
 
-        return {"status": "success", "message": "Configuration updated successfully"}
+        return {"status": "success", "message": "Configuration updated successfully", "version": version}
     except HTTPException as he:
         logger.warning(f"HTTP Exception in POST /config: {he.status_code} - {he.detail}")
         raise he
@@ -1066,25 +1401,19 @@ async def update_config(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/config")
-async def get_config(request: Request):
-    """Get user configuration"""
+async def get_config(request: Request, username: CurrentUser, memory_db: MemoryDBDep, since_version: int = None):
+    """Get user configuration; with since_version, only whether it changed after that version"""
     logger.info("Received request for GET /config")
     try:
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-
-        if not token:
-            logger.warning("Authentication token missing for GET /config")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        username = get_username_from_token(token)
         logger.info(f"Fetching config for user: {username}")
 
-        # Get the configuration from the database
+        # Get the configuration from the database; the version first, so the ETag can only be older than the body
         try:
+            version = memory_db.get_versions(username)["config"]
+            if conditional_get.matches(request, conditional_get.etag("config", username, version)):
+                return conditional_get.not_modified("/config", "config", username, version)
+            if since_version == version:
+                return conditional_get.versioned_json("/config", "delta", "config", username, version, {"version": version, "changed": False})
             config = memory_db.get_user_config(username)
         except Exception as db_err:
             logger.error(f"Database error fetching config for user {username}: {db_err}", exc_info=True)
@@ -1106,7 +1435,9 @@ async def get_config(request: Request):
         else:
              logger.info(f"Returning saved config for user {username}")
 
-        return config
+        if since_version is not None:
+            return conditional_get.versioned_json("/config", "full", "config", username, version, {"version": version, "changed": True, "config": config})
+        return conditional_get.versioned_json("/config", "full", "config", username, version, config)
     except HTTPException as he:
         logger.warning(f"HTTP Exception in GET /config: {he.status_code} - {he.detail}")
         raise he
@@ -1117,5 +1448,5 @@ async def get_config(request: Request):
 if __name__ == "__main__":
     import uvicorn
     logger.info("Starting Uvicorn server...")
-    # Consider adding reload=True for development, but remove for production
+    # Development server with auto-reload; use serve.py for production
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, log_level="info")
@@ -0,0 +1,85 @@
+"""Bulk memory operations shared by POST /memories/batch and the batch_memories tool.
+
+An operation is one of delete, update (new content per id) or retype (one
+new type for all ids). It is applied to up to MEMORY_BATCH_MAX ids in a single
+MemoryDB transaction, and the result lists every requested id with what
+happened to it: ids that do not exist or belong to another user come back as
+not_found and leave the rest of the batch alone.
+"""
+import logging
+import os
+
+import metrics
+from db import MemoryDB
+
+logger = logging.getLogger(__name__)
+
+MAX_IDS = int(os.getenv("MEMORY_BATCH_MAX", "5000"))
+OPERATIONS = {"delete": "deleted", "update": "updated", "retype": "retyped"} # op -> status of the ids it applied to
+
+BATCH_SIZE = metrics.Histogram(
+    "memory_batch_ids",
+    "Ids per bulk memory operation, by operation.",
+    labelnames=("op",),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+
+
+class BatchError(ValueError):
+    """The batch request is malformed or too large."""
+
+
+def _ids(values) -> list:
+    if not isinstance(values, list) or not all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        raise BatchError("ids must be a list of integers")
+    if len(set(values)) != len(values):
+        # Each id gets exactly one result, so a repeated id could not be answered twice
+        raise BatchError("ids must not repeat")
+    return values
+
+
+def run(memory_db: MemoryDB, username: str, op: str, ids=None, updates=None, new_type=None) -> dict:
+    """Apply one bulk operation (blocking). updates is a list of {"id", "content"} for op "update".
+
+    Returns {"op", "version", "results": [{"id", "status"}]}; version is the
+    memories version after the batch, None if no id matched.
+    """
+    if op not in OPERATIONS:
+        raise BatchError(f"op must be one of: {', '.join(OPERATIONS)}")
+    if op == "update":
+        if not isinstance(updates, list) or not all(isinstance(u, dict) for u in updates):
+            raise BatchError("updates must be a list of {\"id\", \"content\"} objects")
+        _ids([u.get("id") for u in updates])
+        if not all(isinstance(u.get("content"), str) for u in updates):
+            raise BatchError("every update needs a string content")
+        count = len(updates)
+    else:
+        count = len(_ids(ids))
+    if count > MAX_IDS:
+        raise BatchError(f"at most {MAX_IDS} ids per batch")
+    if op == "retype" and not (isinstance(new_type, str) and new_type):
+        raise BatchError("retype needs a type")
+
+    BATCH_SIZE.labels(op).observe(count)
+    if op == "delete":
+        version, applied = memory_db.delete_memories(ids, username)
+    elif op == "update":
+        version, applied = memory_db.update_memories({u["id"]: u["content"] for u in updates}, username)
+    else:
+        version, applied = memory_db.retype_memories(ids, new_type, username)
+    status = OPERATIONS[op]
+    return {
+        "op": op,
+        "version": version,
+        "results": [{"id": memory_id, "status": status if ok else "not_found"} for memory_id, ok in applied.items()],
+    }
+
+
+def summary(outcome: dict) -> str:
+    """One line for the model about what a batch did."""
+    done = sum(1 for r in outcome["results"] if r["status"] != "not_found")
+    missing = [r["id"] for r in outcome["results"] if r["status"] == "not_found"]
+    text = f"{OPERATIONS[outcome['op']].capitalize()} {done} of {len(outcome['results'])} memories."
+    if missing:
+        text += f" Not found: {', '.join(map(str, missing[:20]))}{'...' if len(missing) > 20 else ''}."
+    return text
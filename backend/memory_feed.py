@@ -0,0 +1,141 @@
+"""Push memory changes to connected clients instead of having them poll /memories.
+
+MemoryDB reports every committed memory change through its change listeners;
+MemoryFeed.publish hands it to the event loop and fans it out to the
+subscriptions of that user. A subscription coalesces bursts: changes arriving
+within MEMORY_FEED_COALESCE_MS of the first one are merged per memory (added
+then updated is still one memory_added with the new content, two updates are
+one memory_updated with both changes, added then deleted cancels out) and sent
+as a single message:
+
+    {"type": "memory_changes", "version": 12, "events": [
+        {"type": "memory_added", "id": 7, "version": 11, "memory": {...}},
+        {"type": "memory_deleted", "id": 3, "version": 12}]}
+
+version is the user's memories version after these changes, usable as
+``GET /memories?since_version=``. It is null after a memories_cleared event,
+which tells the client to reload. Clients apply events by id, so seeing one
+that is already reflected in their list is harmless.
+
+Subscribers are /ws sessions that ask for the feed with ``"memory_feed": true``
+in their config message, and the dedicated /ws/memories channel. Changes
+written by other worker processes are not seen; clients catch up with a
+since_version request when they reconnect.
+"""
+import asyncio
+import logging
+import os
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FEED_EVENTS = metrics.Counter(
+    "memory_feed_events_total",
+    "Memory change events, by stage (published: fanned out to a subscription, delivered: sent after coalescing).",
+    labelnames=("stage",),
+)
+_PUBLISHED = FEED_EVENTS.labels("published")
+_DELIVERED = FEED_EVENTS.labels("delivered")
+FEED_SUBSCRIBERS = metrics.Gauge(
+    "memory_feed_subscribers",
+    "Open memory change feed subscriptions.",
+)
+
+
+class Subscription:
+    def __init__(self, feed: "MemoryFeed", username: str):
+        self.feed = feed
+        self.username = username
+        self._pending = {} # memory id -> coalesced event, in arrival order
+        self._cleared = False
+        self._version = None # Memories version after the pending events
+        self._ready = asyncio.Event()
+
+    def _push(self, change: dict):
+        """Merge one change into the pending batch. Runs on the event loop."""
+        _PUBLISHED.inc()
+        if change["type"] == "memories_cleared":
+            self._pending.clear()
+            self._cleared = True
+            self._version = None
+        else:
+            self._version = change["version"]
+            memory_id = change["id"]
+            previous = self._pending.pop(memory_id, None)
+            if previous is not None and change["type"] == "memory_updated":
+                # Still an add if it was added within the window, with the changed fields on top
+                change = {**previous, "version": change["version"], "memory": {**previous["memory"], **change["memory"]}}
+            elif previous is not None and previous["type"] == "memory_added" and change["type"] == "memory_deleted":
+                change = None # Added and deleted within the window: nothing to report
+            if change is not None:
+                self._pending[memory_id] = change
+        self._ready.set()
+
+    async def next_batch(self, coalesce: float) -> dict:
+        """Wait for changes, give a burst coalesce seconds to settle and return it as one message."""
+        while True:
+            await self._ready.wait()
+            if coalesce:
+                await asyncio.sleep(coalesce)
+            self._ready.clear()
+            events = list(self._pending.values())
+            if self._cleared:
+                events.insert(0, {"type": "memories_cleared"})
+            version = self._version
+            self._pending = {}
+            self._cleared = False
+            if events: # A burst can cancel itself out entirely; its version shows up with the next batch
+                _DELIVERED.inc(len(events))
+                return {"type": "memory_changes", "version": version, "events": events}
+
+    def close(self):
+        self.feed._unsubscribe(self)
+
+
+class MemoryFeed:
+    def __init__(self, coalesce: float = 0.1):
+        self.coalesce = coalesce
+        self._subscriptions = {} # username -> set of Subscription
+        self._loop = None
+        FEED_SUBSCRIBERS.set_function(lambda: sum(len(subs) for subs in self._subscriptions.values()))
+
+    @classmethod
+    def from_env(cls):
+        return cls(coalesce=float(os.getenv("MEMORY_FEED_COALESCE_MS", "100")) / 1000)
+
+    def subscribe(self, username: str) -> Subscription:
+        """Start collecting the user's memory changes. Call from the event loop; close() when done."""
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(self, username)
+        self._subscriptions.setdefault(username, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.username)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.username]
+
+    def publish(self, username, change: dict):
+        """MemoryDB change listener; may run on any thread."""
+        if self._loop is None or not (self._subscriptions if username is None else self._subscriptions.get(username)):
+            return # Nobody is listening, which is the common case
+        try:
+            self._loop.call_soon_threadsafe(self._fan_out, username, change)
+        except RuntimeError:
+            pass # The loop has closed at shutdown
+
+    def _fan_out(self, username, change: dict):
+        if username is None:
+            targets = [s for subscriptions in self._subscriptions.values() for s in subscriptions]
+        else:
+            targets = list(self._subscriptions.get(username, ()))
+        for subscription in targets:
+            subscription._push(change)
+
+    async def pump(self, subscription: Subscription, send):
+        """Send the subscription's batches with send(payload) until cancelled."""
+        while True:
+            await send(await subscription.next_batch(self.coalesce))
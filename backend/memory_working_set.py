@@ -0,0 +1,132 @@
+"""Per-session in-memory copy of a user's newest memories for tool calls.
+
+get_recent_memories and search_memories tool calls keep hitting the same few
+hundred rows during a conversation. GeminiConnection loads the user's newest
+MEMORY_WORKING_SET_SIZE memories when it connects, and those tool calls are
+answered from that list:
+
+* recent(limit) is exact whenever the set holds at least limit memories, or
+  all of the user's memories.
+* search(query, limit) is a case-insensitive substring match like the SQL
+  LIKE it replaces. Because the set holds the newest memories, its matches are
+  the newest matches overall, so it is exact when the set is complete or has at
+  least limit matches.
+
+Anything else falls back to the DB. Reloads and DB fallbacks run in a worker
+thread, since tool calls are handled on the event loop. Coherence uses the
+same mechanism as the setup memory cache: a MemoryDB write listener bumps a
+per-user generation, and a working set whose generation is out of date reloads
+before answering. That covers writes from this session's tool calls, other
+sessions of the same user and the REST routes. Writes made by other worker
+processes are not seen, so a set also reloads once it is older than
+MEMORY_WORKING_SET_TTL seconds.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from db import MemoryDB
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKING_SET_LOOKUPS = metrics.Counter(
+    "memory_working_set_lookups_total",
+    "Memory tool call lookups, by result (hit: answered from the session's working set, miss: sent to the DB).",
+    labelnames=("result",),
+)
+_HIT = WORKING_SET_LOOKUPS.labels("hit")
+_MISS = WORKING_SET_LOOKUPS.labels("miss")
+WORKING_SET_LOADS = metrics.Counter(
+    "memory_working_set_loads_total",
+    "Working set (re)loads from the DB, at connect or after a write made it stale.",
+)
+
+_generations = {} # username -> write count
+_global_generation = 0 # Bumped by writes that affect every user
+_lock = threading.Lock()
+
+
+def _on_write(username):
+    global _global_generation
+    with _lock:
+        if username is None:
+            _global_generation += 1
+        else:
+            _generations[username] = _generations.get(username, 0) + 1
+
+
+def _generation(username: str):
+    return _global_generation, _generations.get(username, 0)
+
+
+def _row_limit(limit) -> int:
+    """A model-supplied limit as a row count: it may arrive as a float, and negative means none."""
+    return max(0, int(limit))
+
+
+MemoryDB.add_write_listener(_on_write)
+
+
+class MemoryWorkingSet:
+    def __init__(self, memory_db: MemoryDB, username: str, max_items: int = 500, ttl: float = 60.0):
+        self.memory_db = memory_db
+        self.username = username
+        self.max_items = max_items # 0 disables the working set
+        self.ttl = ttl
+        self.entries = [] # (content, timestamp, lowercased content), newest first
+        self.complete = False # True when entries hold all of the user's memories
+        self._loaded_generation = None # None until loaded
+        self._loaded_at = 0.0
+
+    @classmethod
+    def from_env(cls, memory_db: MemoryDB, username: str):
+        return cls(
+            memory_db,
+            username,
+            max_items=int(os.getenv("MEMORY_WORKING_SET_SIZE", "500")),
+            ttl=float(os.getenv("MEMORY_WORKING_SET_TTL", "60")),
+        )
+
+    def load(self):
+        """Fetch the user's newest memories. Blocking; run it off the event loop where possible."""
+        if self.max_items <= 0:
+            return
+        generation = _generation(self.username) # Taken first, so a write racing the query makes the set stale
+        rows = self.memory_db.get_all_memories(self.username, limit=self.max_items + 1)
+        self.complete = len(rows) <= self.max_items
+        self.entries = [(row["content"], row["timestamp"], row["content"].lower()) for row in rows[:self.max_items]]
+        self._loaded_generation = generation
+        self._loaded_at = time.monotonic()
+        WORKING_SET_LOADS.inc()
+
+    async def _fresh(self) -> bool:
+        """Make sure the set reflects the latest writes; False if it is disabled."""
+        if self.max_items <= 0:
+            return False
+        if self._loaded_generation != _generation(self.username) or time.monotonic() - self._loaded_at > self.ttl:
+            await asyncio.to_thread(self.load)
+        return True
+
+    async def recent(self, limit):
+        """Newest memories as (content, timestamp) rows, like MemoryDB.get_recent_memories."""
+        limit = _row_limit(limit)
+        if await self._fresh() and (self.complete or limit <= len(self.entries)):
+            _HIT.inc()
+            return [(content, timestamp) for content, timestamp, _ in self.entries[:limit]]
+        _MISS.inc()
+        return await asyncio.to_thread(self.memory_db.get_recent_memories, self.username, limit)
+
+    async def search(self, query: str, limit):
+        """Newest memories containing query, as (content, timestamp) rows, like MemoryDB.search_memories."""
+        limit = _row_limit(limit)
+        if await self._fresh():
+            needle = query.lower()
+            matches = [(content, timestamp) for content, timestamp, lowered in self.entries if needle in lowered]
+            if self.complete or len(matches) >= limit:
+                _HIT.inc()
+                return matches[:limit]
+        _MISS.inc()
+        return await asyncio.to_thread(self.memory_db.search_memories, self.username, query, limit)
@@ -0,0 +1,266 @@
+"""Minimal Prometheus-style metrics for the backend.
+
+All updates happen on the event loop thread (or, for the odd DB call pushed to a
+worker thread, under the GIL), so metric objects are plain attribute increments
+without locks. Label combinations are bound once up front with ``labels()`` and
+the returned child is kept around, so the per-message path does no dict lookups
+or allocations.
+"""
+from bisect import bisect_left
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets tuned for voice interaction: a few ms up to tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+_registry = []
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(value)
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        _registry.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues):
+        """Return the child for a label combination. Bind once, reuse on the hot path."""
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._children[labelvalues] = self._new_child()
+        return child
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+    def _samples(self):
+        for labelvalues, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(child.value)}"
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Compute the value at scrape time instead of tracking it on the hot path."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+    def _samples(self):
+        for labelvalues, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(child.get())}"
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One slot per bucket plus the implicit +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    """Context manager observing the elapsed wall time into a histogram child."""
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return _Timer(self._children[()])
+
+    def _samples(self):
+        for labelvalues, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, ("le", _format_value(float(bound))))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Metric catalogue shared by main.py and db.py ---
+
+SESSION_SETUP_SECONDS = Histogram(
+    "gemini_session_setup_seconds",
+    "Time from starting the upstream connect to receiving the setup response.",
+)
+SESSION_SETUP_PHASE_SECONDS = Histogram(
+    "gemini_session_setup_phase_seconds",
+    "Duration of each upstream setup phase (handshake, memory, memory_wait, setup_send, setup_ack).",
+    labelnames=("phase",),
+)
+RESPONSE_LATENCY_SECONDS = Histogram(
+    "voice_response_latency_seconds",
+    "Time from the last user audio chunk to the first model audio chunk of a turn.",
+)
+INTERRUPT_LATENCY_SECONDS = Histogram(
+    "interrupt_stop_audio_seconds",
+    "Time from receiving an interrupt to sending stop_audio to the client.",
+)
+TOOL_CALL_SECONDS = Histogram(
+    "tool_call_seconds",
+    "Duration of Gemini tool call handling, by function.",
+    labelnames=("function",),
+)
+DB_CALL_SECONDS = Histogram(
+    "db_call_seconds",
+    "Duration of MemoryDB calls, by operation.",
+    labelnames=("operation",),
+    buckets=DB_BUCKETS,
+)
+WS_BYTES = Counter(
+    "ws_bytes_total",
+    "WebSocket payload bytes, by peer (client/upstream) and direction (in/out).",
+    labelnames=("peer", "direction"),
+)
+WS_MESSAGES = Counter(
+    "ws_messages_total",
+    "WebSocket messages, by peer (client/upstream) and direction (in/out).",
+    labelnames=("peer", "direction"),
+)
+ACTIVE_CONNECTIONS = Gauge(
+    "active_connections",
+    "Number of entries in the connections registry.",
+)
+
+# Pre-bound children for the per-message path
+CLIENT_IN_BYTES = WS_BYTES.labels("client", "in")
+CLIENT_OUT_BYTES = WS_BYTES.labels("client", "out")
+UPSTREAM_IN_BYTES = WS_BYTES.labels("upstream", "in")
+UPSTREAM_OUT_BYTES = WS_BYTES.labels("upstream", "out")
+CLIENT_IN_MESSAGES = WS_MESSAGES.labels("client", "in")
+CLIENT_OUT_MESSAGES = WS_MESSAGES.labels("client", "out")
+UPSTREAM_IN_MESSAGES = WS_MESSAGES.labels("upstream", "in")
+UPSTREAM_OUT_MESSAGES = WS_MESSAGES.labels("upstream", "out")
@@ -0,0 +1,120 @@
+"""On-demand statistical profiling of the whole process or of one /ws session.
+
+Nothing is installed while no profile is running, so the cost when off is
+zero. A profile runs a sampler thread for the requested number of seconds
+that reads thread stacks with sys._current_frames() every few milliseconds.
+For a session, only event loop samples taken while one of that session's
+tasks was running are kept (task names end in ``:<client_id>``, see
+loop_watchdog). For the whole process every thread is sampled, including the
+image, password and DB worker threads.
+
+The result is in the collapsed-stack format read by flamegraph.pl and
+speedscope: one line per distinct stack, frames separated by ``;``, root
+first, followed by the sample count. The root frame is the task name for
+event loop samples and the thread name for other threads.
+"""
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+
+import metrics
+from loop_watchdog import qualname, running_task_name, short_filename
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 60.0
+
+PROFILES_TAKEN = metrics.Counter(
+    "profiles_taken_total",
+    "On-demand profiles taken through the admin API, by scope (process, session).",
+    labelnames=("scope",),
+)
+
+
+class ProfileBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{qualname(frame)} ({short_filename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _stack(frame, skip_event_loop: bool):
+    """Frame labels root first. On the loop thread the asyncio plumbing is cut off."""
+    frames = []
+    while frame is not None:
+        if skip_event_loop and frame.f_code.co_name == "_run" and frame.f_code.co_filename.endswith("events.py"):
+            break # Handle._run: everything above it is the event loop itself
+        frames.append(frame)
+        frame = frame.f_back
+    return [_frame_label(f) for f in reversed(frames)]
+
+
+class SamplingProfiler:
+    def __init__(self, loop, loop_thread_id: int, client_id: str = None, interval: float = 0.005):
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.client_id = client_id # None profiles the whole process
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = None
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            if thread_id == self.loop_thread_id:
+                task = running_task_name(self.loop)
+                if self.client_id is not None and not task.endswith(":" + self.client_id):
+                    continue
+                root = task
+                stack = _stack(frame, skip_event_loop=True)
+            elif self.client_id is None:
+                if names is None:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                root = names.get(thread_id, f"thread-{thread_id}")
+                stack = _stack(frame, skip_event_loop=False)
+            else:
+                continue
+            self.stacks[";".join([root.replace(";", ":")] + stack)] += 1
+
+    def run(self, seconds: float) -> str:
+        """Sample for the given number of seconds (blocking) and return the collapsed stacks."""
+        deadline = time.monotonic() + seconds
+        next_sample = time.monotonic()
+        while next_sample < deadline:
+            self._sample()
+            self.samples += 1
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_running = threading.Lock()
+
+
+def profile(loop, loop_thread_id: int, seconds: float, client_id: str = None, interval: float = 0.005) -> str:
+    """Take one profile (blocking; run it off the event loop). Raises ProfileBusy if one is running."""
+    if not _running.acquire(blocking=False):
+        raise ProfileBusy("a profile is already running")
+    try:
+        seconds = min(max(seconds, 0.1), MAX_SECONDS)
+        scope = "session" if client_id is not None else "process"
+        PROFILES_TAKEN.labels(scope).inc()
+        logger.info("[Profiler] Profiling %s for %.1fs every %.1f ms", client_id or "the process", seconds, interval * 1000)
+        sampler = SamplingProfiler(loop, loop_thread_id, client_id, interval)
+        result = sampler.run(seconds)
+        logger.info("[Profiler] Took %d samples, %d distinct stacks", sampler.samples, len(sampler.stacks))
+        return result
+    finally:
+        _running.release()
@@ -0,0 +1,114 @@
+"""Session recording for deterministic replay benchmarks.
+
+When RECORD_DIR is set, every /ws session writes the raw messages it receives
+from the client (config, audio, image, ...) and from Gemini, with timestamps,
+to an append-only binary file. bench/replay.py pushes such recordings back
+through websocket_endpoint against a local upstream stand-in.
+
+File layout: the 8-byte MAGIC, then records of
+
+    kind:      uint8   (CLIENT_IN or UPSTREAM_IN)
+    offset:    float64 seconds since the recording started
+    length:    uint32  payload bytes
+    payload:   UTF-8 message text as received
+
+all little-endian. Readers memory-map the file and hand out memoryviews, so
+iterating a recording copies nothing.
+"""
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"AWKREC1\n"
+CLIENT_IN = 1 # Message received from the browser
+UPSTREAM_IN = 2 # Message received from Gemini
+_HEADER = struct.Struct("<BdI")
+
+RECORD_DIR = os.getenv("RECORD_DIR")
+
+
+class SessionRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "ab", buffering=256 * 1024)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._started = time.perf_counter()
+
+    @classmethod
+    def for_session(cls, username: str, client_id: str):
+        """Return a recorder for a new session, or None if recording is disabled."""
+        if not RECORD_DIR:
+            return None
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{username}-{client_id}")
+        path = os.path.join(RECORD_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_id}.awrec")
+        logger.info("[SessionRecorder] Recording session to %s", path)
+        return cls(path)
+
+    def _write(self, kind: int, message):
+        if self._file is None:
+            return
+        payload = message.encode("utf-8") if isinstance(message, str) else message
+        self._file.write(_HEADER.pack(kind, time.perf_counter() - self._started, len(payload)))
+        self._file.write(payload)
+
+    def client(self, message):
+        self._write(CLIENT_IN, message)
+
+    def upstream(self, message):
+        self._write(UPSTREAM_IN, message)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class RecordingReader:
+    """Memory-mapped reader over a recording file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a session recording")
+        self._view = memoryview(self._mmap)
+
+    def __iter__(self):
+        """Yield (kind, offset_seconds, payload memoryview) in recorded order."""
+        view = self._view
+        pos = len(MAGIC)
+        end = len(view)
+        while pos + _HEADER.size <= end:
+            kind, offset, length = _HEADER.unpack_from(view, pos)
+            pos += _HEADER.size
+            if pos + length > end:
+                break # Truncated final record from a session that was still running
+            yield kind, offset, view[pos:pos + length]
+            pos += length
+
+    def records(self, kind: int):
+        return [(offset, payload) for k, offset, payload in self if k == kind]
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # Payload views handed out by __iter__ are still alive; the map is freed with them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
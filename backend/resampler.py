@@ -0,0 +1,151 @@
+"""Streaming polyphase resampling of client microphone audio to 16 kHz.
+
+Gemini expects 16 kHz 16-bit PCM, while browsers capture at 44.1 or 48 kHz.
+A client can declare its capture rate with ``inputSampleRate`` in its config
+and send native-rate PCM; GeminiConnection then runs every audio chunk through
+a StreamingResampler before forwarding it. Only the common capture rates in
+SUPPORTED_RATES are accepted: the filter and work arrays grow with the reduced
+ratio, so an arbitrary rate (7 Hz, or a coprime one like 44101) would cost
+gigabytes or a filter of hundreds of thousands of taps.
+
+The resampler works at the rational ratio L/M (up by L, down by M, e.g. 160/441
+for 44.1 kHz) with a Kaiser-windowed sinc low-pass split into L polyphase
+filters, so only the output samples are ever computed. All chunk outputs are
+evaluated at once as a gather of input windows times the matching phase's
+filter; for integer decimation (48 kHz) that reduces to a matrix-vector
+product over a strided view of the input. Filter history and the fractional output position carry over between
+chunks, so chunk boundaries are seamless, and the work arrays are reused, so a
+steady stream allocates nothing beyond the output bytes.
+"""
+import math
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; without it clients must send 16 kHz
+    np = None
+
+TARGET_RATE = 16000
+SUPPORTED_RATES = (8000, 11025, 16000, 22050, 24000, 32000, 44100, 48000, 96000)
+
+
+def validate_rate(value) -> int:
+    """The client's declared input rate as an int (16 kHz if unset); ValueError if it is not supported."""
+    if value is None or value == "":
+        return TARGET_RATE
+    if isinstance(value, bool):
+        rate = None
+    elif isinstance(value, float):
+        rate = int(value) if value.is_integer() else None
+    else:
+        try:
+            rate = int(value)
+        except (TypeError, ValueError):
+            rate = None
+    if rate not in SUPPORTED_RATES:
+        raise ValueError(f"inputSampleRate must be one of {', '.join(map(str, SUPPORTED_RATES))}")
+    return rate
+
+
+def design_filter(up: int, down: int, taps_per_phase: int, rolloff: float = 0.9, beta: float = 8.0):
+    """Low-pass prototype for resampling by up/down, normalised to a passband gain of up."""
+    num_taps = up * taps_per_phase
+    cutoff = rolloff * 0.5 / max(up, down) # Cycles per sample at the upsampled rate
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(num_taps, beta)
+    return h * (up / h.sum())
+
+
+class StreamingResampler:
+    def __init__(self, in_rate: int, out_rate: int = TARGET_RATE, taps_per_phase: int = 48, initial_chunk: int = 4096):
+        if np is None:
+            raise RuntimeError("NumPy is required for resampling")
+        g = math.gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.taps = taps_per_phase
+
+        # poly[p] is phase p's filter, reversed so it dots directly with an input window
+        h = design_filter(self.up, self.down, taps_per_phase).astype(np.float32)
+        self._poly = np.ascontiguousarray(h.reshape(taps_per_phase, self.up).T[:, ::-1])
+
+        self._history = taps_per_phase - 1 # Input samples kept from the previous chunk
+        self._filled = self._history # Valid samples at the start of _buf (zeros to begin with)
+        self._position = self._history * self.up # Next output, in 1/up input samples from _buf[0]
+        self._pending = b"" # Odd trailing byte of the previous chunk, half of a sample
+        self._allocate(initial_chunk)
+
+    def _allocate(self, chunk_samples: int):
+        """Size the reusable work arrays for input chunks of up to chunk_samples."""
+        self._capacity = chunk_samples
+        max_out = chunk_samples * self.up // self.down + 2
+        old = getattr(self, "_buf", None)
+        self._buf = np.zeros(self._history + chunk_samples, dtype=np.float32)
+        if old is not None:
+            self._buf[:self._filled] = old[:self._filled]
+        self._index = np.arange(max_out, dtype=np.int64)
+        self._t = np.empty(max_out, dtype=np.int64)
+        self._base = np.empty(max_out, dtype=np.int64)
+        self._phase = np.empty(max_out, dtype=np.int64)
+        self._windows = np.empty((max_out, self.taps), dtype=np.float32)
+        self._coefs = np.empty((max_out, self.taps), dtype=np.float32)
+        self._out = np.empty(max_out, dtype=np.float32)
+        self._out16 = np.empty(max_out, dtype="<i2")
+
+    def process(self, pcm: bytes) -> bytes:
+        """Resample a chunk of 16-bit little-endian mono PCM, returning PCM at out_rate."""
+        if self._pending:
+            pcm = self._pending + pcm
+        usable = len(pcm) & ~1
+        self._pending = pcm[usable:]
+        samples = np.frombuffer(pcm, dtype="<i2", count=usable // 2)
+        if not samples.size:
+            return b""
+        if samples.size > self._capacity:
+            self._allocate(samples.size)
+        end = self._filled + samples.size
+        np.copyto(self._buf[self._filled:end], samples, casting="unsafe")
+
+        # Outputs whose newest input sample has arrived: floor(t / up) < end
+        count = max(0, -(-(end * self.up - self._position) // self.down))
+        out = self._out[:count]
+        if count:
+            # Only when there are outputs: a run of tiny chunks can leave fewer than taps samples
+            windows = np.lib.stride_tricks.sliding_window_view(self._buf[:end], self.taps)
+        if count == 0:
+            pass
+        elif self.up == 1:
+            # Integer decimation (e.g. 48 kHz): one filter, and the windows are a strided view
+            first = self._position - (self.taps - 1)
+            np.dot(windows[first:first + (count - 1) * self.down + 1:self.down], self._poly[0], out=out)
+        else:
+            # Gather each output's input window and phase filter, then dot them row-wise
+            t = self._t[:count]
+            np.multiply(self._index[:count], self.down, out=t)
+            t += self._position
+            base = np.floor_divide(t, self.up, out=self._base[:count])
+            phase = np.remainder(t, self.up, out=self._phase[:count])
+            base -= self.taps - 1
+            np.take(windows, base, axis=0, out=self._windows[:count])
+            np.take(self._poly, phase, axis=0, out=self._coefs[:count], mode="clip")
+            np.einsum("nk,nk->n", self._windows[:count], self._coefs[:count], out=out)
+        np.clip(out, -32768, 32767, out=out)
+        np.copyto(self._out16[:count], out, casting="unsafe")
+
+        # Keep the samples the next chunk's first outputs still need
+        self._position += count * self.down
+        keep_from = min(self._position // self.up - (self.taps - 1), end)
+        kept = end - keep_from
+        self._buf[:kept] = self._buf[keep_from:end]
+        self._filled = kept
+        self._position -= keep_from * self.up
+        return self._out16[:count].tobytes()
+
+
+def for_rate(in_rate) -> "StreamingResampler | None":
+    """Resampler for a client's declared input rate, or None if it already sends 16 kHz."""
+    in_rate = validate_rate(in_rate)
+    if in_rate == TARGET_RATE:
+        return None
+    return StreamingResampler(in_rate)
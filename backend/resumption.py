@@ -0,0 +1,198 @@
+"""Short-lived parking of upstream Gemini sessions for reconnecting clients.
+
+When a browser tab blips, tearing down the upstream socket means the
+reconnecting client pays for the handshake, the setup message with the full
+memory prompt and the config reload again. Instead, the session is parked
+under a resume token for a short grace period. A drain task keeps reading the
+upstream socket meanwhile (answering tool calls and buffering model audio
+within a byte budget) so the upstream never stalls. If the client comes back
+with the token in its config message it is reattached to the same upstream
+and the buffered messages are replayed; otherwise the session is closed when
+the grace period runs out.
+
+A parked session keeps the admission slot of the session it came from, so it
+still counts against the global and per-user session caps: the release
+callback passed to park() runs once it is resumed or expires. A user at their
+cap who reconnects takes over the slot of a parked session instead; that
+session is closed unless the new one resumes it.
+
+Parked sessions live in the worker process that served them, so with several
+workers a reconnect only resumes when it lands on the same process.
+"""
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_PARKED = metrics.Counter("sessions_parked_total", "Upstream sessions parked after a client disconnect.")
+SESSIONS_RESUMED = metrics.Counter("sessions_resumed_total", "Parked sessions reattached to a reconnecting client.")
+PARKED_EXPIRED = metrics.Counter("parked_sessions_expired_total", "Parked sessions closed because the grace period ran out.")
+PARKED_DROPPED_BYTES = metrics.Counter("parked_dropped_bytes_total", "Model audio bytes dropped because a parked session's buffer was full.")
+PARKED_SESSIONS = metrics.Gauge("parked_sessions", "Upstream sessions currently parked.")
+
+
+class ParkedSession:
+    def __init__(self, token: str, gemini, username: str):
+        self.token = token
+        self.gemini = gemini
+        self.username = username
+        self.parked_at = time.monotonic()
+        self.buffered = deque() # Client messages produced while detached, in order
+        self.buffered_bytes = 0
+        self.dropped_bytes = 0
+        self.task = None
+        self.release = None # Coroutine function giving back the admission slot
+
+
+class SessionParking:
+    def __init__(self, grace_seconds: float = 15.0, buffer_budget_bytes: int = 1024 * 1024, max_parked: int = 100):
+        self.grace_seconds = grace_seconds # 0 disables parking
+        self.buffer_budget_bytes = buffer_budget_bytes
+        self.max_parked = max_parked
+        self._parked = {} # token -> ParkedSession
+        PARKED_SESSIONS.set_function(lambda: len(self._parked))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            grace_seconds=float(os.getenv("RESUME_GRACE_SECONDS", "15")),
+            buffer_budget_bytes=int(os.getenv("RESUME_BUFFER_BYTES", str(1024 * 1024))),
+            max_parked=int(os.getenv("RESUME_MAX_PARKED", "100")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.grace_seconds > 0
+
+    def issue_token(self) -> str:
+        return secrets.token_urlsafe(24)
+
+    def park(self, token: str, gemini, username: str, release=None) -> bool:
+        """Keep an upstream session alive for the grace period. Returns False if it should be closed instead.
+
+        release is awaited once the parked session no longer needs its admission slot.
+        """
+        if not self.enabled or not token or len(self._parked) >= self.max_parked:
+            return False
+        if not gemini.is_open():
+            return False
+        parked = ParkedSession(token, gemini, username)
+        parked.release = release
+        parked.task = asyncio.create_task(self._hold(parked))
+        self._parked[token] = parked
+        SESSIONS_PARKED.inc()
+        logger.info("[SessionParking-%s] Parked upstream session for %.0fs.", username, self.grace_seconds)
+        return True
+
+    async def resume(self, token: str, username: str):
+        """Detach and return the parked session for token, or None if there is none for this user."""
+        parked = self._parked.get(token)
+        if parked is None or parked.username != username:
+            return None
+        del self._parked[token]
+        parked.task.cancel()
+        try:
+            await parked.task
+        except asyncio.CancelledError:
+            pass
+        await self._release(parked) # The resuming session holds its own slot
+        if not parked.gemini.is_open():
+            return None
+        SESSIONS_RESUMED.inc()
+        logger.info("[SessionParking-%s] Resumed session after %.1fs with %d buffered messages (%d bytes dropped).",
+                    username, time.monotonic() - parked.parked_at, len(parked.buffered), parked.dropped_bytes)
+        return parked
+
+    async def lend_slot(self, username: str) -> bool:
+        """Give up the admission slot of the user's oldest counted parked session. Returns False if there is none.
+
+        The session stays parked so that the new session being admitted in its
+        place can resume it; close_lent() closes it if that does not happen.
+        """
+        parked = next((p for p in self._parked.values() if p.username == username and p.release is not None), None)
+        if parked is None:
+            return False
+        await self._release(parked)
+        return True
+
+    async def close_lent(self, username: str):
+        """Close the user's parked sessions that gave up their admission slot."""
+        for parked in [p for p in self._parked.values() if p.username == username and p.release is None]:
+            logger.info("[SessionParking-%s] Closing parked session superseded by a new one.", parked.username)
+            parked.task.cancel()
+            await asyncio.gather(parked.task, return_exceptions=True)
+            self._parked.pop(parked.token, None)
+            await parked.gemini.close()
+
+    async def close_all(self):
+        """Close every parked session (used at shutdown)."""
+        parked_sessions = list(self._parked.values())
+        for parked in parked_sessions:
+            parked.task.cancel()
+        await asyncio.gather(*(parked.task for parked in parked_sessions), return_exceptions=True)
+        self._parked.clear()
+
+    async def _hold(self, parked: ParkedSession):
+        try:
+            await asyncio.wait_for(self._drain(parked), timeout=self.grace_seconds)
+        except asyncio.TimeoutError:
+            PARKED_EXPIRED.inc()
+            logger.info("[SessionParking-%s] Grace period expired, closing upstream session.", parked.username)
+        except asyncio.CancelledError:
+            if parked.token in self._parked:
+                # Cancelled by close_all or close_lent rather than resume: the upstream is not reused
+                await parked.gemini.close()
+                await self._release(parked)
+            raise
+        except Exception as e:
+            logger.error("[SessionParking-%s] Error while draining parked session: %s", parked.username, e)
+        self._parked.pop(parked.token, None)
+        await parked.gemini.close()
+        await self._release(parked)
+
+    async def _release(self, parked: ParkedSession):
+        release, parked.release = parked.release, None
+        if release is not None:
+            try:
+                await release()
+            except Exception as e:
+                logger.error("[SessionParking-%s] Error releasing admission slot: %s", parked.username, e)
+
+    def _buffer(self, parked: ParkedSession, payload: dict, size: int):
+        if parked.buffered_bytes + size > self.buffer_budget_bytes:
+            parked.dropped_bytes += size
+            PARKED_DROPPED_BYTES.inc(size)
+            return
+        parked.buffered.append(payload)
+        parked.buffered_bytes += size
+
+    async def _drain(self, parked: ParkedSession):
+        """Keep consuming upstream messages while no client is attached."""
+        gemini = parked.gemini
+        while gemini.is_open():
+            response = json.loads(await gemini.receive())
+            if "toolCall" in response:
+                await gemini.handle_tool_call(response["toolCall"])
+                continue
+            content = response.get("serverContent")
+            if not content:
+                continue
+            if content.get("interrupted") is not None:
+                # Whatever was buffered belongs to the interrupted generation
+                parked.buffered.clear()
+                parked.buffered_bytes = 0
+                continue
+            for p in content.get("modelTurn", {}).get("parts", []):
+                inline = p.get("inlineData")
+                if inline and "data" in inline:
+                    mime_type = inline.get("mimeType", "audio/pcm")
+                    self._buffer(parked, {"type": mime_type.split('/')[0], "data": inline["data"]}, len(inline["data"]))
+            if content.get("turnComplete"):
+                self._buffer(parked, {"type": "turn_complete", "data": True}, 0)
@@ -1,49 +1,232 @@
+"""Password hashing, login and JWT helpers.
+
+bcrypt takes on the order of 100 ms per hash or verify, so the async API
+(hash_password, check_password, authenticate_user) runs it on a small worker
+pool instead of the event loop. The pool is a thread pool by default (the
+bcrypt backend releases the GIL); set PASSWORD_POOL=process to use processes.
+Logins beyond LOGIN_MAX_PENDING in flight are turned away with 429 rather than
+queueing behind the pool. Users are looked up in the users table per login.
+
+Bearer tokens are checked by verify_token(), which remembers tokens it has
+already verified in a bounded LRU keyed by the token's SHA-256 until their
+``exp``, so polling routes do not pay for a JWT decode and signature check on
+every request. get_current_username is the FastAPI dependency for REST routes;
+the /ws handshake goes through the same cache.
+"""
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from fastapi import WebSocket, HTTPException, status
+from fastapi import Depends, WebSocket, HTTPException, status
+from fastapi.security import OAuth2PasswordBearer
 import os
-from typing import Optional
+import time
+from typing import Annotated, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here-change-me-in-production!")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+LOGIN_MAX_PENDING = int(os.getenv("LOGIN_MAX_PENDING", "32"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024")) # 0 disables the verified-token cache
+# Users allowed on the /admin endpoints, comma separated. Empty by default, which turns the endpoints
+# off: a fresh install seeds an admin/admin account, and they expose every session and the profiler.
+ADMIN_USERS = frozenset(name.strip() for name in os.getenv("ADMIN_USERS", "").split(",") if name.strip())
+
+PASSWORD_HASH_SECONDS = metrics.Histogram(
+    "password_hash_seconds",
+    "Time from submitting a bcrypt hash or verify to the password pool until it finishes, by operation.",
+    labelnames=("operation",),
+)
+LOGIN_REJECTIONS = metrics.Counter(
+    "login_rejections_total",
+    "Logins turned away because LOGIN_MAX_PENDING logins were already in flight.",
+)
+TOKEN_VERIFY_SECONDS = metrics.Histogram(
+    "token_verification_seconds",
+    "Time to authenticate a bearer token, by result (hit: cached, miss: decoded, invalid).",
+    labelnames=("result",),
+    buckets=(0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025),
+)
+_VERIFY_HIT = TOKEN_VERIFY_SECONDS.labels("hit")
+_VERIFY_MISS = TOKEN_VERIFY_SECONDS.labels("miss")
+_VERIFY_INVALID = TOKEN_VERIFY_SECONDS.labels("invalid")
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+class User:
+    def __init__(self, username: str, hashed_password: str):
+        self.username = username
+        self.hashed_password = hashed_password
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("PASSWORD_POOL_WORKERS", "2"))
+        if os.getenv("PASSWORD_POOL", "thread") == "process":
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+    return _executor
+
+def shutdown():
+    """Stop the password pool (called at application shutdown)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def _run_on_pool(operation: str, func, *args):
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+    finally:
+        PASSWORD_HASH_SECONDS.labels(operation).observe(time.perf_counter() - started)
+
+async def hash_password(password: str) -> str:
+    """get_password_hash on the password pool."""
+    return await _run_on_pool("hash", get_password_hash, password)
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    """verify_password on the password pool."""
+    return await _run_on_pool("verify", verify_password, plain_password, hashed_password)
+
+_pending_logins = 0
+
+@asynccontextmanager
+async def login_slot():
+    """Admit a login, or raise 429 if LOGIN_MAX_PENDING are already in flight."""
+    global _pending_logins
+    if _pending_logins >= LOGIN_MAX_PENDING:
+        LOGIN_REJECTIONS.inc()
+        logger.warning("[Security] %d logins in flight, rejecting login.", _pending_logins)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many concurrent logins, retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    _pending_logins += 1
+    try:
+        yield
+    finally:
+        _pending_logins -= 1
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+class TokenCache:
+    """Bounded LRU of verified tokens: SHA-256 of the token -> (username, exp)."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key: bytes) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._entries[key] # Expired: make the caller decode it and get the JWT error
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: bytes, username: str, exp: float):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (username, exp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+def verify_token(token: str) -> Optional[str]:
+    """Username the token was issued to, or None if it is invalid or expired."""
+    started = time.perf_counter()
+    key = hashlib.sha256(token.encode()).digest()
+    username = token_cache.get(key)
+    if username is not None:
+        _VERIFY_HIT.observe(time.perf_counter() - started)
+        return username
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username = payload.get("sub")
+    except JWTError:
+        username = None
+    if username is None:
+        _VERIFY_INVALID.observe(time.perf_counter() - started)
+        return None
+    if "exp" in payload: # Tokens without an expiry are not cached
+        token_cache.put(key, username, float(payload["exp"]))
+    _VERIFY_MISS.observe(time.perf_counter() - started)
+    return username
+
+async def get_current_username(token: Annotated[str, Depends(oauth2_scheme)]) -> str:
+    """FastAPI dependency: the username behind the request's bearer token, or 401."""
+    username = verify_token(token)
+    if username is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return username
+
+async def get_admin_username(username: Annotated[str, Depends(get_current_username)]) -> str:
+    """FastAPI dependency for /admin routes: the current user, or 403 unless listed in ADMIN_USERS."""
+    if username not in ADMIN_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return username
+
 async def get_current_user_websocket(websocket: WebSocket) -> Optional[str]:
     token = websocket.query_params.get("token")
     if not token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return None
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return None
-    except JWTError:
+
+    username = verify_token(token)
+    if username is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return None
-    
+
     return username
 
-def authenticate_user(db, username: str, password: str):
-    user = db.get(username)
-    if not user or not verify_password(password, user.hashed_password):
+async def authenticate_user(memory_db, username: str, password: str):
+    """Look the user up in the users table and check the password off the event loop."""
+    row = await asyncio.to_thread(memory_db.get_user, username)
+    if row is None:
+        return False
+    user = User(username=row[0], hashed_password=row[1])
+    if not await check_password(password, user.hashed_password):
         return False
     return user
@@ -0,0 +1,75 @@
+"""Production entry point: N uvicorn workers, no reloader.
+
+Usage:
+    python serve.py --workers 4 --port 8000
+
+Workers share session caps through the SQLite session registry (see
+session_registry.py). uvloop and httptools are used when installed.
+
+Everything else is per process, and a request or socket lands on whichever
+worker the kernel hands it to. With more than one worker:
+
+* The memory change feed (/ws/memories and "memory_feed": true) only carries
+  changes written by the same worker; clients catch up with
+  ``GET /memories?since_version=`` when they reconnect.
+* Memory working sets (MEMORY_WORKING_SET_TTL) and the setup memory cache
+  (MEMORY_CONTEXT_TTL) only see other workers' writes once their TTL expires.
+* Parked sessions can only be resumed by a reconnect to the same worker.
+* /admin/sessions, /admin/loop-lag, /admin/profile and /metrics describe the
+  worker that answered, not the whole server.
+
+bench/bench_sessions_per_core.py measures live sessions per core with a given
+number of workers against the mock upstream.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+
+import uvicorn
+
+from log_config import setup_logging
+from session_registry import SessionRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def _has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the backend with multiple worker processes.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--registry", default=os.getenv("SESSION_REGISTRY_PATH", "sessions.db"),
+                        help="SQLite file shared by the workers for session accounting")
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info").lower())
+    args = parser.parse_args()
+
+    setup_logging(args.log_level.upper())
+
+    # Workers inherit the environment, so this switches them to the shared registry
+    os.environ["SESSION_REGISTRY_PATH"] = args.registry
+    SessionRegistry(args.registry).reset() # Nothing is live before the workers start
+
+    loop = "uvloop" if _has_module("uvloop") else "asyncio"
+    http = "httptools" if _has_module("httptools") else "h11"
+    logger.info("Starting %d workers on %s:%d (loop=%s, http=%s, registry=%s)",
+                args.workers, args.host, args.port, loop, http, args.registry)
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=loop,
+        http=http,
+        ws="websockets",
+        reload=False,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Cross-process registry of live /ws sessions.
+
+With several uvicorn workers the in-process ``connections`` dict only sees a
+fraction of the sessions, so global and per-user caps are enforced against a
+small SQLite database shared by all workers on the host. WAL mode plus
+``BEGIN IMMEDIATE`` transactions make the check-and-insert atomic across
+processes. Each worker refreshes a heartbeat for its rows so sessions of a
+crashed worker expire instead of counting against the caps forever.
+"""
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.getenv("SESSION_REGISTRY_PATH", "sessions.db")
+
+
+def connect_sqlite(path: str, timeout: float = 10.0) -> sqlite3.Connection:
+    """Open a SQLite connection configured for concurrent use by several processes."""
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SessionRegistry:
+    def __init__(self, path: str = DEFAULT_PATH, stale_after: float = 30.0):
+        self.path = path
+        self.stale_after = stale_after # Rows without a heartbeat for this long are ignored and purged
+        self.pid = os.getpid()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_key TEXT PRIMARY KEY,
+                    client_id TEXT NOT NULL,
+                    username TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    started_at REAL NOT NULL,
+                    heartbeat REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username)")
+
+    def _connect(self):
+        return _Connection(connect_sqlite(self.path))
+
+    def _key(self, client_id: str) -> str:
+        # client_id (host:port) is only unique per worker, so namespace it by pid
+        return f"{self.pid}/{client_id}"
+
+    def try_acquire(self, client_id: str, username: str, max_sessions: int, max_sessions_per_user: int):
+        """Atomically register a session if the caps allow it.
+
+        Returns None on success, or the name of the exceeded limit
+        ("sessions" or "user_sessions").
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM sessions WHERE heartbeat < ?", (now - self.stale_after,))
+                total = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+                if total >= max_sessions:
+                    conn.execute("COMMIT")
+                    return "sessions"
+                per_user = conn.execute(
+                    "SELECT COUNT(*) FROM sessions WHERE username = ?", (username,)
+                ).fetchone()[0]
+                if per_user >= max_sessions_per_user:
+                    conn.execute("COMMIT")
+                    return "user_sessions"
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (session_key, client_id, username, pid, started_at, heartbeat) VALUES (?, ?, ?, ?, ?, ?)",
+                    (self._key(client_id), client_id, username, self.pid, now, now)
+                )
+                conn.execute("COMMIT")
+                return None
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def release(self, client_id: str):
+        """Remove a session registered by this worker."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_key = ?", (self._key(client_id),))
+
+    def heartbeat(self):
+        """Mark all sessions owned by this worker as alive."""
+        with self._connect() as conn:
+            conn.execute("UPDATE sessions SET heartbeat = ? WHERE pid = ?", (time.time(), self.pid))
+
+    def clear_worker(self):
+        """Drop rows left behind by an earlier process with this pid."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE pid = ?", (self.pid,))
+
+    def reset(self):
+        """Remove every row. Called by the launcher before workers start."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions")
+
+    def counts(self):
+        """Return (total live sessions, {username: sessions}) across all workers."""
+        cutoff = time.time() - self.stale_after
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT username, COUNT(*) FROM sessions WHERE heartbeat >= ? GROUP BY username", (cutoff,)
+            ).fetchall()
+        per_user = dict(rows)
+        return sum(per_user.values()), per_user
+
+
+class _Connection:
+    """Context manager that closes the connection (sqlite3's own only ends the transaction)."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.close()
+        return False
@@ -0,0 +1,60 @@
+"""Per-session resource counters for the admin sessions API.
+
+Every GeminiConnection carries a SessionStats that the per-message paths bump
+with plain attribute increments (the object has __slots__, so there are no
+dict lookups or allocations on the hot path). Time spent in MemoryDB calls is
+charged to the session through the ``current_stats`` context variable, which
+websocket_endpoint sets before starting the session's tasks; tasks and
+asyncio.to_thread calls inherit it, so db._timed can find the session without
+the DB layer knowing about sessions.
+"""
+import time
+from contextvars import ContextVar
+
+# Stats of the session whose task is running; None outside of /ws sessions
+current_stats: ContextVar = ContextVar("current_session_stats", default=None)
+
+UPSTREAM_AUDIO_BYTES_PER_SECOND = 16000 * 2 # 16 kHz 16-bit mono PCM
+
+
+class SessionStats:
+    __slots__ = (
+        "started_at",
+        "client_in_bytes", "client_in_messages", "client_out_bytes", "client_out_messages",
+        "upstream_in_bytes", "upstream_in_messages", "upstream_out_bytes", "upstream_out_messages",
+        "audio_bytes_forwarded", "images_forwarded", "tool_calls", "db_seconds",
+        "upstream_connects", "interrupts",
+    )
+
+    # Keys the admin API can sort by, besides the fields themselves
+    DERIVED = ("total_bytes", "audio_seconds", "age_seconds", "upstream_reconnects")
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.client_in_bytes = 0
+        self.client_in_messages = 0
+        self.client_out_bytes = 0
+        self.client_out_messages = 0
+        self.upstream_in_bytes = 0
+        self.upstream_in_messages = 0
+        self.upstream_out_bytes = 0
+        self.upstream_out_messages = 0
+        self.audio_bytes_forwarded = 0 # 16 kHz PCM bytes sent upstream
+        self.images_forwarded = 0
+        self.tool_calls = 0
+        self.db_seconds = 0.0
+        self.upstream_connects = 0
+        self.interrupts = 0
+
+    def as_dict(self) -> dict:
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        stats["db_seconds"] = round(self.db_seconds, 4)
+        stats["total_bytes"] = self.client_in_bytes + self.client_out_bytes + self.upstream_in_bytes + self.upstream_out_bytes
+        stats["audio_seconds"] = round(self.audio_bytes_forwarded / UPSTREAM_AUDIO_BYTES_PER_SECOND, 2)
+        stats["age_seconds"] = round(time.time() - self.started_at, 1)
+        stats["upstream_reconnects"] = max(0, self.upstream_connects - 1)
+        return stats
+
+    @classmethod
+    def sort_keys(cls):
+        return tuple(name for name in cls.__slots__ if name != "started_at") + cls.DERIVED
@@ -0,0 +1,200 @@
+"""Building the Gemini setup message without redoing the static work per connect.
+
+The setup message is mostly constant: the tool and function declarations never
+change, so they are serialized to JSON once at import and spliced into each
+message. The per-user part is the memory context (the user's newest
+MEMORY_CONTEXT_MAX memories, one per line, so the setup message stays bounded
+however many memories a user piles up), which is cached per user and
+invalidated whenever MemoryDB writes to that user's memories. Other worker processes do not see those invalidations,
+so entries also expire after MEMORY_CONTEXT_TTL seconds.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from db import MemoryDB
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MEMORY_CONTEXT_CACHE = metrics.Counter(
+    "memory_context_cache_total",
+    "Memory context lookups during session setup, by result (hit, miss).",
+    labelnames=("result",),
+)
+_HIT = MEMORY_CONTEXT_CACHE.labels("hit")
+_MISS = MEMORY_CONTEXT_CACHE.labels("miss")
+
+TOOLS = [
+    { "googleSearch": {} },
+    {
+        "function_declarations": [
+            {
+                "name": "store_memory",
+                "description": "Stores a memory in the database using MemoryDB.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "client_id": { "type": "string" },
+                        "content": { "type": "string" },
+                        "context": { "type": "string" },
+                        "tags": { "type": "array", "items": { "type": "string" } },
+                        "type": { "type": "string" }
+                    }
+                }
+            },
+            {
+                "name": "get_recent_memories",
+                "description": "Retrieves recent memories from the database.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "client_id": { "type": "string" },
+                        "limit": { "type": "integer" }
+                    }
+                }
+            },
+            {
+                "name": "search_memories",
+                "description": "Searches memories based on query.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "client_id": { "type": "string" },
+                        "query": { "type": "string" },
+                        "limit": { "type": "integer" }
+                    }
+                }
+            },
+            {
+                "name": "delete_memory",
+                "description": "Deletes a specific memory by its ID.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "memory_id": { "type": "integer" }
+                    }
+                }
+            },
+            {
+                "name": "update_memory",
+                "description": "Updates the content of a specific memory.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "memory_id": { "type": "integer" },
+                        "new_content": { "type": "string" }
+                    }
+                }
+            },
+            {
+                "name": "batch_memories",
+                "description": "Deletes, updates or retypes many memories at once, in one transaction.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "operation": { "type": "string", "enum": ["delete", "update", "retype"] },
+                        "memory_ids": { "type": "array", "items": { "type": "integer" } },
+                        "updates": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "memory_id": { "type": "integer" },
+                                    "new_content": { "type": "string" }
+                                }
+                            }
+                        },
+                        "type": { "type": "string" }
+                    }
+                }
+            }
+        ]
+    }
+]
+_TOOLS_JSON = json.dumps(TOOLS)
+
+
+def build_setup_message(model: str, voice: str, system_prompt: str, memory_context: str) -> str:
+    """Return the serialized setup message; only the per-session fields are encoded here."""
+    generation_config = {
+        "response_modalities": ["AUDIO"],
+        "speech_config": {
+            "voice_config": {
+                "prebuilt_voice_config": {
+                    "voice_name": voice
+                }
+            }
+        }
+    }
+    system_instruction = {
+        "parts": [
+            {
+                "text": system_prompt +
+                "\n\nHere are recent memories:\n" + memory_context +
+                "\n\nYou can also use the memory functions store_memory, get_recent_memories, and search_memories."
+                "\n\nUse the memory function often."
+            }
+        ]
+    }
+    return (
+        '{"setup": {"model": ' + json.dumps(f"models/{model}") +
+        ', "generation_config": ' + json.dumps(generation_config) +
+        ', "tools": ' + _TOOLS_JSON +
+        ', "system_instruction": ' + json.dumps(system_instruction) + '}}'
+    )
+
+
+def format_memory_context(memories) -> str:
+    return "\n".join(f"- {memory['content']}" for memory in memories)
+
+
+class MemoryContextCache:
+    def __init__(self, ttl: float = 60.0, max_memories: int = 200):
+        self.ttl = ttl # 0 disables caching
+        self.max_memories = max_memories # Newest memories put in the context; 0 for all of them
+        self._entries = {} # username -> (context, loaded_at)
+        self._generations = {} # username -> invalidation count, so loads racing a write are not cached
+        self._global_generation = 0
+        self._lock = threading.Lock() # Loads run in worker threads
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=float(os.getenv("MEMORY_CONTEXT_TTL", "60")),
+            max_memories=int(os.getenv("MEMORY_CONTEXT_MAX", "200")),
+        )
+
+    def _generation(self, username: str):
+        return self._global_generation, self._generations.get(username, 0)
+
+    def get(self, memory_db: MemoryDB, username: str) -> str:
+        """Return the formatted memory context for username, loading it on a miss."""
+        entry = self._entries.get(username)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            _HIT.inc()
+            return entry[0]
+        _MISS.inc()
+        generation = self._generation(username)
+        loaded_at = time.monotonic()
+        context = format_memory_context(memory_db.get_all_memories(username, limit=self.max_memories or None))
+        with self._lock:
+            if self.ttl > 0 and self._generation(username) == generation:
+                self._entries[username] = (context, loaded_at)
+        return context
+
+    def invalidate(self, username=None):
+        """Drop the cached context for username, or for everyone if username is None."""
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+                self._global_generation += 1
+            else:
+                self._entries.pop(username, None)
+                self._generations[username] = self._generations.get(username, 0) + 1
+
+
+memory_context_cache = MemoryContextCache.from_env()
+MemoryDB.add_write_listener(memory_context_cache.invalidate)
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# Backend modules are imported top-level, as uvicorn main:app does from the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import MemoryDB  # noqa: E402
+
+
+@pytest.fixture
+def memory_db(tmp_path):
+    db = MemoryDB(str(tmp_path / "memories.db"))
+    db.open()
+    yield db
+    db.close()
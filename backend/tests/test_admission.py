@@ -0,0 +1,115 @@
+"""Fair connect slot scheduling in AdmissionController."""
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def controller(**kwargs) -> AdmissionController:
+    return AdmissionController(max_concurrent_connects=1, **kwargs)
+
+
+def assert_idle(admission: AdmissionController):
+    assert admission._active_connects == 0
+    assert admission._pending_connects == 0
+    assert admission._waiters == {}
+    assert not admission._turns
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_slots_go_round_robin_between_users():
+    async def scenario():
+        admission = controller()
+        order = []
+
+        async def connect(name):
+            async with admission.connect_slot(name[0]):
+                order.append(name)
+
+        await admission._acquire_slot("held")
+        tasks = []
+        for name in ("a0", "a1", "a2", "b0", "b1", "c0"):
+            tasks.append(asyncio.create_task(connect(name)))
+            await settle()
+        admission._release_slot()
+        await asyncio.gather(*tasks)
+        assert order == ["a0", "b0", "c0", "a1", "b1", "a2"]
+        assert_idle(admission)
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_rejects_and_cleans_up():
+    async def scenario():
+        admission = controller(connect_queue_timeout=0.01)
+        await admission._acquire_slot("held")
+        with pytest.raises(AdmissionRejected):
+            async with admission.connect_slot("u"):
+                pass
+        assert admission._waiters == {} and not admission._turns
+        admission._release_slot()
+        assert_idle(admission)
+
+    asyncio.run(scenario())
+
+
+def test_release_between_cancel_and_cleanup():
+    async def scenario():
+        admission = controller()
+        await admission._acquire_slot("held")
+        waiter = asyncio.create_task(admission._acquire_slot("u"))
+        await settle()
+        # The release runs before the cancelled waiter gets to remove itself, so it drops it first
+        waiter.cancel()
+        admission._release_slot()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert_idle(admission)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_rest_of_its_users_queue():
+    async def scenario():
+        admission = controller()
+        await admission._acquire_slot("held")
+        first = asyncio.create_task(admission._acquire_slot("u"))
+        second = asyncio.create_task(admission._acquire_slot("u"))
+        other = asyncio.create_task(admission._acquire_slot("v"))
+        await settle()
+        first.cancel()
+        admission._release_slot()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await settle()
+        assert other.done() and not second.done()
+        admission._release_slot()
+        await asyncio.wait_for(second, timeout=1)
+        admission._release_slot()
+        assert_idle(admission)
+
+    asyncio.run(scenario())
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_passed_on():
+    async def scenario():
+        admission = controller()
+        await admission._acquire_slot("held")
+        granted = asyncio.create_task(admission._acquire_slot("a"))
+        waiting = asyncio.create_task(admission._acquire_slot("b"))
+        await settle()
+        admission._release_slot() # Hands the slot to a...
+        granted.cancel() # ...which is cancelled before it resumes
+        with pytest.raises(asyncio.CancelledError):
+            await granted
+        await asyncio.wait_for(waiting, timeout=1)
+        assert admission._active_connects == 1
+        admission._release_slot()
+        assert_idle(admission)
+
+    asyncio.run(scenario())
@@ -0,0 +1,63 @@
+"""G.711 tables and codec negotiation in audio_codec."""
+import base64
+
+import numpy as np
+import pytest
+
+import audio_codec
+
+ALL_SAMPLES = np.arange(-32768, 32768, dtype="<i2")
+DECODE_TABLES = {"mulaw": audio_codec.mulaw_decode_table, "alaw": audio_codec.alaw_decode_table}
+
+
+def encode(name: str, pcm: bytes) -> bytes:
+    return base64.b64decode(audio_codec.create(name).encode(base64.b64encode(pcm).decode("ascii")))
+
+
+@pytest.mark.parametrize("name", ["mulaw", "alaw"])
+def test_round_trip_stays_within_g711_quantisation(name):
+    decoded = DECODE_TABLES[name]()[np.frombuffer(encode(name, ALL_SAMPLES.tobytes()), dtype=np.uint8)].astype(np.int32)
+    error = np.abs(decoded - ALL_SAMPLES.astype(np.int32))
+    # Segments double their step size as the magnitude doubles, so the error grows with the sample
+    assert np.all(error <= np.abs(ALL_SAMPLES.astype(np.int32)) / 28 + 36)
+    # Louder samples never decode quieter
+    assert np.all(np.diff(decoded) >= 0)
+
+
+@pytest.mark.parametrize("name, reference", [("mulaw", "lin2ulaw"), ("alaw", "lin2alaw")])
+def test_tables_match_audioop(name, reference):
+    audioop = pytest.importorskip("audioop") # Removed from the standard library in Python 3.13
+    assert encode(name, ALL_SAMPLES.tobytes()) == getattr(audioop, reference)(ALL_SAMPLES.tobytes(), 2)
+
+
+@pytest.mark.parametrize("name", ["mulaw", "alaw"])
+def test_every_code_decodes_to_a_sample_that_encodes_back_to_it(name):
+    table = DECODE_TABLES[name]()
+    codes = np.frombuffer(encode(name, table.astype("<i2").tobytes()), dtype=np.uint8)
+    assert np.array_equal(table[codes], table)
+
+
+@pytest.mark.parametrize("name", ["mulaw", "alaw"])
+def test_odd_length_chunks_match_one_shot_encoding(name):
+    pcm = ALL_SAMPLES[::37].tobytes()
+    encoder = audio_codec.create(name)
+    out, offset = b"", 0
+    for size in (3, 1, 480, 7, 2, 1001) * 4:
+        out += base64.b64decode(encoder.encode(base64.b64encode(pcm[offset:offset + size]).decode("ascii")))
+        offset += size
+    out += base64.b64decode(encoder.encode(base64.b64encode(pcm[offset:]).decode("ascii")))
+    assert out == encode(name, pcm)
+
+
+def test_reset_drops_a_buffered_half_sample():
+    encoder = audio_codec.create("mulaw")
+    encoder.encode(base64.b64encode(b"\x01").decode("ascii"))
+    encoder.reset()
+    assert base64.b64decode(encoder.encode(base64.b64encode(b"\x00\x00").decode("ascii"))) == encode("mulaw", b"\x00\x00")
+
+
+def test_negotiate_picks_the_first_supported_codec():
+    assert audio_codec.negotiate(["speex", "alaw", "mulaw"]) == "alaw"
+    assert audio_codec.negotiate(["speex"]) == audio_codec.DEFAULT_CODEC
+    assert audio_codec.negotiate(None) == audio_codec.DEFAULT_CODEC
+    assert audio_codec.create("pcm16").encode("AAEC") == "AAEC"
@@ -0,0 +1,71 @@
+"""ETags, 304s and deltas on GET /memories and GET /config."""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from security import create_access_token
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # The app opens memories.db in the working directory
+    with TestClient(main.app) as client:
+        yield client
+
+
+def auth(username: str, etag: str = None) -> dict:
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+    if etag:
+        headers["If-None-Match"] = etag
+    return headers
+
+
+def test_matching_etag_gets_304(client):
+    first = client.get("/memories", headers=auth("alice"))
+    assert first.status_code == 200
+    assert first.headers["X-Version"] == "0"
+    assert first.headers["Vary"] == "Authorization"
+
+    again = client.get("/memories", headers=auth("alice", first.headers["ETag"]))
+    assert again.status_code == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert again.headers["Vary"] == "Authorization"
+
+
+def test_write_invalidates_the_etag(client):
+    tag = client.get("/memories", headers=auth("alice")).headers["ETag"]
+    client.app.state.memory_db.store_memory("new", "alice")
+    response = client.get("/memories", headers=auth("alice", tag))
+    assert response.status_code == 200
+    assert response.headers["X-Version"] == "1"
+    assert [m["content"] for m in response.json()] == ["new"]
+
+
+def test_etags_are_scoped_to_the_user(client):
+    alice = client.get("/memories", headers=auth("alice"))
+    bob = client.get("/memories", headers=auth("bob", alice.headers["ETag"]))
+    # Both are at version 0, but bob must not be told alice's cached body is current
+    assert bob.status_code == 200
+    assert bob.headers["ETag"] != alice.headers["ETag"]
+
+    config = client.get("/config", headers=auth("alice")).headers["ETag"]
+    assert client.get("/config", headers=auth("bob", config)).status_code == 200
+    assert client.get("/config", headers=auth("alice", config)).status_code == 304
+
+
+def test_since_version_returns_a_delta(client):
+    memory_db = client.app.state.memory_db
+    memory_db.store_memory("old", "alice")
+    memory_db.store_memory("doomed", "alice")
+    doomed = max(m["id"] for m in memory_db.get_all_memories("alice"))
+    memory_db.delete_memory(doomed, "alice")
+    memory_db.store_memory("new", "alice")
+
+    delta = client.get("/memories", params={"since_version": 2}, headers=auth("alice")).json()
+    assert delta["full"] is False
+    assert [m["content"] for m in delta["memories"]] == ["new"]
+    assert delta["deleted"] == [doomed]
+
+    memory_db.clear_memories()
+    after_clear = client.get("/memories", params={"since_version": 4}, headers=auth("alice")).json()
+    assert after_clear == {"version": 5, "full": True, "memories": [], "deleted": []}
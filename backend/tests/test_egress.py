@@ -0,0 +1,59 @@
+"""Generation epochs and interrupts in ClientEgress."""
+import asyncio
+
+from egress import ClientEgress
+
+
+def run_egress(scenario):
+    """Run scenario(egress) and return the messages the sender wrote, in order."""
+    async def main():
+        sent = []
+
+        async def send(payload):
+            sent.append(payload)
+
+        egress = ClientEgress(send)
+        await scenario(egress)
+        sender = asyncio.create_task(egress.run())
+        while len(egress):
+            await asyncio.sleep(0)
+        sender.cancel()
+        return sent
+
+    return asyncio.run(main())
+
+
+def test_interrupt_purges_queued_audio_and_sends_stop_audio_first():
+    async def scenario(egress):
+        for chunk in ("a", "b", "c"):
+            await egress.audio("audio", chunk)
+        await egress.put({"type": "text", "text": "kept"})
+        assert egress.interrupt() == 1
+
+    sent = run_egress(scenario)
+    assert sent == [{"type": "stop_audio", "data": True, "epoch": 1}, {"type": "text", "text": "kept"}]
+
+
+def test_rest_of_the_interrupted_turn_is_dropped():
+    async def scenario(egress):
+        await egress.audio("audio", "old 0")
+        egress.interrupt()
+        await egress.audio("audio", "old 1") # Upstream is still finishing the interrupted turn
+        assert egress.end_turn() is False
+        await egress.audio("audio", "new 0")
+        await egress.audio("audio", "new 1")
+        assert egress.end_turn() is True
+
+    sent = run_egress(scenario)
+    assert sent[0]["type"] == "stop_audio"
+    assert [(m["data"], m["epoch"], m["seq"]) for m in sent[1:]] == [("new 0", 1, 0), ("new 1", 1, 1)]
+
+
+def test_messages_queued_after_the_interrupt_are_kept():
+    async def scenario(egress):
+        await egress.audio("audio", "old")
+        egress.interrupt()
+        egress.end_turn()
+        await egress.audio("audio", "new")
+
+    assert [m.get("data") for m in run_egress(scenario)] == [True, "new"]
@@ -0,0 +1,70 @@
+"""Bulk memory operations through memory_batch.run."""
+import pytest
+
+import memory_batch
+from memory_batch import BatchError
+
+
+@pytest.fixture
+def alice_ids(memory_db):
+    for i in range(3):
+        memory_db.store_memory(f"memory {i}", "alice")
+    return sorted(m["id"] for m in memory_db.get_all_memories("alice"))
+
+
+def statuses(outcome) -> dict:
+    return {r["id"]: r["status"] for r in outcome["results"]}
+
+
+def test_every_requested_id_gets_a_result(memory_db, alice_ids):
+    outcome = memory_batch.run(memory_db, "alice", "delete", ids=[alice_ids[0], 999])
+    assert outcome["op"] == "delete"
+    assert outcome["version"] == memory_db.get_versions("alice")["memories"]
+    assert statuses(outcome) == {alice_ids[0]: "deleted", 999: "not_found"}
+    assert sorted(m["id"] for m in memory_db.get_all_memories("alice")) == alice_ids[1:]
+
+
+def test_update_and_retype(memory_db, alice_ids):
+    updates = [{"id": alice_ids[0], "content": "edited"}, {"id": alice_ids[1], "content": "also edited"}]
+    assert statuses(memory_batch.run(memory_db, "alice", "update", updates=updates)) == dict.fromkeys(alice_ids[:2], "updated")
+    assert statuses(memory_batch.run(memory_db, "alice", "retype", ids=alice_ids, new_type="note")) == dict.fromkeys(alice_ids, "retyped")
+    memories = {m["id"]: m for m in memory_db.get_all_memories("alice")}
+    assert memories[alice_ids[0]]["content"] == "edited"
+    assert {m["type"] for m in memories.values()} == {"note"}
+
+
+def test_other_users_ids_are_not_found(memory_db, alice_ids):
+    memory_db.store_memory("bob's", "bob")
+    bobs = memory_db.get_all_memories("bob")[0]["id"]
+    outcome = memory_batch.run(memory_db, "alice", "delete", ids=[bobs, alice_ids[0]])
+    assert statuses(outcome) == {bobs: "not_found", alice_ids[0]: "deleted"}
+    outcome = memory_batch.run(memory_db, "alice", "update", updates=[{"id": bobs, "content": "hijacked"}])
+    assert outcome == {"op": "update", "version": None, "results": [{"id": bobs, "status": "not_found"}]}
+    assert memory_db.get_all_memories("bob")[0]["content"] == "bob's"
+
+
+def test_duplicate_ids_are_rejected(memory_db, alice_ids):
+    with pytest.raises(BatchError):
+        memory_batch.run(memory_db, "alice", "update", updates=[{"id": alice_ids[0], "content": "a"}, {"id": alice_ids[0], "content": "b"}])
+    with pytest.raises(BatchError):
+        memory_batch.run(memory_db, "alice", "delete", ids=[alice_ids[0], alice_ids[0]])
+    assert memory_db.get_versions("alice")["memories"] == 3
+
+
+def test_batch_size_is_capped(memory_db, monkeypatch):
+    monkeypatch.setattr(memory_batch, "MAX_IDS", 2)
+    with pytest.raises(BatchError, match="at most 2"):
+        memory_batch.run(memory_db, "alice", "delete", ids=[1, 2, 3])
+    memory_batch.run(memory_db, "alice", "delete", ids=[1, 2])
+
+
+@pytest.mark.parametrize("op, kwargs", [
+    ("purge", {"ids": [1]}),
+    ("delete", {"ids": "1,2"}),
+    ("delete", {"ids": [True]}),
+    ("update", {"updates": [{"id": 1}]}),
+    ("retype", {"ids": [1]}),
+])
+def test_malformed_requests_are_rejected(memory_db, op, kwargs):
+    with pytest.raises(BatchError):
+        memory_batch.run(memory_db, "alice", op, **kwargs)
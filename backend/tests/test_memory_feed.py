@@ -0,0 +1,93 @@
+"""Coalescing and fan-out of memory change events in MemoryFeed."""
+import asyncio
+import threading
+
+from memory_feed import MemoryFeed
+
+
+def added(memory_id, version, content):
+    return {"type": "memory_added", "id": memory_id, "version": version,
+            "memory": {"id": memory_id, "content": content, "timestamp": "t", "type": "note"}}
+
+
+def updated(memory_id, version, **fields):
+    return {"type": "memory_updated", "id": memory_id, "version": version, "memory": {"id": memory_id, **fields}}
+
+
+def deleted(memory_id, version):
+    return {"type": "memory_deleted", "id": memory_id, "version": version}
+
+
+def batches(*changes):
+    """Push changes into a fresh subscription, then return the batch they coalesce into."""
+    async def scenario():
+        subscription = MemoryFeed(coalesce=0).subscribe("alice")
+        for change in changes:
+            subscription._push(change)
+        batch = await asyncio.wait_for(subscription.next_batch(0), timeout=1)
+        subscription.close()
+        return batch
+
+    return asyncio.run(scenario())
+
+
+def test_add_then_update_is_still_an_add():
+    batch = batches(added(1, 1, "draft"), updated(1, 2, content="final"))
+    assert batch["version"] == 2
+    assert batch["events"] == [added(1, 2, "final")]
+
+
+def test_updates_merge_their_fields():
+    batch = batches(updated(1, 1, content="edited"), updated(1, 2, type="fact"))
+    assert batch["events"] == [updated(1, 2, content="edited", type="fact")]
+
+
+def test_add_then_delete_cancels_out():
+    async def scenario():
+        subscription = MemoryFeed(coalesce=0).subscribe("alice")
+        subscription._push(added(1, 1, "oops"))
+        subscription._push(deleted(1, 2))
+        # Nothing to send for that burst, so next_batch keeps waiting and the version rides along later
+        waiting = asyncio.create_task(subscription.next_batch(0))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        subscription._push(added(2, 3, "kept"))
+        return await asyncio.wait_for(waiting, timeout=1)
+
+    batch = asyncio.run(scenario())
+    assert batch == {"type": "memory_changes", "version": 3, "events": [added(2, 3, "kept")]}
+
+
+def test_update_then_delete_is_a_delete():
+    assert batches(updated(1, 1, content="x"), deleted(1, 2))["events"] == [deleted(1, 2)]
+
+
+def test_events_keep_arrival_order_per_memory():
+    batch = batches(added(1, 1, "a"), added(2, 2, "b"), deleted(3, 3))
+    assert [e["id"] for e in batch["events"]] == [1, 2, 3]
+
+
+def test_clear_drops_pending_changes_and_comes_first():
+    batch = batches(added(1, 1, "gone"), {"type": "memories_cleared"}, added(2, 5, "after"))
+    assert batch["events"] == [{"type": "memories_cleared"}, added(2, 5, "after")]
+    assert batch["version"] == 5
+    batch = batches(added(1, 1, "gone"), {"type": "memories_cleared"})
+    assert batch == {"type": "memory_changes", "version": None, "events": [{"type": "memories_cleared"}]}
+
+
+def test_publish_reaches_only_the_users_subscriptions():
+    async def scenario():
+        feed = MemoryFeed(coalesce=0)
+        alice, bob = feed.subscribe("alice"), feed.subscribe("bob")
+        # MemoryDB calls listeners from whichever thread wrote
+        writer = threading.Thread(target=feed.publish, args=("alice", added(1, 1, "hers")))
+        writer.start()
+        writer.join()
+        assert (await asyncio.wait_for(alice.next_batch(0), timeout=1))["events"] == [added(1, 1, "hers")]
+        feed.publish(None, {"type": "memories_cleared"})
+        assert (await asyncio.wait_for(bob.next_batch(0), timeout=1))["events"] == [{"type": "memories_cleared"}]
+        alice.close()
+        bob.close()
+        assert feed._subscriptions == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+"""Per-user memories and config versions, deltas and tombstones in MemoryDB."""
+
+
+def memories_version(memory_db, username="alice"):
+    return memory_db.get_versions(username)["memories"]
+
+
+def ids(memory_db, username="alice"):
+    return [m["id"] for m in memory_db.get_all_memories(username)]
+
+
+def test_every_memory_write_bumps_the_version(memory_db):
+    assert memories_version(memory_db) == 0
+    assert memory_db.store_memory("first", "alice") == 1
+    memory_db.store_memory("second", "alice")
+    first, second = sorted(ids(memory_db))
+    assert memory_db.update_memory(first, "edited", "alice") == 3
+    assert memory_db.delete_memory(second, "alice") == 4
+    memory_db.store_memory("third", "alice")
+    memory_db.store_memory("fourth", "alice")
+    assert memory_db.update_memories({first: "again"}, "alice")[0] == 7
+    assert memory_db.retype_memories([first], "note", "alice")[0] == 8
+    assert memory_db.delete_memories(ids(memory_db), "alice")[0] == 9
+    assert memories_version(memory_db) == 9
+
+
+def test_writes_that_match_nothing_leave_the_version_alone(memory_db):
+    memory_db.store_memory("mine", "alice")
+    memory_db.store_memory("theirs", "bob")
+    theirs = ids(memory_db, "bob")[0]
+    assert memory_db.update_memory(theirs, "hijacked", "alice") is None
+    assert memory_db.delete_memory(theirs, "alice") is None
+    assert memory_db.delete_memories([theirs, 999], "alice") == (None, {theirs: False, 999: False})
+    assert memories_version(memory_db) == 1
+    assert memories_version(memory_db, "bob") == 1
+
+
+def test_versions_are_per_user(memory_db):
+    memory_db.store_memory("a", "alice")
+    memory_db.store_memory("b", "alice")
+    memory_db.store_memory("c", "bob")
+    assert memories_version(memory_db) == 2
+    assert memories_version(memory_db, "bob") == 1
+
+
+def test_config_version_only_moves_when_the_config_changes(memory_db):
+    memory_db.create_user("alice", "secret")
+    assert memory_db.update_user_config("alice", {"voice": "Puck"}) == 1
+    assert memory_db.update_user_config("alice", {"voice": "Puck"}) == 1
+    assert memory_db.update_user_config("alice", {"voice": "Kore"}) == 2
+    assert memory_db.get_versions("alice") == {"memories": 0, "config": 2}
+
+
+def test_delta_holds_changed_memories_and_tombstones(memory_db):
+    memory_db.store_memory("kept", "alice")
+    memory_db.store_memory("edited", "alice")
+    memory_db.store_memory("deleted", "alice")
+    kept, edited, deleted = sorted(ids(memory_db))
+    since = memories_version(memory_db)
+    memory_db.update_memory(edited, "edited later", "alice")
+    memory_db.delete_memory(deleted, "alice")
+    memory_db.store_memory("added", "alice")
+
+    delta = memory_db.get_memories_since("alice", since)
+    assert delta["version"] == 6
+    assert not delta["full"]
+    assert sorted(m["content"] for m in delta["memories"]) == ["added", "edited later"]
+    assert delta["deleted"] == [deleted]
+    assert memory_db.get_memories_since("alice", delta["version"]) == {"version": 6, "full": False, "memories": [], "deleted": []}
+
+
+def test_batch_deletes_leave_tombstones(memory_db):
+    for content in ("a", "b", "c"):
+        memory_db.store_memory(content, "alice")
+    since = memories_version(memory_db)
+    gone = sorted(ids(memory_db))[:2]
+    memory_db.delete_memories(gone, "alice")
+    assert sorted(memory_db.get_memories_since("alice", since)["deleted"]) == gone
+
+
+def test_clear_memories_makes_older_versions_reload_in_full(memory_db):
+    memory_db.store_memory("a", "alice")
+    memory_db.store_memory("b", "alice")
+    memory_db.delete_memory(ids(memory_db)[0], "alice")
+    before = memories_version(memory_db)
+    memory_db.clear_memories()
+    memory_db.store_memory("after the clear", "alice")
+
+    delta = memory_db.get_memories_since("alice", before)
+    assert delta["full"]
+    assert [m["content"] for m in delta["memories"]] == ["after the clear"]
+    assert delta["deleted"] == []
+    # Versions handed out after the clear give deltas again
+    assert not memory_db.get_memories_since("alice", before + 1)["full"]
+
+
+def test_versions_never_handed_out_reload_in_full(memory_db):
+    memory_db.store_memory("a", "alice")
+    delta = memory_db.get_memories_since("alice", 42)
+    assert delta["full"]
+    assert [m["content"] for m in delta["memories"]] == ["a"]
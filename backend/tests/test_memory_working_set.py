@@ -0,0 +1,111 @@
+"""Hit, fallback and invalidation rules of MemoryWorkingSet."""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from memory_working_set import MemoryWorkingSet
+
+
+class Spy:
+    """Counts calls to one MemoryDB method and passes them through."""
+
+    def __init__(self, memory_db, name):
+        self.calls = 0
+        self._method = getattr(memory_db, name)
+        setattr(memory_db, name, self)
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self._method(*args, **kwargs)
+
+
+@pytest.fixture
+def store(memory_db):
+    def store(*contents):
+        for content in contents:
+            memory_db.store_memory(content, "alice")
+    return store
+
+
+def contents(rows):
+    return [content for content, _ in rows]
+
+
+def test_complete_set_answers_without_the_db(memory_db, store):
+    store("tea at noon", "coffee at nine", "Tea with milk")
+    working_set = MemoryWorkingSet(memory_db, "alice", max_items=5)
+    working_set.load()
+    recent, search = Spy(memory_db, "get_recent_memories"), Spy(memory_db, "search_memories")
+
+    assert contents(asyncio.run(working_set.recent(2))) == ["Tea with milk", "coffee at nine"]
+    assert contents(asyncio.run(working_set.recent(10))) == ["Tea with milk", "coffee at nine", "tea at noon"]
+    assert contents(asyncio.run(working_set.search("TEA", 5))) == ["Tea with milk", "tea at noon"]
+    assert recent.calls == search.calls == 0
+
+
+def test_write_makes_the_set_reload(memory_db, store):
+    store("first")
+    working_set = MemoryWorkingSet(memory_db, "alice", max_items=5)
+    working_set.load()
+    loads = Spy(memory_db, "get_all_memories")
+    asyncio.run(working_set.recent(5))
+    assert loads.calls == 0
+
+    store("second")
+    assert contents(asyncio.run(working_set.recent(5))) == ["second", "first"]
+    assert loads.calls == 1
+    memory_db.store_memory("someone else's", "bob")
+    asyncio.run(working_set.recent(5))
+    assert loads.calls == 1 # Other users' writes leave this set alone
+
+
+def test_writes_the_listeners_miss_are_picked_up_after_the_ttl(memory_db, store):
+    store("first")
+    working_set = MemoryWorkingSet(memory_db, "alice", max_items=5, ttl=0.05)
+    working_set.load()
+    # Another worker process writes straight to the file; no listener in this process fires
+    with sqlite3.connect(memory_db.db_path) as conn:
+        conn.execute("INSERT INTO memories (content, type, username) VALUES ('from elsewhere', 'note', 'alice')")
+    assert contents(asyncio.run(working_set.recent(5))) == ["first"]
+    time.sleep(0.06)
+    assert "from elsewhere" in contents(asyncio.run(working_set.recent(5)))
+
+
+def test_incomplete_set_falls_back_when_it_may_miss_rows(memory_db, store):
+    store("tea 1", "coffee 2", "tea 3", "coffee 4", "tea 5")
+    working_set = MemoryWorkingSet(memory_db, "alice", max_items=2) # Holds "tea 5" and "coffee 4"
+    working_set.load()
+    assert not working_set.complete
+    recent, search = Spy(memory_db, "get_recent_memories"), Spy(memory_db, "search_memories")
+
+    assert contents(asyncio.run(working_set.recent(2))) == ["tea 5", "coffee 4"]
+    assert recent.calls == 0
+    assert len(asyncio.run(working_set.recent(3))) == 3
+    assert recent.calls == 1
+
+    assert contents(asyncio.run(working_set.search("tea", 1))) == ["tea 5"]
+    assert search.calls == 0
+    # Only one match in the set, but older ones may exist
+    assert contents(asyncio.run(working_set.search("tea", 2))) == ["tea 5", "tea 3"]
+    assert search.calls == 1
+
+
+def test_model_supplied_limits_are_coerced(memory_db, store):
+    store("a", "b", "c")
+    working_set = MemoryWorkingSet(memory_db, "alice", max_items=5)
+    working_set.load()
+    recent = Spy(memory_db, "get_recent_memories")
+    assert asyncio.run(working_set.recent(-3)) == []
+    assert asyncio.run(working_set.search("a", -1)) == []
+    assert contents(asyncio.run(working_set.recent(2.0))) == ["c", "b"]
+    assert recent.calls == 0
+
+
+def test_disabled_set_always_uses_the_db(memory_db, store):
+    store("a")
+    working_set = MemoryWorkingSet(memory_db, "alice", max_items=0)
+    recent = Spy(memory_db, "get_recent_memories")
+    assert contents(asyncio.run(working_set.recent(1))) == ["a"]
+    assert recent.calls == 1
@@ -0,0 +1,144 @@
+"""Vision ingest stage for camera and screen frames on /ws.
+
+Clients send ``image`` messages as fast as they capture, and most consecutive
+frames of a webcam or a static screen are near-identical. Each session gets a
+VisionIngest that decides per frame whether it is worth forwarding upstream:
+
+* an adaptive minimum interval between forwarded frames, which backs off while
+  the model is speaking or the upstream socket has unsent data queued;
+* a 64-bit difference hash (dHash) of a 9x8 grayscale thumbnail, so frames
+  within a small Hamming distance of the last forwarded one are dropped;
+* a keyframe interval that forwards an unchanged scene now and then anyway.
+
+The rate check runs first because it is free; the hash is computed off the
+event loop by image_pipeline.prepare_frame(), which decodes the frame anyway.
+
+Pillow is used for decoding when installed. Without it only byte-identical
+frames are detected as duplicates.
+"""
+import hashlib
+import io
+import logging
+import os
+import time
+
+import metrics
+
+try:
+    from PIL import Image
+except ImportError: # Pillow is optional
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+VISION_FRAMES = metrics.Counter(
+    "vision_frames_total",
+    "Image frames received from clients, by outcome (forwarded, duplicate, rate_limited).",
+    labelnames=("outcome",),
+)
+_FORWARDED = VISION_FRAMES.labels("forwarded")
+_DUPLICATE = VISION_FRAMES.labels("duplicate")
+_RATE_LIMITED = VISION_FRAMES.labels("rate_limited")
+
+
+def dhash_image(img) -> int:
+    """Return a 64-bit difference hash of a decoded Pillow image."""
+    pixels = list(img.convert("L").resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def frame_hash(jpeg_bytes: bytes) -> int:
+    """Return a 64-bit perceptual difference hash of a JPEG frame."""
+    if Image is None:
+        return int.from_bytes(hashlib.blake2b(jpeg_bytes, digest_size=8).digest(), "big")
+    with Image.open(io.BytesIO(jpeg_bytes)) as img:
+        # draft() lets the JPEG decoder scale down by up to 8x during decode, which is far cheaper than a full decode
+        img.draft("L", (64, 64))
+        return dhash_image(img)
+
+
+class VisionIngest:
+    def __init__(
+        self,
+        max_fps: float = 2.0,
+        speaking_fps: float = 0.5,
+        saturated_fps: float = 0.25,
+        hash_threshold: int = 4,
+        keyframe_seconds: float = 10.0,
+        saturation_bytes: int = 256 * 1024,
+    ):
+        self.max_fps = max_fps
+        self.speaking_fps = speaking_fps # Frame rate while the model is talking
+        self.saturated_fps = saturated_fps # Frame rate while the upstream socket has a send backlog
+        self.hash_threshold = hash_threshold if Image is not None else 0 # Max differing bits for a duplicate
+        self.keyframe_seconds = keyframe_seconds
+        self.saturation_bytes = saturation_bytes
+
+        self.last_hash = None
+        self.last_forwarded_at = 0.0
+        self.forwarded = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_fps=float(os.getenv("VISION_MAX_FPS", "2")),
+            speaking_fps=float(os.getenv("VISION_SPEAKING_FPS", "0.5")),
+            saturated_fps=float(os.getenv("VISION_SATURATED_FPS", "0.25")),
+            hash_threshold=int(os.getenv("VISION_HASH_THRESHOLD", "4")),
+            keyframe_seconds=float(os.getenv("VISION_KEYFRAME_SECONDS", "10")),
+            saturation_bytes=int(os.getenv("VISION_SATURATION_BYTES", str(256 * 1024))),
+        )
+
+    def current_interval(self, model_speaking: bool, upstream_backlog: int) -> float:
+        """Minimum seconds between forwarded frames under the current conditions."""
+        fps = self.max_fps
+        if model_speaking:
+            fps = min(fps, self.speaking_fps)
+        if upstream_backlog > self.saturation_bytes:
+            fps = min(fps, self.saturated_fps)
+        return 1.0 / fps if fps > 0 else float("inf")
+
+    def check_rate(self, model_speaking: bool = False, upstream_backlog: int = 0, busy: bool = False) -> bool:
+        """First stage: is it time for another frame? Call before decoding anything.
+
+        busy means the previous frame is still being prepared; newer frames are dropped meanwhile.
+        """
+        if busy or time.monotonic() - self.last_forwarded_at < self.current_interval(model_speaking, upstream_backlog):
+            self.rate_limited += 1
+            _RATE_LIMITED.inc()
+            return False
+        return True
+
+    def check_duplicate(self, digest) -> bool:
+        """Second stage: given the frame's hash (None if unknown), should it be forwarded?"""
+        now = time.monotonic()
+        since_last = now - self.last_forwarded_at
+        if (
+            digest is not None
+            and self.last_hash is not None
+            and bin(digest ^ self.last_hash).count("1") <= self.hash_threshold
+            and since_last < self.keyframe_seconds
+        ):
+            self.duplicates += 1
+            _DUPLICATE.inc()
+            return False
+
+        self.last_hash = digest
+        self.last_forwarded_at = now
+        self.forwarded += 1
+        _FORWARDED.inc()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "forwarded": self.forwarded,
+            "duplicates": self.duplicates,
+            "rate_limited": self.rate_limited,
+        }
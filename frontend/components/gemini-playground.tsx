@@ -4,7 +4,10 @@ import React, { useState, useRef, useEffect } from "react";
 import { Mic, StopCircle, Video, Monitor } from "lucide-react";
 import { Alert, AlertDescription, AlertTitle } from "@/components/ui/alert";
 import { Button } from "@/components/ui/button";
-import { base64ToFloat32Array, float32ToPcm16 } from "@/lib/utils";
+import { base64ToFloat32Array, base64MulawToFloat32Array, float32ToPcm16 } from "@/lib/utils";
+
+// Model audio encodings this client can decode, most preferred first
+const AUDIO_CODECS = ["mulaw", "pcm16"];
 
 // Import our components
 import AudioStatus from "./audio-status";
@@ -165,6 +168,7 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
         JSON.stringify({
           type: "config",
           config: config,
+          audio_codecs: AUDIO_CODECS,
         })
       );
     }
@@ -199,6 +203,59 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
   const isPlayingRef = useRef(false);
   const currentAudioSourceRef = useRef<AudioBufferSourceNode | null>(null);
   const sfxAudioRef = useRef<HTMLAudioElement | null>(null);
+  // Audio chunks carry the server's generation epoch; anything older than this was interrupted.
+  // Epochs restart at 0 with every /ws session, so these are reset whenever a new socket opens.
+  const minAudioEpochRef = useRef(0);
+  const lastAudioEpochRef = useRef(0);
+  // Encoding of model audio chunks, announced by the server in an audio_format message
+  const audioCodecRef = useRef("pcm16");
+  // Lets a reconnecting socket reattach to the upstream session the server parked after a drop
+  const resumeTokenRef = useRef<string | null>(null);
+
+  const resetAudioEpochs = () => {
+    minAudioEpochRef.current = 0;
+    lastAudioEpochRef.current = 0;
+    audioCodecRef.current = "pcm16";
+  };
+
+  const handleServerMessage = (ws: WebSocket, response) => {
+    if (ws !== wsRef.current) {
+      return; // Late message from a socket that has been replaced; its epochs mean nothing now
+    }
+    if (response.type === "audio") {
+      if (response.epoch !== undefined) {
+        if (response.epoch < minAudioEpochRef.current) {
+          return; // Late chunk of an interrupted generation
+        }
+        lastAudioEpochRef.current = response.epoch;
+      }
+      const audioData =
+        audioCodecRef.current === "mulaw"
+          ? base64MulawToFloat32Array(response.data)
+          : base64ToFloat32Array(response.data);
+      playAudioData(audioData, response.epoch);
+    } else if (response.type === "session") {
+      resumeTokenRef.current = response.resume_token;
+    } else if (response.type === "audio_format") {
+      console.log("Model audio encoding:", response.codec);
+      audioCodecRef.current = response.codec;
+    } else if (response.type === "interrupt") {
+      console.log("Received interrupt confirmation from server:", response);
+    } else if (response.type === "interrupt_confirmed") {
+      console.log("Received interrupt_confirmed from Gemini API:", response);
+      stopAudio(); // Stop audio playback when interrupt is confirmed
+    } else if (response.type === "stop_audio") {
+      console.log("Received stop_audio command from server");
+      if (response.epoch !== undefined) {
+        minAudioEpochRef.current = Math.max(minAudioEpochRef.current, response.epoch);
+      }
+      stopAudio(); // Stop audio playback
+      // Let the server measure interrupt-to-silence latency
+      if (ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: "audio_stopped", epoch: response.epoch }));
+      }
+    }
+  };
 
   const startStream = async (mode: "audio" | "camera" | "screen") => {
     if (mode !== "audio") {
@@ -213,6 +270,7 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
       return;
     }
 
+    resetAudioEpochs();
     wsRef.current = new WebSocket(
       `${process.env.NEXT_PUBLIC_API_URL.replace(
         "http",
@@ -225,6 +283,7 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
         JSON.stringify({
           type: "config",
           config: config,
+          audio_codecs: AUDIO_CODECS,
         })
       );
 
@@ -240,19 +299,7 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
     };
 
     wsRef.current.onmessage = async (event) => {
-      const response = JSON.parse(event.data);
-      if (response.type === "audio") {
-        const audioData = base64ToFloat32Array(response.data);
-        playAudioData(audioData);
-      } else if (response.type === "interrupt") {
-        console.log("Received interrupt confirmation from server:", response);
-      } else if (response.type === "interrupt_confirmed") {
-        console.log("Received interrupt_confirmed from Gemini API:", response);
-        stopAudio(); // Stop audio playback when interrupt is confirmed
-      } else if (response.type === "stop_audio") {
-        console.log("Received stop_audio command from server");
-        stopAudio(); // Stop audio playback
-      }
+      handleServerMessage(event.target as WebSocket, JSON.parse(event.data));
     };
 
     wsRef.current.onerror = (error) => {
@@ -328,23 +375,13 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
                 JSON.stringify({
                   type: "config",
                   config: config,
+                  audio_codecs: AUDIO_CODECS,
+                  resume_token: resumeTokenRef.current,
                 })
               );
             };
             ws.onmessage = async (event) => {
-              const response = JSON.parse(event.data);
-              if (response.type === "audio") {
-                const audioData = base64ToFloat32Array(response.data);
-                playAudioData(audioData);
-              } else if (response.type === "interrupt") {
-                console.log("Received interrupt confirmation from server:", response);
-              } else if (response.type === "interrupt_confirmed") {
-                console.log("Received interrupt_confirmed from Gemini API:", response);
-                stopAudio(); // Stop audio playback when interrupt is confirmed
-              } else if (response.type === "stop_audio") {
-                console.log("Received stop_audio command from server");
-                stopAudio(); // Stop audio playback
-              }
+              handleServerMessage(ws, JSON.parse(event.data));
             };
             ws.onerror = (error) => {
               setError("WebSocket error: " + error.message);
@@ -352,6 +389,7 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
             ws.onclose = (event) => {
               setIsStreaming(false);
             };
+            resetAudioEpochs();
             wsRef.current = ws;
             lastWsConnectionAttemptRef.current = Date.now();
           }
@@ -530,9 +568,10 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
       wsRef.current.onerror = null;
       wsRef.current.onclose = null;
 
-      // Close and nullify
-      wsRef.current.close();
+      // Close and nullify; a normal close tells the server not to park the session
+      wsRef.current.close(1000, "Stream stopped");
       wsRef.current = null;
+      resumeTokenRef.current = null;
     }
 
     setIsStreaming(false);
@@ -540,14 +579,15 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
     setChatMode(null);
   };
 
-  const playAudioData = async (audioData) => {
+  const playAudioData = async (audioData, epoch?: number) => {
     // Create a queue for audio chunks
     if (!audioBufferRef.current) {
       audioBufferRef.current = [];
     }
 
-    // Don't buffer audio if we're in an interrupted state
-    if (isInterruptedRef.current) {
+    // Don't buffer audio if we're in an interrupted state. Epoch-tagged chunks have
+    // already been checked against the last stop_audio, so only untagged ones wait here.
+    if (epoch === undefined && isInterruptedRef.current) {
       console.log("Skipping audio buffering due to active interruption");
       return;
     }
@@ -804,6 +844,10 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
                 wsRef.current.readyState === WebSocket.OPEN
               ) {
                 wsRef.current.send(JSON.stringify({ type: "interrupt" }));
+                // The server bumps its epoch for this interrupt, so drop the rest of the current
+                // generation without waiting for its stop_audio. Only once the interrupt is sent:
+                // otherwise the server's epoch never moves and the next turn would be dropped too.
+                minAudioEpochRef.current = lastAudioEpochRef.current + 1;
                 console.log("Interrupt message sent to backend via WebSocket.");
 
                 // Only show interrupting message if wake word is not enabled
@@ -859,10 +903,11 @@ export default function GeminiPlayground({ onLogout }: GeminiPlaygroundProps) {
                 `ws://54.158.95.38:8000/ws?token=${encodeURIComponent(token)}`
               );
               ws.onopen = async () => {
-                ws.send(JSON.stringify({ type: "config", config: config }));
+                ws.send(JSON.stringify({ type: "config", config: config, audio_codecs: AUDIO_CODECS, resume_token: resumeTokenRef.current }));
                 setIsStreaming(true);
                 setIsConnected(true);
               };
+              resetAudioEpochs();
               wsRef.current = ws;
             }
           }
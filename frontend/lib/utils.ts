@@ -27,3 +27,25 @@ export const base64ToFloat32Array = (base64: string) => {
   }
   return float32;
 };
+
+// G.711 mu-law code -> 16-bit sample, built once
+const MULAW_TABLE = (() => {
+  const table = new Int16Array(256);
+  for (let i = 0; i < 256; i++) {
+    const code = ~i & 0xff;
+    const exponent = (code >> 4) & 0x07;
+    const magnitude = (((code & 0x0f) << 3) + 0x84) << exponent;
+    table[i] = code & 0x80 ? 0x84 - magnitude : magnitude - 0x84;
+  }
+  return table;
+})();
+
+// Utility function to convert base64 mu-law (audio_format "mulaw") to Float32Array
+export const base64MulawToFloat32Array = (base64: string) => {
+  const binary = atob(base64);
+  const float32 = new Float32Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    float32[i] = MULAW_TABLE[binary.charCodeAt(i)] / 32768.0;
+  }
+  return float32;
+};